@@ -0,0 +1,345 @@
+"""
+NumPy-batched Dr Mario simulator.
+
+Steps N independent games at once. Every board lives in one (N, rows, cols)
+int8 colour array (-1 for empty), a matching link array holding engine.Link
+values and a virus mask. Pill movement, gravity, matching and clearing are
+array operations over the whole batch, following the same rules as
+engine.Pill, Board.resolve and Board.findMatches. A settled pill is resolved
+to a fixpoint straight away, like GameState(instantResolve = True). Given a
+level pack, reset copies random boards out of the memory-mapped pack in one
+array operation instead of placing viruses.
+
+# @Author: V.K. Prinsen
+
+"""
+
+import random
+
+import numpy as np
+
+from engine import (BOARD_ROWS, BOARD_COLS, START_ROW, START_COL, MATCH_COUNT, PILL_GRAVITY_TIMER, TICK_MS, LEVEL,
+	COLOUR_MASK, VIRUS_FLAG, LINK_SHIFT, Colour, Orientation, Link, Action, virusPlacements, cellColour, cellIsVirus,
+	cellLink)
+from levelpack import PACK_HEADER, RECORD_HEADER, LevelPack
+
+VERTICAL = Orientation.VERTICAL.value
+HORIZONTAL = Orientation.HORIZONTAL.value
+
+# Array rules, shared by every (games, rows, cols) slice of a batch
+
+def resolve(colour, link, virus):
+	"""moves every unsupported pill half down a single row, like Board.resolve; returns which boards moved"""
+	rows = colour.shape[1]
+	moved = np.zeros(colour.shape[0], dtype = bool)
+	for row in reversed(range(0, rows - 1)):
+		freeBelow = colour[:, row + 1] < 0
+		falling = (colour[:, row] >= 0) & ~virus[:, row] & freeBelow
+		if not falling.any():
+			continue
+		# a horizontal pill only falls if both halves can
+		leftHalves = link[:, row] == Link.RIGHT
+		pairFree = np.zeros_like(freeBelow)
+		pairFree[:, :-1] = freeBelow[:, :-1] & freeBelow[:, 1:]
+		blockedLeft = leftHalves & ~pairFree
+		blocked = blockedLeft.copy()
+		blocked[:, 1:] |= blockedLeft[:, :-1]
+		falling &= ~blocked
+		# move the falling halves down, then bring the top halves of vertical pills along
+		colour[:, row + 1][falling] = colour[:, row][falling]
+		link[:, row + 1][falling] = link[:, row][falling]
+		colour[:, row][falling] = -1
+		link[:, row][falling] = Link.NONE
+		if row > 0:
+			tops = falling & (link[:, row + 1] == Link.UP)
+			colour[:, row][tops] = colour[:, row - 1][tops]
+			link[:, row][tops] = Link.DOWN
+			colour[:, row - 1][tops] = -1
+			link[:, row - 1][tops] = Link.NONE
+		moved |= falling.any(axis = 1)
+	return moved
+
+def findMatches(colour):
+	"""mask of every cell in a horizontal/vertical run of MATCH_COUNT or more, like Board.findMatches"""
+	(games, rows, cols) = colour.shape
+	matched = np.zeros(colour.shape, dtype = bool)
+	for value in range(0, len(Colour)):
+		plane = colour == value
+		if rows >= MATCH_COUNT:
+			vertical = plane[:, :rows - MATCH_COUNT + 1].copy()
+			for i in range(1, MATCH_COUNT):
+				vertical &= plane[:, i:rows - MATCH_COUNT + 1 + i]
+			for i in range(0, MATCH_COUNT):
+				matched[:, i:rows - MATCH_COUNT + 1 + i] |= vertical
+		if cols >= MATCH_COUNT:
+			horizontal = plane[:, :, :cols - MATCH_COUNT + 1].copy()
+			for i in range(1, MATCH_COUNT):
+				horizontal &= plane[:, :, i:cols - MATCH_COUNT + 1 + i]
+			for i in range(0, MATCH_COUNT):
+				matched[:, :, i:cols - MATCH_COUNT + 1 + i] |= horizontal
+	return matched
+
+def clearMatches(colour, link, virus, matched):
+	"""empties the matched cells, unlinking their partners, and returns viruses cleared per board"""
+	virusesCleared = (matched & virus).sum(axis = (1, 2))
+	# split every surviving partner from its matched half
+	link[:, :, 1:][matched[:, :, :-1] & (link[:, :, :-1] == Link.RIGHT)] = Link.NONE
+	link[:, :, :-1][matched[:, :, 1:] & (link[:, :, 1:] == Link.LEFT)] = Link.NONE
+	link[:, 1:][matched[:, :-1] & (link[:, :-1] == Link.DOWN)] = Link.NONE
+	link[:, :-1][matched[:, 1:] & (link[:, 1:] == Link.UP)] = Link.NONE
+	colour[matched] = -1
+	link[matched] = Link.NONE
+	virus[matched] = False
+	return virusesCleared
+
+def resolveCascade(colour, link, virus):
+	"""drops and clears until no board changes, returns viruses cleared per board"""
+	virusesCleared = np.zeros(colour.shape[0], dtype = np.int32)
+	unstable = np.ones(colour.shape[0], dtype = bool)
+	while unstable.any():
+		games = np.nonzero(unstable)[0]
+		subColour = colour[games]
+		subLink = link[games]
+		subVirus = virus[games]
+		moved = resolve(subColour, subLink, subVirus)
+		# boards that stopped falling get checked for matches
+		matched = findMatches(subColour) & ~moved[:, None, None]
+		hasMatches = matched.any(axis = (1, 2))
+		virusesCleared[games] += clearMatches(subColour, subLink, subVirus, matched)
+		colour[games] = subColour
+		link[games] = subLink
+		virus[games] = subVirus
+		unstable[:] = False
+		unstable[games] = moved | hasMatches
+	return virusesCleared
+
+class BatchGame():
+	"""N games of Dr Mario stepped together as arrays"""
+	def __init__(self, numGames, level = LEVEL, rows = BOARD_ROWS, cols = BOARD_COLS, seed = None, levelPack = None):
+		self.numGames = numGames
+		self.packRecords = None
+		if levelPack is not None:
+			if isinstance(levelPack, str):
+				levelPack = LevelPack(levelPack)
+			(rows, cols) = (levelPack.rows, levelPack.cols)
+			# (count, record size) view straight onto the map, nothing is read until a board is used
+			self.packRecords = np.frombuffer(levelPack.data, dtype = np.uint8, count = len(levelPack) * levelPack.recordSize,
+				offset = PACK_HEADER.size).reshape(len(levelPack), levelPack.recordSize)
+		self.rows = rows
+		self.cols = cols
+		self.level = np.full(numGames, level, dtype = np.int16)
+		self.rng = random.Random(seed)
+		self.pillRng = np.random.default_rng(seed)
+		# board planes
+		self.colour = np.full((numGames, rows, cols), -1, dtype = np.int8)
+		self.link = np.zeros((numGames, rows, cols), dtype = np.int8)
+		self.virus = np.zeros((numGames, rows, cols), dtype = bool)
+		# falling pill, anchored at its top-left half like engine.Pill
+		self.pillRow = np.zeros(numGames, dtype = np.int16)
+		self.pillCol = np.zeros(numGames, dtype = np.int16)
+		self.pillOrient = np.zeros(numGames, dtype = np.int8)
+		self.pillColours = np.zeros((numGames, 2), dtype = np.int8)
+		self.gravityTimer = np.zeros(numGames, dtype = np.int32)
+		# game progress
+		self.virusCount = np.zeros(numGames, dtype = np.int16)
+		self.pillsUsed = np.zeros(numGames, dtype = np.int32)
+		self.gameOver = np.zeros(numGames, dtype = bool)
+		self.won = np.zeros(numGames, dtype = bool)
+		self.reset()
+	def reset(self, indices = None, level = None):
+		"""starts new games on the given boards (all of them by default)"""
+		if indices is None:
+			indices = np.arange(self.numGames)
+		indices = np.asarray(indices)
+		if level is not None:
+			self.level[indices] = level
+		if self.packRecords is not None:
+			self.loadPackBoards(indices)
+		else:
+			self.placeViruses(indices)
+		self.virusCount[indices] = self.virus[indices].sum(axis = (1, 2))
+		self.pillsUsed[indices] = 0
+		self.gameOver[indices] = False
+		self.won[indices] = False
+		self.spawnPills(self.maskOf(indices))
+	def placeViruses(self, indices):
+		self.colour[indices] = -1
+		self.link[indices] = Link.NONE
+		self.virus[indices] = False
+		for index in indices:
+			# same placement rules as GameState.spawnViruses
+			placements = virusPlacements(int(self.level[index]), self.rng, self.rows, self.cols)
+			(rows, cols, colours) = zip(*placements)
+			self.colour[index, list(rows), list(cols)] = colours
+			self.virus[index, list(rows), list(cols)] = True
+	def loadPackBoards(self, indices):
+		"""copies random level pack boards, and their levels, into the given slots"""
+		records = self.packRecords[[self.rng.randrange(len(self.packRecords)) for index in indices]]
+		cells = records[:, RECORD_HEADER.size:].reshape(len(indices), self.rows, self.cols)
+		self.level[indices] = records[:, RECORD_HEADER.size - 1]
+		self.colour[indices] = (cells & COLOUR_MASK).astype(np.int8) - 1
+		self.link[indices] = cells >> LINK_SHIFT
+		self.virus[indices] = (cells & VIRUS_FLAG) != 0
+	def maskOf(self, indices):
+		mask = np.zeros(self.numGames, dtype = bool)
+		mask[indices] = True
+		return mask
+	def loadState(self, index, state):
+		"""copies the board and pill of an engine GameState into one slot of the batch"""
+		board = state.board
+		for row in range(0, self.rows):
+			for col in range(0, self.cols):
+				cell = board.get(row, col)
+				self.colour[index, row, col] = cellColour(cell)
+				self.link[index, row, col] = cellLink(cell)
+				self.virus[index, row, col] = cellIsVirus(cell)
+		pill = state.pill
+		if pill:
+			self.pillRow[index] = pill.row
+			self.pillCol[index] = pill.col
+			self.pillOrient[index] = pill.orient.value
+			self.pillColours[index] = pill.colours
+			self.gravityTimer[index] = pill.gravityTimer
+		self.virusCount[index] = state.virusCount
+		self.pillsUsed[index] = state.pillsUsed
+		self.gameOver[index] = state.gameOver
+		self.won[index] = state.won
+	def occupiedAt(self, rows, cols):
+		"""per-board collision test at rows,cols; everything off the board collides"""
+		inside = (rows >= 0) & (rows < self.rows) & (cols >= 0) & (cols < self.cols)
+		result = np.ones(self.numGames, dtype = bool)
+		games = np.nonzero(inside)[0]
+		result[games] = self.colour[games, rows[games], cols[games]] >= 0
+		return result
+	def spawnPills(self, mask):
+		"""spawns a pill on every masked board; the game is lost where it collides"""
+		count = int(mask.sum())
+		if not count:
+			return
+		self.pillRow[mask] = START_ROW
+		self.pillCol[mask] = min(START_COL, self.cols - 1) - 1
+		self.pillOrient[mask] = HORIZONTAL
+		self.pillColours[mask] = self.pillRng.integers(0, len(Colour), size = (count, 2))
+		self.gravityTimer[mask] = 0
+		self.pillsUsed[mask] += 1
+		colliding = self.occupiedAt(self.pillRow, self.pillCol) | self.occupiedAt(self.pillRow, self.pillCol + 1)
+		self.gameOver |= mask & colliding
+	def pillCanFall(self):
+		row = self.pillRow
+		col = self.pillCol
+		vertical = self.pillOrient == VERTICAL
+		blockedVertical = self.occupiedAt(row + 2, col)
+		blockedHorizontal = self.occupiedAt(row + 1, col) | self.occupiedAt(row + 1, col + 1)
+		return ~np.where(vertical, blockedVertical, blockedHorizontal)
+	def moveLeft(self, mask):
+		row = self.pillRow
+		col = self.pillCol
+		blocked = self.occupiedAt(row, col - 1) | ((self.pillOrient == VERTICAL) & self.occupiedAt(row + 1, col - 1))
+		self.pillCol -= mask & ~blocked
+	def moveRight(self, mask):
+		row = self.pillRow
+		col = self.pillCol
+		vertical = self.pillOrient == VERTICAL
+		blocked = np.where(vertical, self.occupiedAt(row, col + 1) | self.occupiedAt(row + 1, col + 1), self.occupiedAt(row, col + 2))
+		self.pillCol += mask & ~blocked
+	def rotate(self, mask):
+		"""rotate the masked pills 90 degrees, including the rotate-the-other-way cases of Pill.rotate"""
+		row = self.pillRow.copy()
+		col = self.pillCol.copy()
+		horizontal = mask & (self.pillOrient == HORIZONTAL)
+		vertical = mask & (self.pillOrient == VERTICAL)
+		# horizontal: the right-hand side rotates up, or down when there is no room above
+		upBlocked = self.occupiedAt(row - 1, col)
+		rotateUp = horizontal & ~upBlocked
+		rotateDown = horizontal & upBlocked & ~self.occupiedAt(row + 1, col)
+		self.pillRow -= rotateUp
+		self.pillColours[rotateUp] = self.pillColours[rotateUp][:, ::-1]
+		self.pillOrient[rotateUp | rotateDown] = VERTICAL
+		# vertical: rotate counterclockwise into the bottom half's row, or to its left when blocked
+		rightBlocked = self.occupiedAt(row + 1, col + 1)
+		rotateRight = vertical & ~rightBlocked
+		rotateLeft = vertical & rightBlocked & ~self.occupiedAt(row + 1, col - 1)
+		self.pillRow += rotateRight | rotateLeft
+		self.pillCol -= rotateLeft
+		self.pillOrient[rotateRight | rotateLeft] = HORIZONTAL
+	def applyGravity(self, mask, timeDelta, userInput = False):
+		"""returns the masked boards whose pill is blocked when gravity triggers"""
+		self.gravityTimer += np.where(mask, timeDelta, 0).astype(np.int32)
+		due = mask & ((self.gravityTimer > PILL_GRAVITY_TIMER) | userInput)
+		self.gravityTimer[due] = 0
+		canFall = self.pillCanFall()
+		self.pillRow += due & canFall
+		return due & ~canFall
+	def moveDown(self, mask):
+		blocked = self.applyGravity(mask, 0, userInput = True)
+		# if we hit something, set the timer so gravity triggers next tick
+		self.gravityTimer[blocked] += PILL_GRAVITY_TIMER
+	def landingRow(self, games, rows, cols):
+		"""lowest row a half at rows,cols of each of games can fall to, like Board.landingRow"""
+		# (games, rows) occupancy of each half's column, below the half
+		below = (self.colour[games, :, cols] >= 0) & (np.arange(self.rows) > rows[:, None])
+		return np.where(below.any(axis = 1), below.argmax(axis = 1), self.rows) - 1
+	def hardDrop(self, mask):
+		"""drops the masked pills as far as they go and makes them lock on the next tick, like Pill.hardDrop"""
+		games = np.nonzero(mask)[0]
+		if not len(games):
+			return
+		row = self.pillRow[games]
+		col = self.pillCol[games]
+		vertical = self.pillOrient[games] == VERTICAL
+		# a vertical pill lands on its bottom half, a horizontal one on whichever half is stopped first
+		verticalRow = self.landingRow(games, row + 1, col) - 1
+		horizontalRow = np.minimum(self.landingRow(games, row, col),
+			self.landingRow(games, row, np.minimum(col + 1, self.cols - 1)))
+		self.pillRow[games] = np.where(vertical, verticalRow, horizontalRow)
+		self.gravityTimer[games] = PILL_GRAVITY_TIMER + 1
+	def settle(self, mask):
+		"""locks the masked pills into their boards as linked halves"""
+		games = np.nonzero(mask)[0]
+		row = self.pillRow[games]
+		col = self.pillCol[games]
+		vertical = self.pillOrient[games] == VERTICAL
+		otherRow = row + vertical
+		otherCol = col + ~vertical
+		self.colour[games, row, col] = self.pillColours[games, 0]
+		self.colour[games, otherRow, otherCol] = self.pillColours[games, 1]
+		self.link[games, row, col] = np.where(vertical, Link.DOWN, Link.RIGHT)
+		self.link[games, otherRow, otherCol] = np.where(vertical, Link.UP, Link.LEFT)
+	def resolveCascade(self, mask):
+		"""drops and clears the masked boards until none of them change, returns viruses cleared per board"""
+		virusesCleared = np.zeros(self.numGames, dtype = np.int32)
+		games = np.nonzero(mask)[0]
+		if not len(games):
+			return virusesCleared
+		# work on a compact copy of just the boards that need resolving
+		colour = self.colour[games]
+		link = self.link[games]
+		virus = self.virus[games]
+		virusesCleared[games] = resolveCascade(colour, link, virus)
+		self.colour[games] = colour
+		self.link[games] = link
+		self.virus[games] = virus
+		return virusesCleared
+	def step(self, actions = None, timeDelta = TICK_MS):
+		"""applies one action per board and advances every live game by one logic tick
+
+		returns the viruses cleared on each board"""
+		live = ~self.gameOver
+		if actions is not None:
+			actions = np.asarray(actions)
+			self.moveLeft(live & (actions == Action.LEFT))
+			self.moveRight(live & (actions == Action.RIGHT))
+			self.rotate(live & (actions == Action.ROTATE))
+			self.moveDown(live & (actions == Action.DOWN))
+			self.hardDrop(live & (actions == Action.HARD_DROP))
+		# apply gravity, settling and resolving the pills that are blocked
+		blocked = self.applyGravity(live, timeDelta)
+		self.settle(blocked)
+		virusesCleared = self.resolveCascade(blocked)
+		self.virusCount -= virusesCleared.astype(self.virusCount.dtype)
+		# boards without viruses are won, the rest get a new pill
+		won = blocked & (self.virusCount < 1)
+		self.won |= won
+		self.gameOver |= won
+		self.spawnPills(blocked & ~won)
+		return virusesCleared
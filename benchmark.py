@@ -0,0 +1,304 @@
+"""
+Benchmarks for the Dr Mario rules engine and renderer.
+
+Every benchmark runs on fixed seeds and fixed board fill levels (an empty
+board, one half full and one a couple of rows from game over), on the list
+board and the bitboard. Results go to a JSON file; given a baseline from an
+earlier run, any benchmark that got slower than the tolerance is reported
+and the exit code is 1, so CI can catch regressions. Rendering runs under
+the SDL dummy video driver, so no display is needed.
+
+	python benchmark.py --output results.json
+	python benchmark.py --output new.json --compare results.json --tolerance 0.25
+
+# @Author: V.K. Prinsen
+
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+
+from engine import (BOARD_ROWS, BOARD_COLS, START_ROW, START_COL, MATCH_COUNT, TICK_MS, EMPTY, COLOUR_MASK, Colour, Action,
+	Orientation, Board, Pill, GameState, makeCell, resolveCascade)
+from bitboard import BitBoard, copyBoard
+
+# fraction of the rows, from the bottom, packed with viruses and pills
+FILL_LEVELS = {"empty": 0.0, "half": 0.5, "nearGameOver": 0.85}
+BOARD_CLASSES = {"list": Board, "bit": BitBoard}
+SEED = 0
+# widths of the half-full list boards the scaling benchmarks run on
+SCALING_COLS = (8, 64, 256, 1024)
+
+def filledBoard(fill, boardClass = Board, seed = SEED, rows = BOARD_ROWS, cols = BOARD_COLS):
+	"""a settled board with its bottom rows packed with viruses, loose halves and horizontal pills, and no matches"""
+	rng = random.Random(seed)
+	board = Board(rows, cols)
+	def colourFor(row, col):
+		# filling bottom up and left to right, only runs to the left and below can reach MATCH_COUNT
+		colours = [colour.value for colour in Colour]
+		for (rowStep, colStep) in ((0, -1), (1, 0)):
+			run = [board.get(row + rowStep * i, col + colStep * i) & COLOUR_MASK
+				for i in range(1, MATCH_COUNT) if 0 <= col + colStep * i and row + rowStep * i < rows]
+			if len(run) == MATCH_COUNT - 1 and len(set(run)) == 1 and run[0] - 1 in colours:
+				colours.remove(run[0] - 1)
+		return rng.choice(colours)
+	for row in range(rows - 1, rows - 1 - round(rows * fill), -1):
+		col = 0
+		while col < cols:
+			kind = rng.random()
+			if kind < 0.4:
+				board.placeVirus(row, col, colourFor(row, col))
+				col += 1
+			elif kind < 0.7 and col + 1 < cols:
+				left = colourFor(row, col)
+				board.set(row, col, makeCell(left))
+				board.placePill(((row, col, left), (row, col + 1, colourFor(row, col + 1))))
+				col += 2
+			else:
+				board.set(row, col, makeCell(colourFor(row, col)))
+				col += 1
+	board.findMatches()
+	if boardClass is not Board:
+		board = copyBoard(board, boardClass)
+	return board
+
+def measure(function, minTime = 0.1, repeat = 5):
+	"""returns the best seconds per call of function over repeat runs of at least minTime each"""
+	number = 1
+	while (1):
+		start = time.perf_counter()
+		for _ in range(number):
+			function()
+		elapsed = time.perf_counter() - start
+		if elapsed >= minTime:
+			break
+		number *= 2 if elapsed == 0 else max(2, int(minTime / elapsed * 1.2))
+	best = elapsed / number
+	for _ in range(repeat - 1):
+		start = time.perf_counter()
+		for _ in range(number):
+			function()
+		best = min(best, (time.perf_counter() - start) / number)
+	return best
+
+# Benchmarks, each builds its own state and returns the function to time
+
+def benchFindMatchesFull(board):
+	board.incremental = False
+	return board.findMatches
+
+def benchFindMatchesIncremental(board):
+	# what matching costs after a pill locks: the two halves at the top of the stack were touched
+	row = next((row for row in range(0, board.rows) if board.get(row, 0) != EMPTY), board.rows) - 1
+	touched = {row * board.cols, row * board.cols + 1}
+	def findMatches():
+		board.touched = set(touched)
+		board.findMatches()
+	return findMatches
+
+def benchResolve(board):
+	# the board is settled, so a pass moves nothing; the list board's pass leaves every column settled,
+	# so each call marks them all unsettled again and scans the whole board, as before columns were tracked
+	columns = range(0, board.cols)
+	def resolve():
+		board.unsettled = set(columns)
+		board.resolve()
+	return resolve
+
+def benchResolveCascade(board):
+	# clearing the bottom row makes everything above it fall; the time includes copying the board
+	cells = board.toBytes()
+	boardClass = type(board)
+	def cascade():
+		copy = boardClass(board.rows, board.cols)
+		copy.loadBytes(cells)
+		for col in range(0, board.cols):
+			copy.splitFromPartner(board.rows - 1, col)
+			copy.set(board.rows - 1, col, EMPTY)
+		resolveCascade(copy)
+	return cascade
+
+def benchOneColumnCascade(board):
+	"""a loose half dropped onto one column's stack then taken off again, so only that column changes"""
+	for col in range(0, board.cols):
+		top = next((row for row in range(0, board.rows) if board.get(row, col) != EMPTY), board.rows)
+		if top < 2:
+			continue
+		# a colour that cannot match where the half lands
+		nearby = {board.get(top - 1, near) & COLOUR_MASK for near in (col - 1, col + 1) if 0 <= near < board.cols}
+		nearby.add(board.get(top, col) & COLOUR_MASK if top < board.rows else 0)
+		colours = [colour.value for colour in Colour if colour.value + 1 not in nearby]
+		if colours:
+			break
+	cell = makeCell(colours[0])
+	def cascade():
+		board.set(top - 2, col, cell)
+		resolveCascade(board)
+		board.set(top - 1, col, EMPTY)
+		resolveCascade(board)
+	return cascade
+
+def benchIsColliding(board):
+	isColliding = board.isColliding
+	positions = [(row, col) for row in range(-1, board.rows + 1) for col in range(-1, board.cols + 1)]
+	def collide():
+		for (row, col) in positions:
+			isColliding(row, col)
+	return collide
+
+def benchPillMove(move):
+	def bench(board):
+		pill = Pill(board, (0, 1), START_ROW, START_COL - 1, Orientation.HORIZONTAL)
+		def movePill():
+			pill.row, pill.col, pill.orient = START_ROW, START_COL - 1, Orientation.HORIZONTAL
+			move(pill)
+		return movePill
+	return bench
+
+def benchGameSteps(board, instantResolve):
+	"""random inputs on games starting from the fill board, restarting each game as it ends"""
+	cells = board.toBytes()
+	boardClass = type(board)
+	rng = random.Random(SEED)
+	actions = list(Action)
+	games = [0]
+	def newGame():
+		games[0] += 1
+		return GameState(boardClass = boardClass, rows = board.rows, cols = board.cols, instantResolve = instantResolve,
+			seed = SEED + games[0], startingBoard = cells)
+	state = [newGame()]
+	def step():
+		state[0].step(rng.choice(actions))
+		if state[0].gameOver:
+			state[0] = newGame()
+	return step
+
+def benchGameStart(board):
+	"""a new game from the fill board, up to its first tick"""
+	cells = board.toBytes()
+	boardClass = type(board)
+	def start():
+		GameState(boardClass = boardClass, rows = board.rows, cols = board.cols, seed = SEED, startingBoard = cells).tick()
+	return start
+
+ENGINE_BENCHMARKS = {
+	"findMatches.full": benchFindMatchesFull,
+	"findMatches.incremental": benchFindMatchesIncremental,
+	"resolve": benchResolve,
+	"resolveCascade": benchResolveCascade,
+	"isColliding.allCells": benchIsColliding,
+	"pill.rotate": benchPillMove(Pill.rotate),
+	"pill.moveLeft": benchPillMove(Pill.moveLeft),
+	"pill.moveRight": benchPillMove(Pill.moveRight),
+	"game.step": lambda board: benchGameSteps(board, False),
+	"game.step.instantResolve": lambda board: benchGameSteps(board, True),
+}
+
+# run on ever wider boards, to show what costs grow with the board rather than with what changed; starting a game
+# loads and scans the whole board, and the game steps include a restart every few pills
+SCALING_BENCHMARKS = {
+	"resolveCascade.oneColumn": benchOneColumnCascade,
+	"game.start": benchGameStart,
+	"game.step": lambda board: benchGameSteps(board, False),
+	"game.step.instantResolve": lambda board: benchGameSteps(board, True),
+}
+
+def renderBenchmarks(board):
+	"""(name, function) for a full redraw and a typical frame of the renderer, on the SDL dummy driver"""
+	os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+	import pygame as pg
+	import drmario
+	if pg.display.get_surface() is None:
+		pg.display.init()
+		pg.display.set_mode(drmario.SCREENRECT.size)
+	screen = pg.display.get_surface()
+	(background, icon) = drmario.loadGraphics()
+	newGame = lambda: GameState(boardClass = type(board), seed = SEED, startingBoard = board.toBytes())
+	renderer = drmario.BoardRenderer(newGame(), screen, background)
+	def fullFrame():
+		renderer.redrawAll()
+		pg.display.update(renderer.draw())
+	def frame():
+		# one logic tick, the virus animation and the dirty-cell redraw the game loop does every frame
+		renderer.state.step(Action.NONE)
+		if renderer.state.gameOver:
+			renderer.state = newGame()
+		renderer.update(TICK_MS)
+		pg.display.update(renderer.draw())
+	return (("render.fullFrame", fullFrame), ("render.frame", frame))
+
+def runBenchmarks(only = None, render = True, minTime = 0.1, repeat = 5, scaling = False):
+	"""returns a list of result dicts"""
+	results = []
+	def record(name, fill, boardName, secondsPerCall):
+		results.append({"name": name, "fill": fill, "board": boardName, "usPerCall": secondsPerCall * 1e6,
+			"callsPerSecond": 1 / secondsPerCall if secondsPerCall else None})
+		logging.info("%-28s %-13s %-5s %10.2f us %12.0f /s", name, fill, boardName, secondsPerCall * 1e6,
+			results[-1]["callsPerSecond"] or 0)
+	for (fill, fraction) in FILL_LEVELS.items():
+		for (boardName, boardClass) in BOARD_CLASSES.items():
+			for (name, bench) in ENGINE_BENCHMARKS.items():
+				if only and only not in name:
+					continue
+				function = bench(filledBoard(fraction, boardClass))
+				record(name, fill, boardName, measure(function, minTime, repeat))
+			if render and (not only or "render" in only):
+				for (name, function) in renderBenchmarks(filledBoard(fraction, boardClass)):
+					record(name, fill, boardName, measure(function, minTime, repeat))
+	if scaling:
+		for cols in SCALING_COLS:
+			for (name, bench) in SCALING_BENCHMARKS.items():
+				name = "scaling.%s.%dcols" % (name, cols)
+				if only and only not in name:
+					continue
+				function = bench(filledBoard(FILL_LEVELS["half"], Board, cols = cols))
+				record(name, "half", "list", measure(function, minTime, repeat))
+	return results
+
+def compareResults(results, baseline, tolerance):
+	"""returns the (result, baseline result) pairs that got slower by more than tolerance"""
+	key = lambda result: (result["name"], result["fill"], result["board"])
+	previous = {key(result): result for result in baseline["results"]}
+	regressions = []
+	for result in results:
+		old = previous.get(key(result))
+		if old and result["usPerCall"] > old["usPerCall"] * (1 + tolerance):
+			regressions.append((result, old))
+	return regressions
+
+if __name__ == "__main__":
+	logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+	parser = argparse.ArgumentParser(description = "Benchmark the Dr Mario engine and renderer")
+	parser.add_argument("--output", default = "benchmark.json", help = "JSON file to write the results to")
+	parser.add_argument("--compare", metavar = "BASELINE", help = "JSON results of an earlier run to check against")
+	parser.add_argument("--tolerance", type = float, default = 0.25, help = "slowdown allowed before a regression, 0.25 = 25%%")
+	parser.add_argument("--only", help = "run only the benchmarks whose name contains this")
+	parser.add_argument("--no-render", action = "store_true", help = "skip the renderer benchmarks")
+	parser.add_argument("--quick", action = "store_true", help = "shorter runs, for smoke tests")
+	parser.add_argument("--scaling", action = "store_true", help = "also time the engine on boards up to %d columns wide" %
+		SCALING_COLS[-1])
+	args = parser.parse_args()
+	(minTime, repeat) = (0.02, 2) if args.quick else (0.1, 5)
+	results = runBenchmarks(args.only, not args.no_render, minTime, repeat, args.scaling)
+	report = {
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+		"results": results,
+	}
+	with open(args.output, "w") as outputFile:
+		json.dump(report, outputFile, indent = 1)
+	logging.info("Wrote %d results to %s", len(results), args.output)
+	if args.compare:
+		with open(args.compare) as baselineFile:
+			regressions = compareResults(results, json.load(baselineFile), args.tolerance)
+		for (result, old) in regressions:
+			logging.warning("%s (%s, %s board) slowed from %.2f us to %.2f us", result["name"], result["fill"],
+				result["board"], old["usPerCall"], result["usPerCall"])
+		sys.exit(1 if regressions else 0)
@@ -0,0 +1,336 @@
+"""
+Bitboard backend for the Dr Mario board.
+
+Every plane of the board (occupancy, each colour, viruses and pill links) is
+a single Python int with one bit per cell, bit index row * cols + col. Collision
+is a mask test, gravity is a shift-and-compare per row and matches are a few
+shift/AND operations per colour. BitBoard implements the same interface as
+engine.Board, so it can be handed to GameState(boardClass = BitBoard).
+
+The planes pay off on whole-board work: matching is several times faster
+than the list board, and a cascade drops each row's pieces with one shift per
+distance fallen. Single-cell work does not: get(), set() and isColliding()
+shift or mask a board-sized int, so they are slower than indexing a list.
+toBytes() and loadBytes() convert a whole plane at a time through a digit
+string, so game steps come out about even with the list board, and the
+renderer, which reads every cell each frame, is somewhat slower.
+
+# @Author: V.K. Prinsen
+
+"""
+
+import random
+import logging
+
+from engine import (BOARD_ROWS, BOARD_COLS, MATCH_COUNT, EMPTY, VIRUS_FLAG, LINK_SHIFT, OCCUPIED_DIGITS,
+	Colour, Link, Action, Board, GameState, makeCell, cellColour, cellLink)
+
+def digitTable(test):
+	"""maps cell bytes to "1" where test(cell) holds and "0" elsewhere, to read a plane off toBytes() data"""
+	return bytes(ord("1") if cell != EMPTY and test(cell) else ord("0") for cell in range(0, 256))
+
+COLOUR_DIGITS = [digitTable(lambda cell, colour = colour: cellColour(cell) == colour) for colour in range(0, len(Colour))]
+VIRUS_DIGITS = digitTable(lambda cell: cell & VIRUS_FLAG)
+LINK_RIGHT_DIGITS = digitTable(lambda cell: cellLink(cell) == Link.RIGHT)
+LINK_DOWN_DIGITS = digitTable(lambda cell: cellLink(cell) == Link.DOWN)
+
+class BitBoard():
+	"""game board stored as one integer bitmask per plane"""
+	def __init__(self, rows = BOARD_ROWS, cols = BOARD_COLS):
+		self.rows = rows
+		self.cols = cols
+		self.size = rows * cols
+		self.fullMask = (1 << self.size) - 1
+		self.occupied = 0
+		self.colours = [0] * len(Colour)
+		self.virus = 0
+		# linkRight marks the left half of a horizontal pill, linkDown the top half of a vertical pill
+		self.linkRight = 0
+		self.linkDown = 0
+		# one mask per row, plus the cells a horizontal match of MATCH_COUNT can start from
+		self.rowMasks = [((1 << cols) - 1) << (row * cols) for row in range(0, rows)]
+		self.colMasks = [sum(1 << (row * cols + col) for row in range(0, rows)) for col in range(0, cols)]
+		startCols = sum(1 << col for col in range(0, max(cols - MATCH_COUNT + 1, 0)))
+		self.matchStartMask = sum(startCols << (row * cols) for row in range(0, rows))
+		# a plane written out as one "0"/"1" digit per cell, lowest bit first, less the all-"0" string, has
+		# each cell's bit in its own byte
+		self.digitsFormat = "0%db" % self.size
+		self.zeroDigits = int.from_bytes(b"0" * self.size, "little")
+	def get(self, row, col):
+		"""decodes the planes at row,col into an engine cell"""
+		index = row * self.cols + col
+		bit = 1 << index
+		if not self.occupied & bit:
+			return EMPTY
+		for colour in range(0, len(self.colours)):
+			if self.colours[colour] & bit:
+				break
+		link = Link.NONE
+		if self.linkRight & bit:
+			link = Link.RIGHT
+		elif col > 0 and self.linkRight & (bit >> 1):
+			link = Link.LEFT
+		elif self.linkDown & bit:
+			link = Link.DOWN
+		elif self.linkDown & (bit >> self.cols):
+			link = Link.UP
+		return makeCell(colour, bool(self.virus & bit), link)
+	def spread(self, plane):
+		"""the plane as an int with one byte per cell, 1 where its bit is set"""
+		return int.from_bytes(format(plane, self.digitsFormat)[::-1].encode(), "little") - self.zeroDigits
+	def toBytes(self):
+		"""one byte per engine cell, row by row, same as Board.toBytes
+
+		each plane is spread to a byte per cell and scaled by its part of the cell encoding; no two planes
+		set the same bits of a cell, so the sum is the cells"""
+		cells = 0
+		for (colour, plane) in enumerate(self.colours):
+			if plane:
+				cells += self.spread(plane) * (colour + 1)
+		planes = ((self.virus, VIRUS_FLAG), (self.linkRight, Link.RIGHT << LINK_SHIFT),
+			(self.linkRight << 1, Link.LEFT << LINK_SHIFT), (self.linkDown, Link.DOWN << LINK_SHIFT),
+			(self.linkDown << self.cols, Link.UP << LINK_SHIFT))
+		for (plane, value) in planes:
+			if plane:
+				cells += self.spread(plane) * value
+		return cells.to_bytes(self.size, "little")
+	def loadBytes(self, data):
+		"""replaces every cell from toBytes() data, reading each plane off the bytes in one pass"""
+		digits = lambda table: int(data.translate(table)[::-1], 2)
+		self.occupied = digits(OCCUPIED_DIGITS)
+		self.colours = [digits(table) for table in COLOUR_DIGITS]
+		self.virus = digits(VIRUS_DIGITS)
+		self.linkRight = digits(LINK_RIGHT_DIGITS)
+		self.linkDown = digits(LINK_DOWN_DIGITS)
+	def set(self, row, col, cell):
+		"""encodes an engine cell into the planes at row,col"""
+		index = row * self.cols + col
+		bit = 1 << index
+		keep = ~bit
+		self.occupied &= keep
+		self.virus &= keep
+		for colour in range(0, len(self.colours)):
+			self.colours[colour] &= keep
+		# drop any link touching this cell before applying the new one
+		self.linkRight &= ~(bit | (bit >> 1 if col > 0 else 0))
+		self.linkDown &= ~(bit | (bit >> self.cols))
+		if cell == EMPTY:
+			return
+		self.occupied |= bit
+		self.colours[cellColour(cell)] |= bit
+		if cell & VIRUS_FLAG:
+			self.virus |= bit
+		link = cellLink(cell)
+		if link == Link.RIGHT:
+			self.linkRight |= bit
+		elif link == Link.LEFT:
+			self.linkRight |= bit >> 1
+		elif link == Link.DOWN:
+			self.linkDown |= bit
+		elif link == Link.UP:
+			self.linkDown |= bit >> self.cols
+	def isColliding(self, row, col):
+		"""checks for pill collision at row,col; everything off the board collides"""
+		if row < 0 or row >= self.rows or col < 0 or col >= self.cols:
+			return True
+		return bool(self.occupied >> (row * self.cols + col) & 1)
+	def occupancy(self):
+		"""bitmask of the occupied cells, bit row * cols + col, as Board.occupancy"""
+		return self.occupied
+	def canFall(self, row, col):
+		return (row < self.rows - 1) and not self.occupied >> ((row + 1) * self.cols + col) & 1
+	def virusCount(self):
+		return bin(self.virus).count("1")
+	def placeVirus(self, row, col, colour):
+		self.set(row, col, makeCell(colour, virus = True))
+	def placePill(self, halves):
+		"""locks a pair of (row, col, colour) halves into the board as linked cells"""
+		(rowA, colA, colourA), (rowB, colB, colourB) = halves
+		if rowA == rowB:
+			linkA = Link.RIGHT if colA < colB else Link.LEFT
+		else:
+			linkA = Link.DOWN if rowA < rowB else Link.UP
+		self.set(rowA, colA, makeCell(colourA))
+		self.set(rowB, colB, makeCell(colourB))
+		# setting one half is enough, links are shared between both halves
+		self.set(rowA, colA, makeCell(colourA, link = linkA))
+	def splitFromPartner(self, row, col):
+		"""unlinks the half pill at row,col from its partner, if it has one"""
+		self.unlink(1 << (row * self.cols + col))
+	def unlink(self, mask):
+		"""drops every pill link touching a cell in mask"""
+		self.linkRight &= ~(mask | (mask >> 1))
+		self.linkDown &= ~(mask | (mask >> self.cols))
+	def canAnythingFall(self):
+		"""single shift-and-compare test for a loose half pill with an empty cell below it"""
+		cols = self.cols
+		freeBelow = ~(self.occupied >> cols) & (self.fullMask >> cols)
+		pills = self.occupied & ~self.virus
+		# halves of a horizontal pill need both cells below them free
+		blockedLeft = self.linkRight & ~(freeBelow & (freeBelow >> 1))
+		blocked = blockedLeft | (blockedLeft << 1)
+		return bool(pills & freeBelow & ~blocked)
+	def resolve(self):
+		"""moves every unsupported pill half down a single row, returns True if anything moved"""
+		cols = self.cols
+		continueResolving = False
+		for row in reversed(range(0, self.rows - 1)):
+			rowMask = self.rowMasks[row]
+			pills = self.occupied & ~self.virus & rowMask
+			if not pills:
+				continue
+			freeBelow = ~(self.occupied >> cols) & rowMask
+			falling = pills & freeBelow
+			# a horizontal pill only falls if both halves can
+			leftHalves = self.linkRight & rowMask
+			blockedLeft = leftHalves & ~(freeBelow & (freeBelow >> 1))
+			falling &= ~(blockedLeft | (blockedLeft << 1))
+			if not falling:
+				continue
+			# the top half of a vertical pill falls with its bottom half
+			falling |= (falling & (self.linkDown << cols)) >> cols
+			self.shiftDown(falling)
+			continueResolving = True
+		return continueResolving
+	def shiftDown(self, mask, rows = 1):
+		"""moves every plane's bits in mask down by a number of rows"""
+		shift = rows * self.cols
+		keep = ~mask
+		self.occupied = (self.occupied & keep) | ((self.occupied & mask) << shift)
+		self.virus = (self.virus & keep) | ((self.virus & mask) << shift)
+		self.linkRight = (self.linkRight & keep) | ((self.linkRight & mask) << shift)
+		self.linkDown = (self.linkDown & keep) | ((self.linkDown & mask) << shift)
+		for colour in range(0, len(self.colours)):
+			plane = self.colours[colour]
+			if plane & mask:
+				self.colours[colour] = (plane & keep) | ((plane & mask) << shift)
+	def landingRow(self, row, col):
+		"""lowest row a half at row,col can fall to, from the first occupied cell below it"""
+		below = self.occupied & self.colMasks[col] & ~((1 << ((row + 1) * self.cols)) - 1)
+		if not below:
+			return self.rows - 1
+		return ((below & -below).bit_length() - 1) // self.cols - 1
+	def dropAll(self):
+		"""drops every unsupported half and linked pair straight to its resting row
+
+		rows are settled bottom up; the pieces of one row sit in different columns and only land on rows
+		already settled, so they are gathered by how far they fall and moved with one shift per distance"""
+		cols = self.cols
+		fell = []
+		loose = self.occupied & ~self.virus
+		for row in reversed(range(0, self.rows - 1)):
+			# singles, left halves and vertical bottoms; right halves and tops move with their partner
+			pieces = loose & self.rowMasks[row] & ~self.linkDown & ~(self.linkRight << 1)
+			# only pieces with an empty cell below them can fall
+			pieces &= ~(self.occupied >> cols)
+			if not pieces:
+				continue
+			drops = {}
+			while pieces:
+				bit = pieces & -pieces
+				pieces ^= bit
+				col = (bit.bit_length() - 1) - row * cols
+				if self.linkRight & bit:
+					landing = min(self.landingRow(row, col), self.landingRow(row, col + 1))
+					if landing == row:
+						continue
+					drops[landing - row] = drops.get(landing - row, 0) | bit | (bit << 1)
+					fell.append((row, col, landing))
+					fell.append((row, col + 1, landing))
+					continue
+				landing = self.landingRow(row, col)
+				if landing == row:
+					continue
+				if self.linkDown & (bit >> cols):
+					drops[landing - row] = drops.get(landing - row, 0) | bit | (bit >> cols)
+					fell.append((row, col, landing))
+					fell.append((row - 1, col, landing - 1))
+				else:
+					drops[landing - row] = drops.get(landing - row, 0) | bit
+					fell.append((row, col, landing))
+			for (distance, mask) in drops.items():
+				self.shiftDown(mask, distance)
+			if drops:
+				loose = self.occupied & ~self.virus
+		return fell
+	def findMatchMask(self):
+		"""returns a mask of every cell in a horizontal/vertical run of MATCH_COUNT or more"""
+		cols = self.cols
+		matched = 0
+		for plane in self.colours:
+			vertical = plane
+			horizontal = plane & self.matchStartMask
+			for i in range(1, MATCH_COUNT):
+				vertical &= plane >> (i * cols)
+				horizontal &= plane >> i
+			for i in range(0, MATCH_COUNT):
+				matched |= (vertical << (i * cols)) | (horizontal << i)
+		return matched
+	def findMatches(self):
+		"""checks for horizontal/vertical colour matches"""
+		return self.maskToLocations(self.findMatchMask())
+	def maskToLocations(self, mask):
+		locations = set()
+		while mask:
+			lowest = mask & -mask
+			index = lowest.bit_length() - 1
+			locations.add(divmod(index, self.cols))
+			mask ^= lowest
+		return locations
+	def clearMask(self, mask):
+		"""empties every cell in mask and returns the number of viruses cleared"""
+		virusesCleared = bin(self.virus & mask).count("1")
+		self.unlink(mask)
+		keep = ~mask
+		self.occupied &= keep
+		self.virus &= keep
+		for colour in range(0, len(self.colours)):
+			self.colours[colour] &= keep
+		return virusesCleared
+	def clearMatches(self, matchedPillLocations):
+		"""empties the matched cells and returns the number of viruses cleared"""
+		mask = 0
+		for (row, col) in matchedPillLocations:
+			mask |= 1 << (row * self.cols + col)
+		return self.clearMask(mask)
+
+def copyBoard(source, boardClass):
+	"""builds a board of boardClass holding the same cells as source"""
+	board = boardClass(source.rows, source.cols)
+	for row in range(0, source.rows):
+		for col in range(0, source.cols):
+			cell = source.get(row, col)
+			if cell != EMPTY:
+				board.set(row, col, cell)
+	return board
+
+def sameCells(boardA, boardB):
+	return all(boardA.get(row, col) == boardB.get(row, col)
+		for row in range(0, boardA.rows) for col in range(0, boardA.cols))
+
+def crossCheck(numGames = 20, level = 10, seed = 0):
+	"""plays random games on the list board and checks every tick against a mirrored BitBoard"""
+	random.seed(seed)
+	ticks = 0
+	for game in range(0, numGames):
+		state = GameState(level)
+		while not state.gameOver:
+			mirror = copyBoard(state.board, BitBoard)
+			if not sameCells(state.board, mirror):
+				raise AssertionError("BitBoard does not round-trip the list board")
+			if sorted(state.board.findMatches()) != sorted(mirror.findMatches()):
+				raise AssertionError("findMatches differs at game %d tick %d" % (game, ticks))
+			listBoard = copyBoard(state.board, Board)
+			moved = listBoard.resolve()
+			if moved != mirror.canAnythingFall() or moved != mirror.resolve():
+				raise AssertionError("resolve differs at game %d tick %d" % (game, ticks))
+			if not sameCells(listBoard, mirror):
+				raise AssertionError("resolve moved different cells at game %d tick %d" % (game, ticks))
+			state.step(random.choice(list(Action)))
+			ticks += 1
+	logging.info("BitBoard matched the list board over %d games, %d ticks", numGames, ticks)
+	return ticks
+
+if __name__ == "__main__":
+	logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+	crossCheck()
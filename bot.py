@@ -0,0 +1,362 @@
+"""
+Placement search bot for Dr Mario.
+
+Pill.reachablePlacements() walks the real moveLeft/moveRight/rotate/moveDown
+rules from the falling pill, wall kicks included, remembering every visited
+(row, col, orientation) so no position is expanded twice, and returns each
+position the pill can lock in with the inputs that reach it. The bot locks
+the pill at every distinct placement on a copy of the board, resolves the
+cascade and scores the result, looking further ahead over the next pill
+(GameState.nextColours) and then the average over every colour pair.
+Resolved boards are Zobrist hashed into a transposition table, so a board
+reached by different placement orders is only searched once; each board's
+hash is updated from its parent's over just the cells the lock and cascade
+touched. ParallelBot
+spreads the root placements over a process pool and can stop at a time
+budget with the best placement found so far.
+
+	python bot.py --games 20 --level 5 --lookahead 2
+	python bot.py --games 20 --level 5 --lookahead 3 --workers 32 --budget 500
+
+# @Author: V.K. Prinsen
+
+"""
+
+import time
+import random
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor, wait
+
+from engine import (BOARD_ROWS, BOARD_COLS, START_ROW, START_COL, LEVEL, EMPTY, COLOUR_MASK, VIRUS_FLAG, Colour, Action,
+	MAX_SEED, Board, Pill, GameState, resolveCascade, parseSeed)
+
+# every pill colour pair, ignoring order, with its chance of being drawn
+COLOUR_PAIRS = [((first, second), (1 if first == second else 2) / len(Colour) ** 2)
+	for first in range(0, len(Colour)) for second in range(first, len(Colour))]
+
+# engine cells fit in 6 bits
+CELL_VALUES = 64
+
+# rows at the top of the board where a stack starts to threaten the spawn point
+DANGER_ROWS = 4
+
+WIN_SCORE = 1000000.0
+LOSS_SCORE = -1000000.0
+
+DEFAULT_WEIGHTS = {
+	"virus": 100.0,		# per virus cleared
+	"cleared": 2.0,		# per pill half cleared
+	"halves": -1.0,		# per pill half left on the board
+	"buried": -6.0,		# per half of another colour stacked on a virus
+	"neighbours": 3.0,	# per pair of touching cells of the same colour
+	"danger": -40.0,	# per cell in the top rows above the spawn point
+}
+
+# the table is dropped when it grows past this many boards
+MAX_TABLE_SIZE = 1 << 20
+
+class ZobristTable():
+	"""one random 64 bit key per (cell index, cell value); a board hashes to the XOR of its cells' keys"""
+	def __init__(self, size, seed = 0):
+		rng = random.Random(seed)
+		self.keys = [0 if value == EMPTY else rng.getrandbits(64) for index in range(0, size) for value in range(0, CELL_VALUES)]
+	def hash(self, cells):
+		keys = self.keys
+		value = 0
+		for (index, cell) in enumerate(cells):
+			if cell:
+				value ^= keys[index * CELL_VALUES + cell]
+		return value
+	def update(self, value, before, after, indices):
+		"""rehashes a board whose cells only changed at indices, from value, the hash of before"""
+		keys = self.keys
+		for index in indices:
+			value ^= keys[index * CELL_VALUES + before[index]] ^ keys[index * CELL_VALUES + after[index]]
+		return value
+
+def touchedCells(board, halves, chainSteps):
+	"""indices of every cell locking halves and resolving chainSteps can have changed: the halves, where
+	pieces fell from and to, and the cleared cells with their neighbours, whose links to them were cut"""
+	(rows, cols) = (board.rows, board.cols)
+	touched = {row * cols + col for (row, col, colour) in halves}
+	for chainStep in chainSteps:
+		for (row, col, landing) in chainStep.fell:
+			touched.add(row * cols + col)
+			touched.add(landing * cols + col)
+		for (row, col) in chainStep.cleared:
+			index = row * cols + col
+			touched.add(index)
+			if col > 0:
+				touched.add(index - 1)
+			if col < cols - 1:
+				touched.add(index + 1)
+			if row > 0:
+				touched.add(index - cols)
+			if row < rows - 1:
+				touched.add(index + cols)
+	return touched
+
+class Bot():
+	"""chooses where to lock each pill by searching placements lookahead pills deep"""
+	def __init__(self, lookahead = 2, weights = None, rows = BOARD_ROWS, cols = BOARD_COLS):
+		self.lookahead = lookahead
+		self.weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+		self.rows = rows
+		self.cols = cols
+		self.spawnCol = min(START_COL, cols - 1) - 1
+		self.zobrist = ZobristTable(rows * cols)
+		# (board hash, upcoming colours, depth) -> score
+		self.table = {}
+		self.tableHits = 0
+		self.nodes = 0
+	def placements(self, board, pill, boardHash = None):
+		"""returns (actions, board, virusesCleared, cellsCleared, boardHash) for every distinct placement of the
+		pill, with each board resolved after the pill locks"""
+		if boardHash is None:
+			boardHash = self.zobrist.hash(board.cells)
+		results = []
+		seen = set()
+		for ((row, col, orient, colours), path) in pill.reachablePlacements().items():
+			halves = Pill(board, colours, row, col, orient).halves()
+			# a pill of one colour locks the same cells either way round; keep the shorter path
+			if frozenset(halves) in seen:
+				continue
+			seen.add(frozenset(halves))
+			after = board.copy()
+			after.placePill(halves)
+			chainSteps = resolveCascade(after)
+			virusesCleared = sum(chainStep.virusesCleared for chainStep in chainSteps)
+			cellsCleared = sum(len(chainStep.cleared) for chainStep in chainSteps)
+			afterHash = self.zobrist.update(boardHash, board.cells, after.cells, touchedCells(board, halves, chainSteps))
+			results.append((path, after, virusesCleared, cellsCleared, afterHash))
+		self.nodes += len(results)
+		return results
+	def lockScore(self, after, virusesCleared, cellsCleared, virusCount):
+		"""returns the score for locking a pill and whether that ends the game"""
+		score = virusesCleared * self.weights["virus"] + cellsCleared * self.weights["cleared"]
+		if virusesCleared >= virusCount:
+			return score + WIN_SCORE, True
+		if after.isColliding(START_ROW, self.spawnCol) or after.isColliding(START_ROW, self.spawnCol + 1):
+			return score + LOSS_SCORE, True
+		return score, False
+	def bestPlacement(self, board, pill, upcoming, depth, virusCount, boardHash = None):
+		"""returns (score, actions) of the best placement of pill, searching depth pills deep"""
+		best = (LOSS_SCORE * 2, [])
+		for (path, after, virusesCleared, cellsCleared, afterHash) in self.placements(board, pill, boardHash):
+			(score, gameEnds) = self.lockScore(after, virusesCleared, cellsCleared, virusCount)
+			if not gameEnds:
+				score += self.futureScore(after, upcoming, depth - 1, virusCount - virusesCleared, afterHash)
+			if score > best[0]:
+				best = (score, path)
+		return best
+	def futureScore(self, board, upcoming, depth, virusCount, boardHash = None):
+		"""scores a resolved board, averaging over the colours of pills we cannot see yet"""
+		if depth <= 0:
+			return self.evaluate(board)
+		if boardHash is None:
+			boardHash = self.zobrist.hash(board.cells)
+		key = (boardHash, tuple(upcoming), depth)
+		if key in self.table:
+			self.tableHits += 1
+			return self.table[key]
+		if upcoming:
+			pill = Pill(board, upcoming[0], START_ROW, self.spawnCol)
+			score = self.bestPlacement(board, pill, upcoming[1:], depth, virusCount, boardHash)[0]
+		else:
+			score = 0
+			for (colours, chance) in COLOUR_PAIRS:
+				pill = Pill(board, colours, START_ROW, self.spawnCol)
+				score += chance * self.bestPlacement(board, pill, [], depth, virusCount, boardHash)[0]
+		if len(self.table) >= MAX_TABLE_SIZE:
+			self.table.clear()
+		self.table[key] = score
+		return score
+	def evaluate(self, board):
+		"""heuristic score of a resolved board"""
+		weights = self.weights
+		cells = board.cells
+		cols = self.cols
+		size = len(cells)
+		halves = buried = neighbours = danger = 0
+		for (index, cell) in enumerate(cells):
+			if cell == EMPTY:
+				continue
+			colour = cell & COLOUR_MASK
+			if cell & VIRUS_FLAG:
+				# everything of another colour between the virus and open space has to go first
+				above = index - cols
+				while above >= 0 and cells[above] != EMPTY:
+					if cells[above] & COLOUR_MASK != colour:
+						buried += 1
+					above -= cols
+			else:
+				halves += 1
+			if index % cols < cols - 1 and cells[index + 1] & COLOUR_MASK == colour:
+				neighbours += 1
+			if index + cols < size and cells[index + cols] & COLOUR_MASK == colour:
+				neighbours += 1
+		for row in range(0, min(DANGER_ROWS, self.rows)):
+			for col in range(max(self.spawnCol - 1, 0), min(self.spawnCol + 3, cols)):
+				if cells[row * cols + col] != EMPTY:
+					danger += DANGER_ROWS - row
+		return (halves * weights["halves"] + buried * weights["buried"] + neighbours * weights["neighbours"] +
+			danger * weights["danger"])
+	def rootPosition(self, state):
+		"""returns the falling pill on a list board of our own, whatever board class the game uses"""
+		board = loadBoard(state.board.toBytes(), state.board.rows, state.board.cols)
+		pill = state.pill.copy()
+		pill.board = board
+		return board, pill
+	def chooseActions(self, state):
+		"""returns the inputs that move the falling pill to the best placement found"""
+		if state.pill is None or state.gameOver:
+			return []
+		(board, pill) = self.rootPosition(state)
+		upcoming = [state.nextColours] if self.lookahead > 1 else []
+		return self.bestPlacement(board, pill, upcoming, self.lookahead, state.virusCount)[1]
+
+class ParallelBot(Bot):
+	"""searches the root placements on a pool of worker processes, within an optional time budget
+
+	workers get each resolved board as toBytes() data and keep a Bot, and its transposition table, of their own"""
+	def __init__(self, lookahead = 2, weights = None, rows = BOARD_ROWS, cols = BOARD_COLS, workers = None,
+			timeBudget = None):
+		Bot.__init__(self, lookahead, weights, rows, cols)
+		# seconds allowed per decision, None to always finish the search
+		self.timeBudget = timeBudget
+		self.timeouts = 0
+		# searches from earlier decisions that were already running when their budget ran out
+		self.busy = set()
+		self.executor = ProcessPoolExecutor(workers, initializer = startSearchWorker,
+			initargs = (lookahead, self.weights, rows, cols))
+	def chooseActions(self, state):
+		"""returns the inputs to the best placement found, or the best found so far when the budget runs out"""
+		if state.pill is None or state.gameOver:
+			return []
+		start = time.perf_counter()
+		(board, pill) = self.rootPosition(state)
+		upcoming = [state.nextColours] if self.lookahead > 1 else []
+		# running searches cannot be cancelled, so new ones would only queue behind them; let them finish
+		# within this budget, and if they do not, score every placement by its guess rather than pile on more work
+		if self.busy:
+			(finished, self.busy) = wait(self.busy, self.remainingTime(start))
+			self.countTableHits(finished)
+		# placements that end the game are scored exactly here, the rest go to the workers; until they
+		# report back, each of those counts as the lock score plus how good its board looks right now
+		best = (LOSS_SCORE * 2, [])
+		searches = []
+		for (path, after, virusesCleared, cellsCleared, afterHash) in self.placements(board, pill):
+			(score, gameEnds) = self.lockScore(after, virusesCleared, cellsCleared, state.virusCount)
+			if gameEnds or self.lookahead <= 1:
+				score += 0 if gameEnds else self.evaluate(after)
+				best = max(best, (score, path), key = lambda value: value[0])
+				continue
+			searches.append((score + self.evaluate(after), score, path, after, state.virusCount - virusesCleared))
+		jobs = [None] * len(searches)
+		if not self.busy and self.remainingTime(start) != 0:
+			# the most promising placements first, so they are the ones searched when the budget is short
+			for index in sorted(range(0, len(searches)), key = lambda index: searches[index][0], reverse = True):
+				(guess, score, path, after, virusCount) = searches[index]
+				jobs[index] = self.executor.submit(searchFromBoard, after.toBytes(), upcoming, self.lookahead - 1,
+					virusCount)
+		submitted = [job for job in jobs if job]
+		(done, notDone) = wait(submitted, self.remainingTime(start)) if submitted else (set(), set())
+		if notDone or len(submitted) < len(searches):
+			self.timeouts += 1
+		self.countTableHits(done)
+		# combined in placement order, so ties go the same way as in Bot
+		for (job, (guess, score, path, after, virusCount)) in zip(jobs, searches):
+			if job in done:
+				score += job.result()[0]
+			else:
+				if job and not job.cancel():
+					self.busy.add(job)
+				score = guess
+			best = max(best, (score, path), key = lambda value: value[0])
+		return best[1]
+	def remainingTime(self, start):
+		if self.timeBudget is None:
+			return None
+		return max(self.timeBudget - (time.perf_counter() - start), 0)
+	def countTableHits(self, jobs):
+		"""adds the transposition table hits the workers made on finished searches"""
+		for job in jobs:
+			if not job.cancelled() and job.exception() is None:
+				self.tableHits += job.result()[1]
+	def close(self):
+		self.executor.shutdown(cancel_futures = True)
+	def __enter__(self):
+		return self
+	def __exit__(self, *exc):
+		self.close()
+
+def loadBoard(data, rows, cols):
+	"""builds a list board from toBytes() data of a resolved board"""
+	board = Board(rows, cols)
+	board.loadBytes(data)
+	# nothing on a resolved board matches, so start incremental matching afresh
+	board.findMatches()
+	return board
+
+# Search worker processes
+
+searchBot = None
+
+def startSearchWorker(lookahead, weights, rows, cols):
+	global searchBot
+	searchBot = Bot(lookahead, weights, rows, cols)
+
+def searchFromBoard(data, upcoming, depth, virusCount):
+	"""scores a resolved board sent over as toBytes() data, returns (score, table hits during the search)"""
+	hits = searchBot.tableHits
+	score = searchBot.futureScore(loadBoard(data, searchBot.rows, searchBot.cols), upcoming, depth, virusCount)
+	return score, searchBot.tableHits - hits
+
+def playGame(state, bot, maxPills = None):
+	"""lets the bot play a game to the end, returns the finished state and the seconds taken per decision"""
+	decisionTimes = []
+	while not state.gameOver and (maxPills is None or state.pillsUsed <= maxPills):
+		if state.pill is not None and not state.resolveNeeded:
+			start = time.perf_counter()
+			actions = bot.chooseActions(state)
+			decisionTimes.append(time.perf_counter() - start)
+			for action in actions:
+				state.applyAction(action)
+			state.applyAction(Action.HARD_DROP)
+		state.tick()
+	return state, decisionTimes
+
+if __name__ == "__main__":
+	logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+	parser = argparse.ArgumentParser(description = "Let the Dr Mario bot play headless games")
+	parser.add_argument("--games", type = int, default = 10, help = "number of games to play")
+	parser.add_argument("--level", type = int, default = LEVEL, help = "virus level")
+	parser.add_argument("--lookahead", type = int, default = 2, help = "pills to search ahead, including the current one")
+	parser.add_argument("--seed", type = parseSeed, default = 0, help = "seed of the first game, the rest follow consecutively")
+	parser.add_argument("--workers", type = int, help = "search on this many worker processes")
+	parser.add_argument("--budget", type = int, help = "milliseconds allowed per decision with --workers")
+	parser.add_argument("--rows", type = int, default = BOARD_ROWS, help = "board height")
+	parser.add_argument("--cols", type = int, default = BOARD_COLS, help = "board width")
+	args = parser.parse_args()
+	if args.seed + args.games > MAX_SEED:
+		parser.error("--seed leaves no room for %d consecutive seeds" % args.games)
+	if args.workers:
+		bot = ParallelBot(args.lookahead, rows = args.rows, cols = args.cols, workers = args.workers,
+			timeBudget = args.budget and args.budget / 1000)
+	else:
+		bot = Bot(args.lookahead, rows = args.rows, cols = args.cols)
+	wins = 0
+	allTimes = []
+	for game in range(0, args.games):
+		(state, decisionTimes) = playGame(GameState(args.level, rows = args.rows, cols = args.cols, instantResolve = True,
+			seed = args.seed + game), bot)
+		wins += state.won
+		allTimes += decisionTimes
+		logging.info("Game %d: %s after %d pills, %d viruses left", game, "won" if state.won else "lost", state.pillsUsed,
+			state.virusCount)
+	logging.info("Won %d of %d games, %.1f ms mean and %.1f ms worst per decision, %d table hits", wins, args.games,
+		1000 * sum(allTimes) / max(len(allTimes), 1), 1000 * max(allTimes, default = 0), bot.tableHits)
+	if args.workers:
+		logging.info("%d decisions ran out of time", bot.timeouts)
+		bot.close()
@@ -0,0 +1,182 @@
+"""
+Frame capture for Dr Mario gameplay videos.
+
+The game loop hands capture() the screen and the rects it just updated. The
+pixels under those rects are copied with pg.image.tobytes and queued for a
+writer thread, which patches them onto its own copy of the screen. The writer
+then saves each frame as a PNG or appends it to one raw RGB stream, so encoding
+never runs on the game loop. The queue is bounded. When it is full the frame
+is not grabbed; its rects are kept and merged into the next frame that fits,
+and the writer repeats the previous frame in its place, so the video keeps the
+game's timing and the loop never waits on the disk.
+
+Recorded games can also be rendered headless, far faster than real time,
+under the SDL dummy video driver:
+
+	python capture.py game.drr --output frames --fps 30
+	ffmpeg -framerate 30 -i frames/frame-%06d.png DrMario.gif
+
+# @Author: V.K. Prinsen
+
+"""
+
+import os
+import queue
+import shutil
+import logging
+import argparse
+import threading
+
+import pygame as pg
+
+FORMATS = ("png", "raw")
+RAW_NAME = "frames.rgb"
+# frames waiting for the writer before new ones are merged instead
+QUEUE_FRAMES = 32
+# this many rects waiting to be grabbed are replaced by one grab of the whole screen
+MAX_RECTS = 64
+
+class FrameCapture():
+	"""copies updated screen rects each frame and writes the frames on a background thread"""
+	def __init__(self, directory, size, frameRate, format = "png", queueFrames = QUEUE_FRAMES, dropFrames = True):
+		if format not in FORMATS:
+			raise ValueError("Unknown capture format %s" % format)
+		os.makedirs(directory, exist_ok = True)
+		self.directory = directory
+		self.size = tuple(size)
+		self.frameRate = frameRate
+		self.format = format
+		# without dropping, a full queue makes capture() wait for the writer instead
+		self.dropFrames = dropFrames
+		self.queue = queue.Queue(queueFrames)
+		# rects updated since the last frame that was queued; the first frame grabs the whole screen
+		self.pending = [pg.Rect((0, 0), self.size)]
+		self.frames = 0
+		self.merged = 0
+		self.surface = None
+		self.thread = threading.Thread(target = self.write, name = "FrameCapture", daemon = True)
+		self.thread.start()
+	def damage(self, rects):
+		"""notes rects updated between frames, to be grabbed with the next frame"""
+		self.pending.extend(rects)
+	def capture(self, surface, rects = None, frame = None):
+		"""queues frame (by default the one after the last) from the rects of surface updated since the
+		last frame, or all of it; returns False if the writer is behind and the frame was merged into the next"""
+		frame = self.frames if frame is None else frame
+		self.frames = frame + 1
+		self.surface = surface
+		self.pending.extend(rects if rects is not None else [surface.get_rect()])
+		if self.dropFrames and self.queue.full():
+			self.merged += 1
+			return False
+		self.queueFrame(surface, frame)
+		return True
+	def queueFrame(self, surface, frame):
+		bounds = surface.get_rect()
+		if len(self.pending) > MAX_RECTS:
+			self.pending = [bounds]
+		patches = []
+		for rect in self.pending:
+			rect = bounds.clip(rect)
+			if rect.width and rect.height:
+				patches.append((tuple(rect), pg.image.tobytes(surface.subsurface(rect), "RGB")))
+		# the game loop is the only producer, so this only waits when not dropping frames
+		self.queue.put((frame, patches))
+		self.pending = []
+	def write(self):
+		"""the writer thread: applies each frame's patches to its copy of the screen and saves it"""
+		canvas = pg.Surface(self.size, 0, 24)
+		rawFile = open(os.path.join(self.directory, RAW_NAME), "wb") if self.format == "raw" else None
+		(written, lastFrame) = (None, None)
+		try:
+			while (1):
+				item = self.queue.get()
+				if item is None:
+					break
+				(frame, patches) = item
+				# frames merged away repeat the one before them
+				if written is not None:
+					for repeated in range(written + 1, frame):
+						if rawFile:
+							rawFile.write(lastFrame)
+						else:
+							shutil.copyfile(self.framePath(written), self.framePath(repeated))
+				for (rect, data) in patches:
+					canvas.blit(pg.image.frombytes(data, rect[2:], "RGB"), rect[:2])
+				if rawFile:
+					lastFrame = pg.image.tobytes(canvas, "RGB")
+					rawFile.write(lastFrame)
+				else:
+					pg.image.save(canvas, self.framePath(frame))
+				written = frame
+		finally:
+			if rawFile:
+				rawFile.close()
+	def framePath(self, frame):
+		return os.path.join(self.directory, "frame-%06d.png" % frame)
+	def close(self):
+		"""waits for the writer to finish every queued frame"""
+		# the last frame may have been merged, with nothing after it to carry its rects
+		if self.merged and self.surface and self.pending:
+			self.queueFrame(self.surface, self.frames - 1)
+		self.queue.put(None)
+		self.thread.join()
+		logging.info("Captured %d frames to %s, %d merged while the writer was behind", self.frames, self.directory,
+			self.merged)
+		if self.format == "raw":
+			logging.info("Encode with: ffmpeg -f rawvideo -pix_fmt rgb24 -s %dx%d -framerate %d -i %s out.gif",
+				self.size[0], self.size[1], self.frameRate, os.path.join(self.directory, RAW_NAME))
+
+def renderReplay(replay, directory, frameRate = 30, format = "png"):
+	"""renders a recorded game to frames headless, as fast as they can be drawn, returns the frame count"""
+	os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+	import drmario
+	from engine import GameState
+	if pg.display.get_surface() is None:
+		pg.display.init()
+		pg.display.set_mode(drmario.SCREENRECT.size)
+	screen = pg.display.get_surface()
+	(background, icon) = drmario.loadGraphics()
+	screen.blit(background, (0, 0))
+	state = GameState(replay.level, rows = replay.rows, cols = replay.cols, instantResolve = replay.instantResolve,
+		seed = replay.seed)
+	renderer = drmario.BoardRenderer(state, screen, background)
+	capture = FrameCapture(directory, screen.get_size(), frameRate, format, dropFrames = False)
+	tickTime = 1000 / replay.logicRate
+	frameTime = 1000 / frameRate
+	inputs = replay.inputs
+	nextInput = 0
+	# the game's clock in ms, run forward in logic ticks with a frame drawn whenever one is due
+	(tick, frame) = (0, 0)
+	try:
+		while (1):
+			frameDue = frame * frameTime
+			while tick < replay.ticks and tick * tickTime < frameDue:
+				while nextInput < len(inputs) and inputs[nextInput][0] == tick:
+					state.applyAction(inputs[nextInput][1])
+					nextInput += 1
+				state.tick(tickTime)
+				tick += 1
+			if tick >= replay.ticks:
+				for (inputTick, action) in inputs[nextInput:]:
+					state.applyAction(action)
+			renderer.update(frameTime)
+			capture.capture(screen, renderer.draw(), frame)
+			frame += 1
+			if tick >= replay.ticks:
+				break
+	finally:
+		capture.close()
+	return frame
+
+if __name__ == "__main__":
+	logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+	parser = argparse.ArgumentParser(description = "Render a Dr Mario replay to video frames, headless")
+	parser.add_argument("replay", help = "replay file saved with drmario.py --record")
+	parser.add_argument("--output", default = "frames", help = "directory to write the frames to")
+	parser.add_argument("--fps", type = int, default = 30, help = "frames per second of game time")
+	parser.add_argument("--format", choices = FORMATS, default = "png", help = "a PNG per frame or one raw RGB stream")
+	args = parser.parse_args()
+	from replay import loadReplay
+	renderReplay(loadReplay(args.replay), args.output, args.fps, args.format)
+	pg.quit()
@@ -0,0 +1,63 @@
+"""
+Held-key auto-repeat for Dr Mario input.
+
+Moves fire the moment a key goes down. Left and right then wait the delayed
+auto shift (DAS) and repeat every auto repeat rate (ARR) milliseconds while
+held, and down repeats at the soft drop rate, all on the caller's clock
+rather than once per frame. The game loop asks nextRepeat() how long it may
+sleep and due(now) which repeats to apply, so repeats land on time whatever
+the frame rate.
+
+# @Author: V.K. Prinsen
+
+"""
+
+from engine import Action
+
+# milliseconds before a held left/right starts repeating, and between repeats
+DAS_MS = 160
+ARR_MS = 50
+# soft drop has no delay, it repeats every SOFT_DROP_MS from the press
+SOFT_DROP_DELAY_MS = 0
+SOFT_DROP_MS = 33
+
+class AutoRepeat():
+	"""tracks held moves and when each one fires next"""
+	def __init__(self, delay = DAS_MS, repeat = ARR_MS, softDropDelay = SOFT_DROP_DELAY_MS, softDropRepeat = SOFT_DROP_MS):
+		# (delay, repeat) per repeating action; rotate fires once per press
+		self.rates = {
+			Action.LEFT: (delay, repeat),
+			Action.RIGHT: (delay, repeat),
+			Action.DOWN: (softDropDelay, softDropRepeat),
+		}
+		# action -> time it fires next
+		self.held = {}
+	def press(self, action, now):
+		"""a key went down at now, returns the action to apply straight away"""
+		if action in self.rates:
+			# the last of left and right pressed wins, like the NES pad
+			if action == Action.LEFT:
+				self.held.pop(Action.RIGHT, None)
+			elif action == Action.RIGHT:
+				self.held.pop(Action.LEFT, None)
+			(delay, repeat) = self.rates[action]
+			self.held[action] = now + (delay if delay > 0 else max(repeat, 1))
+		return action
+	def release(self, action):
+		self.held.pop(action, None)
+	def releaseAll(self):
+		self.held.clear()
+	def nextRepeat(self):
+		"""time of the next repeat, None if nothing is held"""
+		return min(self.held.values(), default = None)
+	def due(self, now):
+		"""returns the actions of every repeat due by now, oldest first"""
+		fired = []
+		for (action, fireTime) in self.held.items():
+			repeat = max(self.rates[action][1], 1)
+			while fireTime <= now:
+				fired.append((fireTime, action))
+				fireTime += repeat
+			self.held[action] = fireTime
+		fired.sort()
+		return [action for (fireTime, action) in fired]
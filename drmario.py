@@ -15,13 +15,23 @@ Dr Mario (Pygame)
 
 """
 
-import random
 import os
-from enum import Enum
+import struct
+import hashlib
+import argparse
 
 # import basic pygame modules
 import pygame as pg
 
+# import the game rules
+from replay import ReplayRecorder
+from bot import Bot
+from profiler import PHASES, FrameProfiler
+from controls import DAS_MS, ARR_MS, AutoRepeat
+from capture import FORMATS, FrameCapture
+from engine import (BOARD_ROWS, BOARD_COLS, LEVEL, LOGIC_RATE, EMPTY, VIRUS_FLAG, Colour, Orientation, Link, Action, GameState,
+	makeCell, cellColour, cellIsVirus, cellLink, parseSeed)
+
 # setup logging
 import logging
 logging.basicConfig(format='%(levelname)s:%(message)s', encoding='utf-8', level=logging.INFO)
@@ -39,36 +49,26 @@ MOVEINCREMENT = 16
 FRAME_RATE = 30
 PILLSIZE = pg.Rect(0, 0, 16, 32) 
 HALFPILLSIZE = pg.Rect(0, 0, 16, 16)
-BOARD_ROWS = 16
-BOARD_COLS = 8
+OVERLAYRECT = pg.Rect(4, 4, 220, 16 * (len(PHASES) + 3) + 8)
 PLAYABLERECT = pg.Rect(96 * SPRITERATIO, 80 * SPRITERATIO, BOARD_COLS * 16, BOARD_ROWS * 16) #pg.Rect(96 * SPRITERATIO, 80 * SPRITERATIO, 64 * SPRITERATIO, 128 * SPRITERATIO)
-START_ROW = 0
-START_COL = 4
-MATCH_COUNT = 4
 
 # timers
 VIRUS_ANIM_TIMER = 100
-PILL_GRAVITY_TIMER = 1000
+OVERLAY_TIMER = 500	# ms between refreshes of the performance overlay
+MAX_CATCHUP_TICKS = 5	# logic ticks run per frame at most before dropping the backlog
 
 # temporary constants (should be configurable)
 GAMESPEED = 1000
-LEVEL = 0
-
-# generate the game board
-gameBoard = [[None for j in range(BOARD_COLS)] for i in range(BOARD_ROWS)]
 
 main_dir = os.path.split(os.path.abspath(__file__))[0]
 
-# Enums
-
-class Colour(Enum):
-	RED = 0
-	YELLOW = 1
-	BLUE = 2
-
-class Orientation(Enum):
-	VERTICAL = 0
-	HORIZONTAL = 1
+# prepared sprites are cached as raw pixels, keyed by a hash of the sprite sheets they came from
+SPRITESHEETS = ("NES - Dr Mario - Characters.png", "NES - Dr Mario - Fields.png")
+ATLAS_FOLDER = os.path.join(os.path.expanduser("~"), ".cache", "drmario")
+ATLAS_MAGIC = b"DRMA"
+ATLAS_VERSION = 1
+# name length, width, height of each atlas entry, followed by the name and the RGB pixels
+ATLAS_ENTRY = struct.Struct("<BHH")
 
 # Shared functions
 
@@ -87,314 +87,211 @@ def load_image_from_spritesheet(spritesheet, rect):
 	image.blit(spritesheet, (0, 0), rect)
 	return image
 
-def printGameBoard( mode = "simple" ):
+def buildHalfPillImages(pillImages, linkedPillImages):
+	"""renders every colour and partner side of a half pill once, shared by every half pill the renderer draws"""
+	images = {}
+	for colour in Colour:
+		looseImage = pg.transform.scale(pillImages[colour.value], (14, 14))
+		# the linked sprite is flat along its left edge, turn that edge towards the partner and butt it up against it
+		linkedImage = pg.transform.scale(linkedPillImages[colour.value], (14, 14))
+		variants = {
+			Link.NONE: (looseImage, (1,1)),
+			Link.LEFT: (linkedImage, (0,1)),
+			Link.RIGHT: (pg.transform.flip(linkedImage, True, False), (2,1)),
+			Link.UP: (pg.transform.rotate(linkedImage, -90), (1,0)),
+			Link.DOWN: (pg.transform.rotate(linkedImage, 90), (1,2)),
+		}
+		for (link, (image, offset)) in variants.items():
+			halfPillImage = pg.Surface(HALFPILLSIZE.size).convert()
+			halfPillImage.blit(image, offset)
+			images[(colour, link)] = halfPillImage
+	return images
+
+def buildAtlas():
+	"""decodes the sprite sheets and returns {name: surface} of every scaled image the game draws"""
+	gamesprites = load_image("NES - Dr Mario - Characters.png")
+
+	# Pill images
+	pillImages = []
+	linkedPillImages = []
+	for y_pos in (0, 8, 16):
+		pillImages.append(load_image_from_spritesheet(gamesprites, pg.Rect(y_pos, 40, 7, 7)))
+		linkedPillImages.append(load_image_from_spritesheet(gamesprites, pg.Rect(y_pos, 32, 7, 7)))
+	halfPillImages = buildHalfPillImages(pillImages, linkedPillImages)
+
+	# Virus images
+	redVirusImages = []
+	for x_pos in (88, 96):
+		redVirusImages.append(load_image_from_spritesheet(gamesprites, pg.Rect(0, x_pos, 7, 7)))
+	yellowVirusImages = []
+	for x_pos in (112, 120):
+		yellowVirusImages.append(load_image_from_spritesheet(gamesprites, pg.Rect(0, x_pos, 7, 7)))
+	blueVirusImages = []
+	for x_pos in (136, 144):
+		blueVirusImages.append(load_image_from_spritesheet(gamesprites, pg.Rect(0, x_pos, 7, 7)))
+	virusImages = {
+		Colour.RED: [pg.transform.scale(img, (14, 14)) for img in redVirusImages],
+		Colour.YELLOW: [pg.transform.scale(img, (14, 14)) for img in yellowVirusImages],
+		Colour.BLUE: [pg.transform.scale(img, (14, 14)) for img in blueVirusImages],
+	}
+
+	# load the background from the sprite sheet
+	bgdfields = load_image("NES - Dr Mario - Fields.png")
+	background = pg.Surface(NESRECT.size)
+	background.blit(bgdfields, (0,0), (0, 0, NESRECT.width, NESRECT.height))
+	background = pg.transform.scale(background, SCREENRECT.size)
+
+	# name every prepared surface, so the atlas can be cached and read back
+	atlas = {"background": background, "icon": pg.transform.scale(blueVirusImages[1], (32, 32))}
+	for ((colour, link), image) in halfPillImages.items():
+		atlas["pill.%s.%s" % (colour.name, link.name)] = image
+	for (colour, frames) in virusImages.items():
+		for (frame, image) in enumerate(frames):
+			atlas["virus.%s.%d" % (colour.name, frame)] = image
+	return atlas
+
+def atlasPath():
+	"""where the atlas for the current sprite sheets is cached"""
+	digest = hashlib.blake2b(bytes((ATLAS_VERSION,)), digest_size = 16)
+	for file in SPRITESHEETS:
+		with open(os.path.join(main_dir, DATAFOLDER, file), "rb") as spriteFile:
+			digest.update(spriteFile.read())
+	return os.path.join(ATLAS_FOLDER, "atlas-%s.bin" % digest.hexdigest())
+
+def saveAtlas(path, atlas):
+	data = bytearray(ATLAS_MAGIC)
+	for (name, surface) in atlas.items():
+		data += ATLAS_ENTRY.pack(len(name), *surface.get_size()) + name.encode()
+		data += pg.image.tobytes(surface, "RGB")
+	os.makedirs(os.path.dirname(path), exist_ok = True)
+	# write then rename, so a concurrent launch never reads half a file
+	with open(path + ".tmp%d" % os.getpid(), "wb") as atlasFile:
+		atlasFile.write(data)
+	os.replace(path + ".tmp%d" % os.getpid(), path)
+
+def loadAtlas(path):
+	"""reads a cached atlas back into display-format surfaces"""
+	with open(path, "rb") as atlasFile:
+		data = memoryview(atlasFile.read())
+	if bytes(data[:len(ATLAS_MAGIC)]) != ATLAS_MAGIC:
+		raise ValueError("%s is not a sprite atlas" % path)
+	atlas = {}
+	offset = len(ATLAS_MAGIC)
+	while offset < len(data):
+		(nameLength, width, height) = ATLAS_ENTRY.unpack_from(data, offset)
+		offset += ATLAS_ENTRY.size
+		name = bytes(data[offset:offset + nameLength]).decode()
+		offset += nameLength
+		size = width * height * 3
+		atlas[name] = pg.image.frombuffer(data[offset:offset + size], (width, height), "RGB").convert()
+		offset += size
+	return atlas
+
+def loadGraphics():
+	"""loads the sprites into BoardRenderer, returns the scaled background and the window icon
+
+	the prepared surfaces come from the cached atlas when there is one, otherwise the atlas is built and cached"""
+	path = atlasPath()
+	try:
+		atlas = loadAtlas(path)
+	except (OSError, ValueError, struct.error):
+		atlas = buildAtlas()
+		try:
+			saveAtlas(path, atlas)
+		except OSError as error:
+			logging.warning("Could not cache the sprite atlas: %s", error)
+	BoardRenderer.halfPillImages = {(colour, link): atlas["pill.%s.%s" % (colour.name, link.name)]
+		for colour in Colour for link in Link}
+	BoardRenderer.virusImages = {colour: [atlas["virus.%s.%d" % (colour.name, frame)] for frame in (0, 1)]
+		for colour in Colour}
+	return atlas["background"], atlas["icon"]
+
+def printGameBoard( board, mode = "simple" ):
 	print('-------------------')
 	if mode == "objects":
-		for row in range(0,BOARD_ROWS):
-			print(gameBoard[row])
+		for row in range(0,board.rows):
+			print([board.get(row, col) for col in range(0,board.cols)])
 	if mode == "simple":
-		for row in range(0,BOARD_ROWS):
-			for col in range(0,BOARD_COLS):
+		for row in range(0,board.rows):
+			for col in range(0,board.cols):
+				cell = board.get(row, col)
 				output = '0'
-				if type(gameBoard[row][col]) is HalfPill:
-					output = 'P'
-				if type(gameBoard[row][col]) is Virus:
-					output = 'V'
+				if cell != EMPTY:
+					output = 'V' if cellIsVirus(cell) else 'P'
 				print(output, end = ' ')
 			print()
 	print('-------------------')
 
-def isColliding(row, col):
-	"""checks for pill collision at row,col""" 
-	if gameBoard[row][col] != None:
-		return True
-	return False
-
-def resolveGameBoard():
-	"""checks for any pills that should fall after a clear"""
-	continueResolving = False
-	for row in reversed(range(0,BOARD_ROWS)):
-		for col in reversed(range(0,BOARD_COLS)):
-			if gameBoard[row][col] != None and type(gameBoard[row][col]) is HalfPill:
-				# space containing a pill half
-				pillHalf = gameBoard[row][col]
-				pillPartner = pillHalf.partner
-				if pillPartner == None:
-					gameBoard[row][col] = None
-					if pillHalf.canFall(): 
-						pillHalf.applyGravity()
-						continueResolving = True
-					gameBoard[pillHalf.row][pillHalf.col] = pillHalf
-				else:
-					if pillHalf.canFall() and (pillPartner.col == pillHalf.col or pillPartner.canFall()):
-						# nullify existing positions
-						gameBoard[row][col] = None
-						gameBoard[pillPartner.row][pillPartner.col] = None
-						# move down
-						pillHalf.applyGravity()
-						pillPartner.applyGravity()
-						# resolve again next frame
-						continueResolving = True
-					gameBoard[pillHalf.row][pillHalf.col] = pillHalf
-					gameBoard[pillPartner.row][pillPartner.col] = pillPartner
-	return continueResolving
-
-def findMatches():
-	"""checks for horizontal/vertical colour matches"""
-	matchedPillLocations = []
-	for row in range(0,BOARD_ROWS):
-		for col in range(0,BOARD_COLS):
-			if gameBoard[row][col] != None:
-				# space containing a pill half
-				matchColour = gameBoard[row][col].colour
-				i = 0
-				# continue until we hit the bottom of the board or a non-matching space
-				while row+i < BOARD_ROWS and gameBoard[row+i][col] != None and gameBoard[row+i][col].colour == matchColour:
-					i += 1
-				# check if we matched a long-enough string of pills 
-				if (i >= MATCH_COUNT):
-					logging.info("Vertical match starting at %d,%d", row, col)
-					for m in range(0,i):
-						if ((row+m,col) not in matchedPillLocations):
-							matchedPillLocations.append((row+m,col))                
-				i = 0
-				# continue until we hit the side of the board or a non-matching space
-				while col+i < BOARD_COLS and gameBoard[row][col+i] != None and gameBoard[row][col+i].colour == matchColour:
-					i += 1
-				# check if we matched a long-enough string of pills 
-				if (i >= MATCH_COUNT):
-					logging.info("Horizontal match starting at %d,%d", row, col)
-					for m in range(0,i):
-						if ((row,col+m) not in matchedPillLocations):
-							matchedPillLocations.append((row,col+m))      
-	return matchedPillLocations    
+def drawOverlay(screen, font, profiler):
+	"""draws the rolling frame percentiles over the top-left of the screen, returns the rect to update"""
+	screen.fill((0, 0, 0), OVERLAYRECT)
+	rows = [("ms", "p50", "p95", "p99")]
+	for (phase, figures) in profiler.percentiles().items():
+		rows.append((phase,) + tuple("%.1f" % value for value in figures))
+	for (number, row) in enumerate(rows):
+		for (column, text) in enumerate(row):
+			x = OVERLAYRECT.x + 4 + (0 if column == 0 else 20 + column * 48)
+			screen.blit(font.render(text, False, (255, 255, 255)), (x, OVERLAYRECT.y + 4 + number * 16))
+	return OVERLAYRECT
 
 # Classes
 
-class Virus(pg.sprite.Sprite):   
-	def __init__(self, virusEligibleRect):
-		pg.sprite.Sprite.__init__(self, self.containers)
-		self.frame = 1
-		self.animcycle = 2
+class BoardRenderer():
+	"""draws a GameState cell by cell, redrawing only the cells that changed since the last frame"""
+	def __init__(self, state, screen, background):
+		self.state = state
+		self.screen = screen
+		self.background = background
+		board = state.board
+		self.cellRects = [pg.Rect(PLAYABLERECT.x + col * 16, PLAYABLERECT.y + row * 16, 16, 16)
+			for row in range(0, board.rows) for col in range(0, board.cols)]
+		# what each cell showed when last drawn, None forces a redraw
+		self.drawn = [None] * (board.rows * board.cols)
 		self.animTimer = 0
-		self.colour = random.choice(list(Colour))
-		if (self.colour == Colour.RED):
-			self.image = self.redVirusImages[self.frame // self.animcycle % 2]
-		elif (self.colour == Colour.YELLOW):
-			self.image = self.yellowVirusImages[self.frame // self.animcycle % 2]
-		elif (self.colour == Colour.BLUE):
-			self.image = self.blueVirusImages[self.frame // self.animcycle % 2]
-		else:
-			logging.error("Virus init returned an invalid colour")
-
-		# spawn virus on the board
-		while (1):
-			row = random.randint(virusEligibleRect.x, virusEligibleRect.x + virusEligibleRect.height - 1) 
-			col = random.randint(0,virusEligibleRect.width - 1)
-			if gameBoard[row][col] == None:
-				gameBoard[row][col] = self
-				break;
-		
-		self.rect = self.image.get_rect()
-		self.rect.top = PLAYABLERECT.y + (row * 16)
-		self.rect.left = PLAYABLERECT.x + (col * 16)
-
+		self.animFrame = 1
+		self.dirtyCount = 0
+	def redrawAll(self):
+		self.drawn = [None] * len(self.drawn)
 	def update(self, timeDelta):
-		# animate virus sprites
+		# all viruses animate together, so frames in between have nothing to redraw
 		self.animTimer += timeDelta
 		if (self.animTimer > VIRUS_ANIM_TIMER):
 			self.animTimer = 0
-			self.frame += 1
-			self.animcycle = 2
-			if (self.colour == Colour.RED):
-				self.image = self.redVirusImages[self.frame // self.animcycle % 2]
-			elif (self.colour == Colour.YELLOW):
-				self.image = self.yellowVirusImages[self.frame // self.animcycle % 2]
-			elif (self.colour == Colour.BLUE):
-				self.image = self.blueVirusImages[self.frame // self.animcycle % 2]
-			else:
-				logging.error("Virus update returned an invalid colour")
-
-class Pill():
-	"""a pill is composed of two HalfPills and contains most player control logic"""
-	def __init__(self):
-		self.orient = Orientation.HORIZONTAL
-		self.one = HalfPill(self.orient)
-		self.two = HalfPill(self.orient, self.one)
-		self.one.setPartner(self.two)
-		self.gravityTimer = 0
-	def moveLeft(self):
-		"""check for collision on the left and move the pill halves"""
-		if (self.orient == Orientation.VERTICAL):
-			if (self.one.col > 0 and not isColliding(self.one.row,self.one.col-1) and not isColliding(self.two.row,self.two.col-1)):
-				self.one.moveLeft()
-				self.two.moveLeft()
-				return True
-			return False
-		elif (self.orient == Orientation.HORIZONTAL):
-			leftHalf = self.getLeftHalf()
-			if (leftHalf != None and leftHalf.col > 0 and not isColliding(leftHalf.row,leftHalf.col-1)):
-				self.one.moveLeft()
-				self.two.moveLeft()
-				return True
-			return False
-	def getLeftHalf(self):
-		if self.orient == Orientation.VERTICAL:
-			logging.error("Called getRightHalf but pill is in vertical orientation!")
-			return None
-		return self.one if (self.one.col < self.two.col) else self.two
-	def moveRight(self):
-		"""check for collision on the right and move the pill halves"""
-		if (self.orient == Orientation.VERTICAL):
-			if (self.one.col < BOARD_COLS - 1 and not isColliding(self.one.row,self.one.col+1) and not isColliding(self.two.row,self.two.col+1)):
-				self.one.moveRight()
-				self.two.moveRight()
-				return True
-				self.one.moveRight()
-				self.two.moveRight()
-				return True
-			return False
-		elif (self.orient == Orientation.HORIZONTAL):
-			rightHalf = self.getRightHalf()
-			if (rightHalf != None and rightHalf.col < BOARD_COLS - 1 and not isColliding(rightHalf.row,rightHalf.col+1)):
-				self.one.moveRight()
-				self.two.moveRight()
-				return True
-			return False
-	def getRightHalf(self):
-		if (self.orient == Orientation.VERTICAL):
-			logging.error("Called getRightHalf but pill is in vertical orientation!")
-			return None
-		return self.one if (self.one.col > self.two.col) else self.two
-	def moveDown(self):
-		if (self.applyGravity(timeDelta = 0, userInput = True) == False):
-			# if we hit something, set the timer so gravity triggers next frame 
-			self.applyGravity(PILL_GRAVITY_TIMER)
-	def applyGravity(self, timeDelta, userInput = False):
-		self.gravityTimer += timeDelta
-		if (self.gravityTimer > PILL_GRAVITY_TIMER or userInput):
-			self.gravityTimer = 0
-			"""check for collision below and move the pill halves"""
-			if (self.orient == Orientation.VERTICAL):
-				bottomHalf = self.getBottomHalf()
-				if (bottomHalf and bottomHalf.canFall()):
-					self.one.applyGravity()
-					self.two.applyGravity()
-					return True
-				return False
-			elif (self.orient == Orientation.HORIZONTAL):
-				if (self.one.canFall() and self.two.canFall()):
-					self.one.applyGravity()
-					self.two.applyGravity()
-					return True
-				return False
-	def getTopHalf(self):
-		if (self.orient == Orientation.HORIZONTAL):
-			logging.error("Called getTopHalf but pill is in horizontal orientation!")
-			return None
-		return self.one if (self.one.row < self.two.row) else self.two 
-	def getBottomHalf(self):
-		if (self.orient == Orientation.HORIZONTAL):
-			logging.error("Called getBottomHalf but pill is in horizontal orientation!")
-			return None
-		return self.one if (self.one.row > self.two.row) else self.two
-	def settle(self, currentBoard):
-		"""called when the pill can't fall any further and must lock in place"""
-		currentBoard.add(self.one)
-		currentBoard.add(self.two)
-		self.one.settle()
-		self.two.settle()
-	def rotate(self):
-		"""rotate the pill 90 degrees"""
-		if (self.orient == Orientation.HORIZONTAL):
-			rightHalf = self.getRightHalf()
-			"""allow rotation in the other direction in certain cases"""
-			if (rightHalf.row-1 < 0) or isColliding(rightHalf.row-1, rightHalf.col-1):
-				if not isColliding(rightHalf.row+1, rightHalf.col-1):
-					rightHalf.setPosition(rightHalf.row+1,rightHalf.col-1)
-					self.one.flipOrientation()
-					self.two.flipOrientation()
-					self.orient = Orientation.VERTICAL
-					return True				
-			elif not isColliding(rightHalf.row-1, rightHalf.col-1):
-				"""right-hand side rotates up"""
-				rightHalf.setPosition(rightHalf.row-1,rightHalf.col-1)
-				self.one.flipOrientation()
-				self.two.flipOrientation()
-				self.orient = Orientation.VERTICAL
-				return True
-			return False
-		else:
-			topHalf = self.getTopHalf()
-			bottomHalf = self.getBottomHalf()
-			"""allow rotation in the other direction in certain cases"""
-			if (bottomHalf.col+1 == BOARD_COLS) or isColliding(bottomHalf.row,bottomHalf.col+1):
-				if not isColliding(bottomHalf.row, bottomHalf.col-1):
-					topHalf.setPosition(bottomHalf.row, bottomHalf.col-1)
-					bottomHalf.setPosition(bottomHalf.row, bottomHalf.col)
-					self.one.flipOrientation()
-					self.two.flipOrientation()
-					self.orient = Orientation.HORIZONTAL
-					return True
-			elif not isColliding(bottomHalf.row,bottomHalf.col+1):
-				"""rotate counterclockwise into the bottom half's row"""
-				topHalf.setPosition(bottomHalf.row, bottomHalf.col)
-				bottomHalf.setPosition(bottomHalf.row, bottomHalf.col+1)
-				self.one.flipOrientation()
-				self.two.flipOrientation()
-				self.orient = Orientation.HORIZONTAL
-				return True
-			return False
-	def isColliding(self):
-		"""check if the pill is colliding with anything in its current position"""
-		return isColliding(self.one.row, self.one.col) or isColliding(self.two.row, self.two.col)
-
-class HalfPill(pg.sprite.Sprite):
-	def __init__(self, pillOrientation, partner = None):
-		pg.sprite.Sprite.__init__(self, self.containers)
-		self.partner = partner
-		self.orient = pillOrientation
-		self.colour = random.choice(list(Colour))
-		self.image = self.buildPill() 
-		self.rect = self.image.get_rect()
-		self.row = START_ROW if (self.partner == None or self.orient == Orientation.HORIZONTAL) else START_ROW + 1
-		self.col = START_COL if (self.partner == None or self.orient == Orientation.VERTICAL) else START_COL - 1
-	def splitFromPartner(self):
-		if (self.partner != None):
-			self.partner.partner = None
-			self.partner = None
-	def setPartner(self, partnerHalf):
-		self.partner = partnerHalf
-	def setPosition(self, row, col):
-		self.row = row
-		self.col = col
-	def flipOrientation(self):
-		self.orient = Orientation.VERTICAL if (self.orient == Orientation.HORIZONTAL) else Orientation.HORIZONTAL
-	def update(self, timeDelta):
-		self.image = self.buildPill()
-		self.rect.top = (self.row * 16) + PLAYABLERECT.y 
-		self.rect.left = (self.col * 16) + PLAYABLERECT.x
-	def buildPill(self):
-		halfPillImage = pg.Surface(HALFPILLSIZE.size)
-		halfPillImage.blit(self.images[self.colour.value], (1,1))
-		halfPillImage.blit(pg.transform.flip(self.images[self.colour.value], flip_x=False, flip_y=True), (1,15))
-		return halfPillImage
-	def moveLeft(self):
-		self.col -= 1
-	def moveRight(self):
-		self.col += 1
-	def applyGravity(self, updateGameBoard = False):
-		self.row += 1
-	def settle(self):
-		"""called when the pill can't fall any further and must lock in place"""
-		gameBoard[self.row][self.col] = self
-	def print_position(self):
-		logging.debug("Position: (%d,%d)", self.row, self.col)
-	def canFall(self):
-		return (self.row < BOARD_ROWS - 1) and not isColliding(self.row+1,self.col)
-
-
-def main(winstyle=0):
+			self.animFrame += 1
+	def cellKeys(self):
+		"""what every cell should show: its board cell, the virus animation frame or the falling pill"""
+		board = self.state.board
+		virusFrame = (self.animFrame // 2 % 2) << 8
+		keys = [cell | virusFrame if cell & VIRUS_FLAG else cell for cell in board.toBytes()]
+		pill = self.state.pill
+		if pill and not self.state.gameOver:
+			links = (Link.RIGHT, Link.LEFT) if pill.orient == Orientation.HORIZONTAL else (Link.DOWN, Link.UP)
+			for ((row, col, colour), link) in zip(pill.halves(), links):
+				keys[row * board.cols + col] = makeCell(colour, link = link)
+		return keys
+	def image(self, key):
+		colour = Colour(cellColour(key))
+		if key & VIRUS_FLAG:
+			return self.virusImages[colour][key >> 8]
+		return self.halfPillImages[(colour, Link(cellLink(key & 0xff)))]
+	def draw(self):
+		"""blits the changed cells and returns their rects"""
+		dirty = []
+		for (index, key) in enumerate(self.cellKeys()):
+			if key == self.drawn[index]:
+				continue
+			rect = self.cellRects[index]
+			self.screen.blit(self.background, rect, rect)
+			if key != EMPTY:
+				self.screen.blit(self.image(key), rect)
+			self.drawn[index] = key
+			dirty.append(rect)
+		self.dirtyCount = len(dirty)
+		return dirty
+
+
+def main(winstyle=0, frameRate=FRAME_RATE, logicRate=LOGIC_RATE, seed=None, recordPath=None, lookahead=0, statsPath=None,
+		das=DAS_MS, arr=ARR_MS, capturePath=None, captureFormat="png"):
 	# Initialize pygame
 	if pg.get_sdl_version()[0] == 2:
 		pg.mixer.pre_init(44100, 32, 2, 1024)
@@ -409,41 +306,14 @@ def main(winstyle=0):
 	bestdepth = pg.display.mode_ok(SCREENRECT.size, winstyle, 32)
 	screen = pg.display.set_mode(SCREENRECT.size, winstyle, bestdepth)
 
-	# Load images, assign to sprite classes
-	gamesprites = load_image("NES - Dr Mario - Characters.png")
-
-	# Pill images
-	pillImages = []
-	for y_pos in (0, 8, 16):
-		pillImages.append(load_image_from_spritesheet(gamesprites, pg.Rect(y_pos, 40, 7, 7)))
-	HalfPill.images = [pg.transform.scale(pillImage, (14, 14)) for pillImage in pillImages]
-
-	# Virus images
-	redVirusImages = []
-	for x_pos in (88, 96):
-		redVirusImages.append(load_image_from_spritesheet(gamesprites, pg.Rect(0, x_pos, 7, 7)))
-	yellowVirusImages = []
-	for x_pos in (112, 120):
-		yellowVirusImages.append(load_image_from_spritesheet(gamesprites, pg.Rect(0, x_pos, 7, 7)))
-	blueVirusImages = []
-	for x_pos in (136, 144):
-		blueVirusImages.append(load_image_from_spritesheet(gamesprites, pg.Rect(0, x_pos, 7, 7)))
-	Virus.redVirusImages = [pg.transform.scale(img, (14, 14)) for img in redVirusImages]
-	Virus.yellowVirusImages = [pg.transform.scale(img, (14, 14)) for img in yellowVirusImages]
-	Virus.blueVirusImages = [pg.transform.scale(img, (14, 14)) for img in blueVirusImages]
+	# Load images, assign to the renderer
+	(background, icon) = loadGraphics()
 
 	# decorate the game window
-	icon = pg.transform.scale(blueVirusImages[1], (32, 32))
 	pg.display.set_icon(icon)
 	pg.display.set_caption("Pygame: Dr. Mario 2021")
 	pg.mouse.set_visible(0)
 
-	# load the background from the sprite sheet
-	bgdfields = load_image("NES - Dr Mario - Fields.png")
-	background = pg.Surface(NESRECT.size)
-	background.blit(bgdfields, (0,0), (0, 0, NESRECT.width, NESRECT.height))
-	background = pg.transform.scale(background, SCREENRECT.size)
-
 	# debug playable areas
 	# virusEligibleRect = copy.copy(PLAYABLERECT)
 	# virusEligibleRect.top += (BOARD_ROWS / 2) * 8  
@@ -455,152 +325,204 @@ def main(winstyle=0):
 	screen.blit(background, (0, 0))
 	pg.display.flip()
 
-	# Initialize Game Groups
-	currentBoard = pg.sprite.Group()
-	all = pg.sprite.RenderUpdates()
-
-	# assign default groups to each sprite class
-	Virus.containers = all
-	HalfPill.containers = all
-
 	# Initialize starting values
 	clock = pg.time.Clock()
+
+	# start a new game, spawning viruses and our first pill
+	logging.info("Starting game at level %d", LEVEL)
+	state = GameState(LEVEL, seed = seed)
+	logging.info("Game seed is %d", state.seed)
+	renderer = BoardRenderer(state, screen, background)
+	# every input and tick goes through the recorder, so any game can be saved as a replay
+	game = ReplayRecorder(state, logicRate)
 	pause = False
-	gameOver = False
-	resolveNeeded = False
-
-	# spawn some viruses on the board
-	numViruses = min(4 + (LEVEL * 4), 84)
-	logging.info("Spawning %d viruses at level %d", numViruses, LEVEL)
-	rowsToUse = min(6 + round(LEVEL / 3), 13) 
-	logging.info("Using %d rows at level %d", rowsToUse, LEVEL)
-	virusEligibleRect = pg.Rect(BOARD_ROWS - rowsToUse,0,8,rowsToUse)   
-	[currentBoard.add(Virus(virusEligibleRect)) for x in range(0,numViruses)]
-
-	# spawn our first pill
-	currentPill = Pill()
-
-	# start game loop
-	while (1):
-		# frame init
-		matchedPillLocations = []
-
-		# get time delta since last tick
-		dt = clock.get_time()
-
-		# get input
-		for event in pg.event.get():
-			if event.type == pg.QUIT:
-				return
-			if event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE:
-				return
-			elif event.type == pg.KEYDOWN:
-				if event.key == pg.K_f:
-					if not fullscreen:
-						print("Changing to FULLSCREEN")
-						screen_backup = screen.copy()
-						screen = pg.display.set_mode(
-							SCREENRECT.size, winstyle | pg.FULLSCREEN, bestdepth
-						)
-						screen.blit(screen_backup, (0, 0))
-					else:
-						print("Changing to windowed mode")
-						screen_backup = screen.copy()
-						screen = pg.display.set_mode(
-							SCREENRECT.size, winstyle, bestdepth
-						)
-						screen.blit(screen_backup, (0, 0))
-					pg.display.flip()
-					fullscreen = not fullscreen
-				if event.key == pg.K_p:
-					pause = not pause
-				if event.key == pg.K_d:
-					printGameBoard()	# for debug
-				if not pause and not resolveNeeded:
-					if event.key == pg.K_LEFT:
-					   currentPill.moveLeft()
-					if event.key == pg.K_RIGHT:
-						currentPill.moveRight()
-					# if event.key == pg.K_DOWN:
-					#     currentPill.applyGravity()
-					if event.key == pg.K_SPACE:
-						currentPill.rotate()
-
-		if (pause):
-			continue
-
-		# get continuous keystrokes
-		keystate = pg.key.get_pressed()
-		if currentPill and keystate[pg.K_DOWN]:
-			currentPill.moveDown()
-
-		# apply gravity
-		if (currentPill and currentPill.applyGravity(dt) == False):
-			# add the current pill to the fixed board
-			currentPill.settle(currentBoard)
-			currentPill = None
-			# check for matches
-			matchedPillLocations = findMatches()
-			if (matchedPillLocations):
-				resolveNeeded = True
-
-		# nothing to resolve and no active pill
-		if not resolveNeeded and currentPill == None:
-			# spawn a new pill
-			currentPill = Pill()
-			# if our newly-spawned pill is colliding, the board is full and we lost
-			if currentPill.isColliding():
-				print("GAME OVER")
-				gameOver = True
-				break;
-			if numViruses < 1:
-				print("YOU WIN!")
-				gameOver = True
+	# with a lookahead the bot plays, one input per tick, replanning whenever an input fails
+	bot = Bot(lookahead) if lookahead else None
+	botPill = None
+	botActions = []
+	# frame phase timings, on while the overlay (O key) is shown or stats are being written
+	profiler = FrameProfiler(statsPath)
+	showOverlay = False
+	overlayTimer = 0
+	overlayFont = pg.font.Font(None, 20) if pg.font else None
+	# held moves repeat on their own clock; presses are applied, and drawn, as soon as they arrive
+	keys = AutoRepeat(das, arr)
+	keyActions = {pg.K_LEFT: Action.LEFT, pg.K_RIGHT: Action.RIGHT, pg.K_DOWN: Action.DOWN, pg.K_SPACE: Action.ROTATE}
+	# game logic runs in fixed ticks, independent of the frame rate
+	accumulator = 0
+	lastTime = pg.time.get_ticks()
+	frameTime = 1000 / frameRate
+	nextFrame = lastTime
+	lastFrame = lastTime
+	# frames are numbered by the time they are due, so frames the loop skips still take up time in the video
+	capture = FrameCapture(capturePath, screen.get_size(), frameRate, captureFormat) if capturePath else None
+	captureStart = lastTime
+
+	def applyInput(action):
+		if game.applyAction(action):
+			profiler.inputApplied()
+			return True
+		return False
+
+	try:
+		# start game loop, waking for each frame, input event or key repeat
+		profiler.startFrame()
+		while (1):
+			# get input, sleeping until the next event while paused
+			if pause:
+				events = [pg.event.wait()]
+			else:
+				# otherwise until an event, the next frame or the next key repeat, whichever comes first
+				timeout = int(min(nextFrame, keys.nextRepeat() or nextFrame) - pg.time.get_ticks())
+				# a timeout of 0 would wait forever
+				event = pg.event.wait(timeout) if timeout > 0 else pg.event.Event(pg.NOEVENT)
+				events = ([] if event.type == pg.NOEVENT else [event]) + pg.event.get()
+			profiler.skip()
+			now = pg.time.get_ticks()
+			inputApplied = False
+			for event in events:
+				if event.type == pg.QUIT:
+					return
+				if event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE:
+					return
+				elif event.type == pg.KEYUP and event.key in keyActions:
+					keys.release(keyActions[event.key])
+				elif event.type == pg.KEYDOWN:
+					if event.key == pg.K_f:
+						if not fullscreen:
+							print("Changing to FULLSCREEN")
+							screen_backup = screen.copy()
+							screen = pg.display.set_mode(
+								SCREENRECT.size, winstyle | pg.FULLSCREEN, bestdepth
+							)
+							screen.blit(screen_backup, (0, 0))
+						else:
+							print("Changing to windowed mode")
+							screen_backup = screen.copy()
+							screen = pg.display.set_mode(
+								SCREENRECT.size, winstyle, bestdepth
+							)
+							screen.blit(screen_backup, (0, 0))
+						pg.display.flip()
+						renderer.screen = screen
+						fullscreen = not fullscreen
+					if event.key == pg.K_p:
+						pause = not pause
+						keys.releaseAll()
+						# time spent paused never reaches the game logic
+						lastTime = nextFrame = pg.time.get_ticks()
+					if event.key == pg.K_d:
+						printGameBoard(state.board)	# for debug
+						print("Dirty rects last frame: %d" % renderer.dirtyCount)
+					if event.key == pg.K_o and overlayFont:
+						showOverlay = not showOverlay
+						if showOverlay or statsPath is not None:
+							profiler.enable()
+						else:
+							profiler.disable()
+						if not showOverlay:
+							screen.blit(background, OVERLAYRECT, OVERLAYRECT)
+							pg.display.update(OVERLAYRECT)
+							if capture:
+								capture.damage([OVERLAYRECT])
+					if not pause and event.key in keyActions:
+						inputApplied |= applyInput(keys.press(keyActions[event.key], now))
+
+			if (pause):
+				continue
+			# held keys that are due to repeat
+			for action in keys.due(now):
+				inputApplied |= applyInput(action)
+			profiler.mark("input")
+
+			# get time delta since last wake
+			dt = now - lastTime
+			lastTime = now
+
+			# advance the game rules in fixed ticks, dropping the backlog if we fall too far behind
+			accumulator += dt
+			ticks = 0
+			while accumulator >= game.tickTime and ticks < MAX_CATCHUP_TICKS:
+				if bot and state.pill and not state.resolveNeeded:
+					if botPill is not state.pill:
+						botPill = state.pill
+						botActions = bot.chooseActions(state) + [Action.HARD_DROP]
+					if botActions and not game.applyAction(botActions.pop(0)):
+						botActions = bot.chooseActions(state) + [Action.HARD_DROP]
+				profiler.mark("input")
+				(pill, resolving) = (state.pill, state.resolveNeeded)
+				game.tick()
+				# ticks that lock a pill, match or clear count towards resolve, the rest towards gravity
+				profiler.mark("resolve" if resolving or state.resolveNeeded or state.pill is not pill else "gravity")
+				accumulator -= game.tickTime
+				ticks += 1
+			if accumulator >= game.tickTime:
+				logging.debug("Dropping %d ms of game time", accumulator)
+				accumulator = 0
+
+			if (state.gameOver):
+				print("YOU WIN!" if state.won else "GAME OVER")
+				# TODO  game over handling
+				clock.tick(2000)
 				break
 
-		# game board is not resolved yet, let remaining pills settle 
-		# into new positions before spawning a new pill
-		if resolveNeeded:
-			# check if anything else can move
-			if not resolveGameBoard():
-				resolveNeeded = False
-				# check for matches
-				matchedPillLocations = findMatches()
-		
-		# clear matches
-		while (matchedPillLocations):
-			(row,col) = matchedPillLocations.pop()
-			item = gameBoard[row][col]
-			if type(item) is HalfPill:
-				item.splitFromPartner()
-			elif type(item) is Virus:
-				numViruses -= 1
-				if (numViruses < 0):
-					logging.error("Number of viruses < 0!")
-			item.kill()
-			gameBoard[row][col] = None
-			resolveNeeded = True
-			   
-		if (gameOver):
-			# TODO  game over handling
-			clock.tick(2000)
-			break
-
-		# clear/erase the last drawn sprites
-		all.clear(screen, background)
-
-		# update all the sprites
-		all.update(dt)
-
-		# draw the scene
-		dirty = all.draw(screen)
-		pg.display.update(dirty)
-
-		# cap the framerate 
-		clock.tick(FRAME_RATE)
+			if now < nextFrame:
+				if inputApplied:
+					# show a move straight away instead of waiting for the next frame
+					dirty = renderer.draw()
+					pg.display.update(dirty)
+					if capture:
+						capture.damage(dirty)
+					profiler.mark("draw")
+					profiler.displayed()
+				continue
+			# the next frame is due, or overdue if we fell behind
+			nextFrame = max(nextFrame + frameTime, now)
+
+			# animate the viruses
+			renderer.update(now - lastFrame)
+			lastFrame = now
+			profiler.mark("update")
+
+			# redraw only the cells that changed, and skip the display update on idle frames
+			dirty = renderer.draw()
+			if showOverlay:
+				overlayTimer += dt
+				if overlayTimer > OVERLAY_TIMER:
+					overlayTimer = 0
+					dirty.append(drawOverlay(screen, overlayFont, profiler))
+			profiler.mark("draw")
+			if dirty:
+				pg.display.update(dirty)
+			if capture:
+				capture.capture(screen, dirty, max(capture.frames, round((now - captureStart) / frameTime)))
+			profiler.mark("display")
+			profiler.displayed()
+			profiler.endFrame()
+			profiler.startFrame()
+	finally:
+		if capture:
+			capture.close()
+		if recordPath:
+			game.save(recordPath)
 
 
 # call the "main" function if running this script
 if __name__ == "__main__":
-	main()
+	parser = argparse.ArgumentParser(description = "Dr Mario (Pygame)")
+	parser.add_argument("--fps", type = int, default = FRAME_RATE, help = "frames drawn per second")
+	parser.add_argument("--logic-rate", type = int, default = LOGIC_RATE, help = "game logic ticks per second")
+	parser.add_argument("--seed", type = parseSeed, help = "seed for virus and pill colours, to replay a game")
+	parser.add_argument("--record", metavar = "FILE", help = "save a replay of the game to FILE")
+	parser.add_argument("--bot", type = int, default = 0, metavar = "LOOKAHEAD",
+		help = "let the bot play, searching LOOKAHEAD pills ahead")
+	parser.add_argument("--stats", metavar = "FILE", help = "append frame timing percentiles to FILE every few seconds")
+	parser.add_argument("--das", type = int, default = DAS_MS, help = "ms a held left/right waits before repeating")
+	parser.add_argument("--arr", type = int, default = ARR_MS, help = "ms between repeats of a held left/right")
+	parser.add_argument("--capture", metavar = "DIR", help = "write every frame to DIR, for gameplay videos")
+	parser.add_argument("--capture-format", choices = FORMATS, default = "png", help = "a PNG per frame or one raw RGB stream")
+	args = parser.parse_args()
+	main(frameRate = args.fps, logicRate = args.logic_rate, seed = args.seed, recordPath = args.record,
+		lookahead = args.bot, statsPath = args.stats, das = args.das, arr = args.arr, capturePath = args.capture,
+		captureFormat = args.capture_format)
 	pg.quit()
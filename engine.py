@@ -0,0 +1,866 @@
+"""
+Dr Mario game rules, free of any pygame dependency.
+
+The board, the falling pill, virus spawning, matching and gravity all live
+here so that games can be simulated headless. drmario.py renders on top of
+a GameState and feeds it player input.
+
+# @Author: V.K. Prinsen
+
+"""
+
+import random
+import struct
+import logging
+import hashlib
+from collections import deque, namedtuple
+from enum import Enum, IntEnum
+
+# board constants
+BOARD_ROWS = 16
+BOARD_COLS = 8
+START_ROW = 0
+START_COL = 4
+MATCH_COUNT = 4
+
+# timers
+PILL_GRAVITY_TIMER = 1000
+LOGIC_RATE = 30
+TICK_MS = 1000 // LOGIC_RATE
+
+# temporary constants (should be configurable)
+LEVEL = 0
+
+# game seeds are unsigned 64 bit values
+MAX_SEED = 1 << 64
+
+# cell encoding: 0 is an empty cell, otherwise bits 0-1 hold the colour + 1,
+# bit 2 flags a virus and bits 3-5 hold the direction of the partner half
+EMPTY = 0
+COLOUR_MASK = 3
+VIRUS_FLAG = 4
+LINK_SHIFT = 3
+# set on the cells of the falling pill in a GameState.view()
+PILL_FLAG = 64
+
+# Enums
+
+class Colour(Enum):
+	RED = 0
+	YELLOW = 1
+	BLUE = 2
+
+class Orientation(Enum):
+	VERTICAL = 0
+	HORIZONTAL = 1
+
+class Link(IntEnum):
+	NONE = 0
+	UP = 1
+	DOWN = 2
+	LEFT = 3
+	RIGHT = 4
+
+class Action(IntEnum):
+	NONE = 0
+	LEFT = 1
+	RIGHT = 2
+	ROTATE = 3
+	DOWN = 4
+	HARD_DROP = 5
+
+# (row, col) offset from a half pill to its partner, indexed by Link
+LINK_OFFSETS = ((0, 0), (-1, 0), (1, 0), (0, -1), (0, 1))
+
+# actions that move the falling pill through the transition tables, in the order searches try them
+MOVE_ACTIONS = (Action.LEFT, Action.RIGHT, Action.ROTATE, Action.DOWN)
+# maps cell bytes to "0" for empty and "1" for occupied, to read an occupancy bitmask off the board
+OCCUPIED_DIGITS = b"0" + b"1" * 255
+
+# everything in a GameState snapshot besides the board and rng: whether there is a falling pill, its
+# row, col, orientation, colours and gravity timer (and whether the timer is an int, which boardHash
+# tells apart), the next colours, resolveNeeded, gameOver, won, pillsUsed and virusCount
+SNAPSHOT_FORMAT = struct.Struct("<?hhBbbd?bb???Ih")
+
+# GameState.writeObservation() layout: a header of these (name, struct code) fields, padded to 24 bytes, then one
+# byte per cell for each of OBSERVATION_PLANES, row by row. The pill fields are -1 without a falling pill
+OBSERVATION_FIELDS = (("pillRow", "h"), ("pillCol", "h"), ("pillOrient", "b"), ("pillFirst", "b"), ("pillSecond", "b"),
+	("nextFirst", "b"), ("nextSecond", "b"), ("gameOver", "?"), ("won", "?"), ("virusCount", "H"), ("pillsUsed", "I"))
+OBSERVATION_HEADER = struct.Struct("<" + "".join(code for (name, code) in OBSERVATION_FIELDS) + "7x")
+# colour is 0 when empty or colour value + 1, virus 1 for viruses, link the Link of each half and pill the colour
+# value + 1 of the falling pill's halves
+OBSERVATION_PLANES = ("colour", "virus", "link", "pill")
+# cell -> plane byte, applied to a whole board with bytes.translate
+COLOUR_PLANE = bytes(cell & COLOUR_MASK for cell in range(0, 256))
+VIRUS_PLANE = bytes((cell & VIRUS_FLAG) >> 2 for cell in range(0, 256))
+LINK_PLANE = bytes(cell >> LINK_SHIFT & 7 for cell in range(0, 256))
+
+# an immutable copy of a GameState: board cells as toBytes() data, the packed SNAPSHOT_FORMAT fields
+# and the pill rng state
+Snapshot = namedtuple("Snapshot", ("board", "progress", "rngState"))
+
+# Cell helpers
+
+def parseSeed(text):
+	"""a game seed from the command line, rejecting what GameState would not take"""
+	seed = int(text)
+	if not 0 <= seed < MAX_SEED:
+		raise ValueError("seed outside 0 to %d" % (MAX_SEED - 1))
+	return seed
+
+def makeCell(colour, virus = False, link = Link.NONE):
+	"""encodes a colour value, virus flag and partner link into a cell"""
+	return (colour + 1) | (VIRUS_FLAG if virus else 0) | (link << LINK_SHIFT)
+
+def cellColour(cell):
+	"""returns the colour value of a cell, or -1 if empty"""
+	return (cell & COLOUR_MASK) - 1
+
+def cellIsVirus(cell):
+	return bool(cell & VIRUS_FLAG)
+
+def cellLink(cell):
+	return cell >> LINK_SHIFT
+
+def observationSize(rows, cols):
+	"""bytes written by GameState.writeObservation() for a board size"""
+	return OBSERVATION_HEADER.size + len(OBSERVATION_PLANES) * rows * cols
+
+def virusCountForLevel(level):
+	"""number of viruses spawned at a given level"""
+	return min(4 + (level * 4), 84)
+
+def virusRowsForLevel(level):
+	"""number of rows (counted from the bottom) viruses may spawn in"""
+	return min(6 + round(level / 3), 13)
+
+def virusPlacements(level, rng, rows = BOARD_ROWS, cols = BOARD_COLS):
+	"""picks a (row, col, colour) for every virus of a level, in the bottom rows of the board"""
+	numViruses = virusCountForLevel(level)
+	rowsToUse = virusRowsForLevel(level)
+	logging.debug("Spawning %d viruses in %d rows at level %d", numViruses, rowsToUse, level)
+	# sample the cells without replacement, rather than retrying until we hit an empty one
+	firstCell = max(rows - rowsToUse, 0) * cols
+	eligibleCells = rows * cols - firstCell
+	cells = rng.sample(range(firstCell, rows * cols), min(numViruses, eligibleCells))
+	colours = rng.choices(range(0, len(Colour)), k = len(cells))
+	return [(cell // cols, cell % cols, colour) for (cell, colour) in zip(cells, colours)]
+
+def resolveCascade(board):
+	"""drops and clears until the board stops changing, returns the list of ChainSteps taken"""
+	chainSteps = []
+	while (1):
+		fell = board.dropAll()
+		matchedPillLocations = board.findMatches()
+		if not fell and not matchedPillLocations:
+			break
+		virusesCleared = board.clearMatches(matchedPillLocations)
+		chainSteps.append(ChainStep(fell, matchedPillLocations, virusesCleared))
+		if not matchedPillLocations:
+			break
+	return chainSteps
+
+# Classes
+
+class ChainStep():
+	"""one link of a cascade: the halves that fell, then the cells that were cleared"""
+	def __init__(self, fell, cleared, virusesCleared):
+		# (row, col, landingRow) for every half that fell
+		self.fell = fell
+		self.cleared = cleared
+		self.virusesCleared = virusesCleared
+	def __repr__(self):
+		return "ChainStep(fell=%r, cleared=%r, virusesCleared=%d)" % (self.fell, sorted(self.cleared), self.virusesCleared)
+
+class Board():
+	"""list-backed game board holding one encoded cell per space"""
+	def __init__(self, rows = BOARD_ROWS, cols = BOARD_COLS, incremental = True):
+		self.rows = rows
+		self.cols = cols
+		self.cells = [EMPTY] * (rows * cols)
+		# incremental matching only rescans runs through cells changed since the last findMatches,
+		# plus the cells it last reported, which stay matched until they are cleared
+		self.incremental = incremental
+		self.touched = set()
+		self.lastMatches = set()
+		self.cellsInspected = 0
+		# topmost occupied row of each column (rows when empty), and the columns that may hold halves that can fall,
+		# so gravity only scans the columns that changed
+		self.tops = [rows] * cols
+		self.unsettled = set()
+		# occupancy() bitmask, None until asked for after a change
+		self.occupiedMask = None
+	def get(self, row, col):
+		return self.cells[row * self.cols + col]
+	def copy(self):
+		board = Board(self.rows, self.cols, self.incremental)
+		board.cells = self.cells[:]
+		board.touched = set(self.touched)
+		board.lastMatches = set(self.lastMatches)
+		board.tops = self.tops[:]
+		board.unsettled = set(self.unsettled)
+		board.occupiedMask = self.occupiedMask
+		return board
+	def toBytes(self):
+		"""one byte per cell, row by row"""
+		return bytes(self.cells)
+	def loadBytes(self, data):
+		"""replaces every cell from toBytes() data"""
+		self.cells = list(data)
+		self.touched = set(range(0, len(self.cells)))
+		self.lastMatches = set()
+		# each column's cells as bytes, the top is past its leading empty cells
+		data = bytes(data)
+		self.tops = [self.rows - len(data[col::self.cols].lstrip(b"\0")) for col in range(0, self.cols)]
+		self.unsettled = set(range(0, self.cols))
+		self.occupiedMask = None
+	def set(self, row, col, cell):
+		index = row * self.cols + col
+		self.cells[index] = cell
+		self.touched.add(index)
+		self.unsettled.add(col)
+		self.occupiedMask = None
+		if cell != EMPTY:
+			if row < self.tops[col]:
+				self.tops[col] = row
+		elif row == self.tops[col]:
+			self.tops[col] = self.findTop(row + 1, col)
+	def findTop(self, row, col):
+		"""first occupied row of a column from row down, rows if there is none"""
+		cells = self.cells
+		cols = self.cols
+		while row < self.rows and cells[row * cols + col] == EMPTY:
+			row += 1
+		return row
+	def occupancy(self):
+		"""bitmask of the occupied cells, bit row * cols + col, kept until the board changes"""
+		if self.occupiedMask is None:
+			self.occupiedMask = int(bytes(self.cells).translate(OCCUPIED_DIGITS)[::-1], 2)
+		return self.occupiedMask
+	def isColliding(self, row, col):
+		"""checks for pill collision at row,col; everything off the board collides"""
+		if row < 0 or row >= self.rows or col < 0 or col >= self.cols:
+			return True
+		return self.cells[row * self.cols + col] != EMPTY
+	def canFall(self, row, col):
+		return (row < self.rows - 1) and self.cells[(row + 1) * self.cols + col] == EMPTY
+	def virusCount(self):
+		return sum(1 for cell in self.cells if cell & VIRUS_FLAG)
+	def placeVirus(self, row, col, colour):
+		self.set(row, col, makeCell(colour, virus = True))
+	def placePill(self, halves):
+		"""locks a pair of (row, col, colour) halves into the board as linked cells"""
+		(rowA, colA, colourA), (rowB, colB, colourB) = halves
+		if rowA == rowB:
+			linkA, linkB = (Link.RIGHT, Link.LEFT) if colA < colB else (Link.LEFT, Link.RIGHT)
+		else:
+			linkA, linkB = (Link.DOWN, Link.UP) if rowA < rowB else (Link.UP, Link.DOWN)
+		self.set(rowA, colA, makeCell(colourA, link = linkA))
+		self.set(rowB, colB, makeCell(colourB, link = linkB))
+	def splitFromPartner(self, row, col):
+		"""unlinks the half pill at row,col from its partner, if it has one"""
+		link = cellLink(self.get(row, col))
+		if link != Link.NONE:
+			(rowOffset, colOffset) = LINK_OFFSETS[link]
+			index = (row + rowOffset) * self.cols + col + colOffset
+			self.cells[index] &= ~(7 << LINK_SHIFT)
+			self.cells[row * self.cols + col] &= ~(7 << LINK_SHIFT)
+			# the partner may have been held up by this half
+			self.unsettled.add(col + colOffset)
+	def resolve(self):
+		"""moves every unsupported pill half down a single row, returns True if anything moved
+
+		only the unsettled columns are scanned, in the same bottom-up, right-to-left order as the whole board;
+		a column where nothing moved stays settled until one of its cells changes"""
+		cells = self.cells
+		cols = self.cols
+		touched = self.touched
+		tops = self.tops
+		scanned = set(self.unsettled)
+		columns = sorted(scanned, reverse = True)
+		moved = set()
+		row = self.rows - 2
+		topRow = min((tops[col] for col in columns), default = self.rows)
+		while row >= topRow:
+			for col in columns:
+				index = row * cols + col
+				cell = cells[index]
+				if cell == EMPTY or cell & VIRUS_FLAG or cells[index + cols] != EMPTY:
+					continue
+				link = cell >> LINK_SHIFT
+				if link == Link.NONE:
+					cells[index] = EMPTY
+					cells[index + cols] = cell
+					touched.add(index + cols)
+					moved.add(col)
+					if tops[col] == row:
+						tops[col] = row + 1
+				else:
+					(rowOffset, colOffset) = LINK_OFFSETS[link]
+					partnerRow = row + rowOffset
+					partnerCol = col + colOffset
+					if colOffset == 0 or self.canFall(partnerRow, partnerCol):
+						partnerIndex = partnerRow * cols + partnerCol
+						partner = cells[partnerIndex]
+						# nullify existing positions, then move down
+						cells[index] = EMPTY
+						cells[partnerIndex] = EMPTY
+						cells[index + cols] = cell
+						cells[partnerIndex + cols] = partner
+						touched.add(index + cols)
+						touched.add(partnerIndex + cols)
+						moved.add(col)
+						moved.add(partnerCol)
+						for (movedRow, movedCol) in ((row, col), (partnerRow, partnerCol)):
+							if tops[movedCol] == movedRow:
+								tops[movedCol] = movedRow + 1
+						if partnerCol not in scanned:
+							# what rested on the partner half is scanned from the next row up
+							scanned.add(partnerCol)
+							columns = sorted(scanned, reverse = True)
+							topRow = min(topRow, tops[partnerCol])
+			row -= 1
+		self.unsettled = moved
+		if moved:
+			self.occupiedMask = None
+		return len(moved) > 0
+	def landingRow(self, row, col):
+		"""lowest row a half at row,col can fall to"""
+		top = self.tops[col]
+		if row < top:
+			# above the stack, it lands on top of it
+			return top - 1
+		cells = self.cells
+		cols = self.cols
+		index = (row + 1) * cols + col
+		while row < self.rows - 1 and cells[index] == EMPTY:
+			row += 1
+			index += cols
+		return row
+	def dropAll(self):
+		"""drops every unsupported half and linked pair straight to its resting row
+
+		like resolve(), only the unsettled columns are scanned, after which every column is settled"""
+		cells = self.cells
+		cols = self.cols
+		touched = self.touched
+		tops = self.tops
+		scanned = set(self.unsettled)
+		columns = sorted(scanned)
+		fell = []
+		row = self.rows - 2
+		topRow = min((tops[col] for col in columns), default = self.rows)
+		while row >= topRow:
+			for col in columns:
+				index = row * cols + col
+				cell = cells[index]
+				if cell == EMPTY or cell & VIRUS_FLAG:
+					continue
+				link = cell >> LINK_SHIFT
+				if link == Link.NONE or link == Link.UP:
+					# single halves and the bottom of a vertical pill, which carries its top half along
+					landing = self.landingRow(row, col)
+					if landing == row:
+						continue
+					distance = (landing - row) * cols
+					cells[index] = EMPTY
+					cells[index + distance] = cell
+					touched.add(index + distance)
+					fell.append((row, col, landing))
+					if tops[col] == row:
+						tops[col] = landing
+					if link == Link.UP:
+						cells[index + distance - cols] = cells[index - cols]
+						cells[index - cols] = EMPTY
+						touched.add(index + distance - cols)
+						fell.append((row - 1, col, landing - 1))
+						if tops[col] == row - 1:
+							tops[col] = landing - 1
+				elif link == Link.RIGHT or link == Link.LEFT:
+					# horizontal pills are moved from their left half; the left column may not be scanned,
+					# but nothing between it and this one moves first, so the order is kept
+					left = col if link == Link.RIGHT else col - 1
+					landing = min(self.landingRow(row, left), self.landingRow(row, left + 1))
+					if landing == row:
+						continue
+					index = row * cols + left
+					distance = (landing - row) * cols
+					cells[index + distance] = cells[index]
+					cells[index + distance + 1] = cells[index + 1]
+					cells[index] = EMPTY
+					cells[index + 1] = EMPTY
+					touched.add(index + distance)
+					touched.add(index + distance + 1)
+					fell.append((row, left, landing))
+					fell.append((row, left + 1, landing))
+					for halfCol in (left, left + 1):
+						if tops[halfCol] == row:
+							tops[halfCol] = landing
+						if halfCol not in scanned:
+							# what rested on this half is scanned from the next row up
+							scanned.add(halfCol)
+							columns = sorted(scanned)
+							topRow = min(topRow, tops[halfCol])
+			row -= 1
+		self.unsettled = set()
+		if fell:
+			self.occupiedMask = None
+		return fell
+	def findMatches(self):
+		"""checks for horizontal/vertical colour matches, returns a set of (row, col)"""
+		seeds = self.touched | self.lastMatches
+		# once most of the board changed, e.g. after loadBytes, a plain scan finds the same runs faster
+		if self.incremental and len(seeds) * 2 <= len(self.cells):
+			matched = self.findMatchesAround(seeds)
+		else:
+			matched = self.findAllMatches()
+		self.touched = set()
+		self.lastMatches = matched
+		return {divmod(index, self.cols) for index in matched}
+	def findAllMatches(self):
+		"""scans the whole board for runs of MATCH_COUNT, returns the matched cell indices"""
+		cells = self.cells
+		rows = self.rows
+		cols = self.cols
+		matched = set()
+		inspected = 0
+		for row in range(0, rows):
+			for col in range(0, cols):
+				cell = cells[row * cols + col]
+				inspected += 1
+				if cell == EMPTY:
+					continue
+				matchColour = cell & COLOUR_MASK
+				i = 0
+				# continue until we hit the bottom of the board or a non-matching space
+				while row+i < rows and cells[(row+i) * cols + col] & COLOUR_MASK == matchColour:
+					i += 1
+				inspected += i
+				# check if we matched a long-enough string of pills
+				if (i >= MATCH_COUNT):
+					logging.debug("Vertical match starting at %d,%d", row, col)
+					matched.update((row+m) * cols + col for m in range(0, i))
+				i = 0
+				# continue until we hit the side of the board or a non-matching space
+				while col+i < cols and cells[row * cols + col+i] & COLOUR_MASK == matchColour:
+					i += 1
+				inspected += i
+				# check if we matched a long-enough string of pills
+				if (i >= MATCH_COUNT):
+					logging.debug("Horizontal match starting at %d,%d", row, col)
+					matched.update(row * cols + col+m for m in range(0, i))
+		self.cellsInspected = inspected
+		return matched
+	def findMatchesAround(self, seeds):
+		"""scans only the row and column runs through the seed cell indices"""
+		cells = self.cells
+		cols = self.cols
+		size = len(cells)
+		matched = set()
+		scannedRows = set()
+		scannedCols = set()
+		inspected = 0
+		for index in seeds:
+			cell = cells[index]
+			inspected += 1
+			if cell == EMPTY:
+				continue
+			matchColour = cell & COLOUR_MASK
+			if index not in scannedRows:
+				# extend the run left and right until a non-matching space or the side of the board
+				rowStart = index - index % cols
+				first = last = index
+				while first > rowStart and cells[first - 1] & COLOUR_MASK == matchColour:
+					first -= 1
+				while last < rowStart + cols - 1 and cells[last + 1] & COLOUR_MASK == matchColour:
+					last += 1
+				inspected += last - first
+				run = range(first, last + 1)
+				scannedRows.update(run)
+				if (len(run) >= MATCH_COUNT):
+					logging.debug("Horizontal match starting at %d,%d", *divmod(first, cols))
+					matched.update(run)
+			if index not in scannedCols:
+				# extend the run up and down until a non-matching space or the edge of the board
+				first = last = index
+				while first - cols >= 0 and cells[first - cols] & COLOUR_MASK == matchColour:
+					first -= cols
+				while last + cols < size and cells[last + cols] & COLOUR_MASK == matchColour:
+					last += cols
+				inspected += (last - first) // cols
+				run = range(first, last + 1, cols)
+				scannedCols.update(run)
+				if (len(run) >= MATCH_COUNT):
+					logging.debug("Vertical match starting at %d,%d", *divmod(first, cols))
+					matched.update(run)
+		self.cellsInspected = inspected
+		return matched
+	def clearMatches(self, matchedPillLocations):
+		"""empties the matched cells and returns the number of viruses cleared"""
+		virusesCleared = 0
+		for (row, col) in matchedPillLocations:
+			cell = self.get(row, col)
+			if cell & VIRUS_FLAG:
+				virusesCleared += 1
+			else:
+				self.splitFromPartner(row, col)
+			self.set(row, col, EMPTY)
+		return virusesCleared
+
+class PillTransitions():
+	"""where each move takes the pill from every position on a rows x cols board
+
+	positions are numbered (row * cols + col) * 2 + orientation value. For each move action and position the
+	table holds the (mask, position, swap) candidates to try in order: the first whose mask of cells is empty
+	in the board's occupancy() is taken, and swap is 1 if the halves change places. Moves whose cells
+	would be off the board are left out, as everything off the board collides"""
+	def __init__(self, rows, cols):
+		self.rows = rows
+		self.cols = cols
+		count = rows * cols * 2
+		# position -> (row, col, orientation)
+		self.decode = [(position // 2 // cols, position // 2 % cols, Orientation(position % 2)) for position in range(0, count)]
+		# action -> [candidates of each position]
+		self.moves = [None] * len(Action)
+		for action in MOVE_ACTIONS:
+			self.moves[action] = [tuple(self.candidates(action, *self.decode[position])) for position in range(0, count)]
+	def candidates(self, action, row, col, orient):
+		vertical = orient == Orientation.VERTICAL
+		if action == Action.LEFT:
+			options = [(((row, col - 1), (row + 1, col - 1)) if vertical else ((row, col - 1),), (row, col - 1, orient), 0)]
+		elif action == Action.RIGHT:
+			options = [(((row, col + 1), (row + 1, col + 1)) if vertical else ((row, col + 2),), (row, col + 1, orient), 0)]
+		elif action == Action.DOWN:
+			options = [(((row + 2, col),) if vertical else ((row + 1, col), (row + 1, col + 1)), (row + 1, col, orient), 0)]
+		elif vertical:
+			# counterclockwise into the bottom half's row, or into the row to its left when the right is blocked
+			options = [(((row + 1, col + 1),), (row + 1, col, Orientation.HORIZONTAL), 0),
+				(((row + 1, col - 1),), (row + 1, col - 1, Orientation.HORIZONTAL), 0)]
+		else:
+			# the right half rotates up, or when above is blocked down, with the left half on top
+			options = [(((row - 1, col),), (row - 1, col, Orientation.VERTICAL), 1),
+				(((row + 1, col),), (row, col, Orientation.VERTICAL), 0)]
+		for (cells, (newRow, newCol, newOrient), swap) in options:
+			if all(0 <= cellRow < self.rows and 0 <= cellCol < self.cols for (cellRow, cellCol) in cells):
+				mask = sum(1 << (cellRow * self.cols + cellCol) for (cellRow, cellCol) in cells)
+				yield (mask, (newRow * self.cols + newCol) * 2 + newOrient.value, swap)
+
+# tables are built once per board size
+transitionTables = {}
+
+def pillTransitions(rows, cols):
+	"""the PillTransitions of a board size, built on first use"""
+	tables = transitionTables.get((rows, cols))
+	if tables is None:
+		tables = transitionTables[(rows, cols)] = PillTransitions(rows, cols)
+	return tables
+
+class Pill():
+	"""a falling pill, anchored at its top-left half and controlled by the player"""
+	def __init__(self, board, colours, row = START_ROW, col = START_COL - 1, orient = Orientation.HORIZONTAL):
+		self.board = board
+		# colours of the (left, right) or (top, bottom) halves
+		self.colours = tuple(colours)
+		self.row = row
+		self.col = col
+		self.orient = orient
+		self.gravityTimer = 0
+		self.transitions = pillTransitions(board.rows, board.cols)
+	def copy(self):
+		pill = Pill(self.board, self.colours, self.row, self.col, self.orient)
+		pill.gravityTimer = self.gravityTimer
+		return pill
+	def key(self):
+		"""hashable (row, col, orientation, colours) position of the pill"""
+		return (self.row, self.col, self.orient, self.colours)
+	def position(self):
+		"""the pill's position number in its PillTransitions"""
+		return (self.row * self.board.cols + self.col) * 2 + self.orient.value
+	def move(self, action):
+		"""applies a LEFT, RIGHT, ROTATE or DOWN move if the board allows it, returns True if the pill moved"""
+		board = self.board
+		occupied = board.occupancy()
+		transitions = self.transitions
+		for (mask, position, swap) in transitions.moves[action][(self.row * board.cols + self.col) * 2 + self.orient.value]:
+			if not occupied & mask:
+				(self.row, self.col, self.orient) = transitions.decode[position]
+				if swap:
+					self.colours = (self.colours[1], self.colours[0])
+				return True
+		return False
+	def halves(self):
+		"""returns the (row, col, colour) of both halves"""
+		if self.orient == Orientation.HORIZONTAL:
+			return ((self.row, self.col, self.colours[0]), (self.row, self.col + 1, self.colours[1]))
+		return ((self.row, self.col, self.colours[0]), (self.row + 1, self.col, self.colours[1]))
+	def moveLeft(self):
+		return self.move(Action.LEFT)
+	def moveRight(self):
+		return self.move(Action.RIGHT)
+	def moveDown(self):
+		if (self.applyGravity(timeDelta = 0, userInput = True) == False):
+			# if we hit something, set the timer so gravity triggers next tick
+			self.applyGravity(PILL_GRAVITY_TIMER)
+	def hardDrop(self):
+		"""drops the pill as far as it goes and makes it lock on the next tick"""
+		landingRow = self.board.landingRow
+		if self.orient == Orientation.VERTICAL:
+			self.row = landingRow(self.row + 1, self.col) - 1
+		else:
+			self.row = min(landingRow(self.row, self.col), landingRow(self.row, self.col + 1))
+		self.gravityTimer = PILL_GRAVITY_TIMER + 1
+	def canFall(self):
+		candidates = self.transitions.moves[Action.DOWN][self.position()]
+		return len(candidates) > 0 and not self.board.occupancy() & candidates[0][0]
+	def applyGravity(self, timeDelta, userInput = False):
+		"""returns True if the pill fell, False if it is blocked and None if the timer has not run out"""
+		self.gravityTimer += timeDelta
+		if (self.gravityTimer > PILL_GRAVITY_TIMER or userInput):
+			self.gravityTimer = 0
+			if self.canFall():
+				self.row += 1
+				return True
+			return False
+		return None
+	def rotate(self):
+		"""rotate the pill 90 degrees, the other way round when the usual way is blocked"""
+		return self.move(Action.ROTATE)
+	def isColliding(self):
+		"""check if the pill is colliding with anything in its current position"""
+		((rowA, colA, _), (rowB, colB, _)) = self.halves()
+		return self.board.isColliding(rowA, colA) or self.board.isColliding(rowB, colB)
+	def settle(self):
+		"""called when the pill can't fall any further and must lock in place"""
+		self.board.placePill(self.halves())
+	def reachablePlacements(self):
+		"""searches left/right/rotate/down moves from here, ignoring gravity timing
+
+		returns {key: actions} for every reachable position the pill would lock in"""
+		occupied = self.board.occupancy()
+		moves = [(action, self.transitions.moves[action]) for action in MOVE_ACTIONS]
+		decode = self.transitions.decode
+		# nodes are position * 2 + 1 if the halves are swapped from this pill's, which only matters for two colours;
+		# each node remembers the move that reached it
+		swaps = int(self.colours[0] != self.colours[1])
+		start = self.position() * 2
+		parents = {start: None}
+		landed = []
+		frontier = deque([start])
+		while frontier:
+			node = frontier.popleft()
+			(position, swapped) = divmod(node, 2)
+			falls = False
+			for (action, table) in moves:
+				for (mask, moved, swap) in table[position]:
+					if not occupied & mask:
+						moved = moved * 2 + (swapped ^ (swap & swaps))
+						if moved not in parents:
+							parents[moved] = (node, action)
+							frontier.append(moved)
+						falls |= action == Action.DOWN
+						break
+			if not falls:
+				landed.append(node)
+		placements = {}
+		(first, second) = self.colours
+		for node in landed:
+			path = []
+			step = parents[node]
+			while step is not None:
+				path.append(step[1])
+				step = parents[step[0]]
+			(position, swapped) = divmod(node, 2)
+			(row, col, orient) = decode[position]
+			placements[(row, col, orient, (second, first) if swapped else (first, second))] = path[::-1]
+		return placements
+
+class GameState():
+	"""a single game of Dr Mario, advanced one logic tick at a time"""
+	def __init__(self, level = LEVEL, boardClass = Board, rows = BOARD_ROWS, cols = BOARD_COLS, instantResolve = False,
+			seed = None, startingBoard = None):
+		self.level = level
+		self.board = boardClass(rows, cols)
+		# resolve cascades in one call when the pill settles, instead of one gravity step per tick
+		self.instantResolve = instantResolve
+		self.chainSteps = []
+		# every game gets its own seeded rngs, so any game can be reproduced from its seed;
+		# pills draw from their own stream so a pre-generated starting board plays the same
+		self.seed = seed if seed is not None else random.randrange(MAX_SEED)
+		if not 0 <= self.seed < MAX_SEED:
+			raise ValueError("Seed %d is outside 0 to %d" % (self.seed, MAX_SEED - 1))
+		self.rng = random.Random(self.seed)
+		self.pillRng = random.Random(b"pills" + self.seed.to_bytes(8, "little"))
+		self.pill = None
+		# colours of the pill after the current one, shown to the player
+		self.nextColours = self.drawColours()
+		self.resolveNeeded = False
+		self.matchedPillLocations = []
+		self.gameOver = False
+		self.won = False
+		self.pillsUsed = 0
+		if startingBoard is not None:
+			# cells of a board generated from the same seed, e.g. out of a level pack
+			self.board.loadBytes(startingBoard)
+		else:
+			self.spawnViruses()
+		self.virusCount = self.board.virusCount()
+		self.spawnPill()
+	def spawnViruses(self):
+		"""fills the bottom rows of the board with viruses for the current level"""
+		for (row, col, colour) in virusPlacements(self.level, self.rng, self.board.rows, self.board.cols):
+			self.board.placeVirus(row, col, colour)
+	def spawnPill(self):
+		"""spawns a new pill at the top of the board; the game is lost if it collides"""
+		self.pill = Pill(self.board, self.nextColours, START_ROW, min(START_COL, self.board.cols - 1) - 1)
+		self.nextColours = self.drawColours()
+		self.pillsUsed += 1
+		if self.pill.isColliding():
+			logging.debug("GAME OVER")
+			self.gameOver = True
+	def drawColours(self):
+		# the rng only moves here, so snapshots in between share one getstate() copy
+		self.pillRngState = None
+		return (self.pillRng.choice(list(Colour)).value, self.pillRng.choice(list(Colour)).value)
+	def applyAction(self, action):
+		"""applies a single player input to the falling pill"""
+		if self.gameOver or self.pill is None or self.resolveNeeded:
+			return False
+		if action == Action.LEFT:
+			return self.pill.moveLeft()
+		if action == Action.RIGHT:
+			return self.pill.moveRight()
+		if action == Action.ROTATE:
+			return self.pill.rotate()
+		if action == Action.DOWN:
+			self.pill.moveDown()
+			return True
+		if action == Action.HARD_DROP:
+			self.pill.hardDrop()
+			return True
+		return False
+	def tick(self, timeDelta = TICK_MS):
+		"""advances gravity, matching and clearing by one logic tick, returns the number of viruses cleared"""
+		if self.gameOver:
+			return 0
+		board = self.board
+		matchedPillLocations = []
+		virusesCleared = 0
+
+		# apply gravity
+		if (self.pill and self.pill.applyGravity(timeDelta) == False):
+			# add the current pill to the fixed board
+			self.pill.settle()
+			self.pill = None
+			if self.instantResolve:
+				# settle the whole cascade now, the chain steps are kept for the renderer
+				self.chainSteps = resolveCascade(board)
+				virusesCleared = sum(chainStep.virusesCleared for chainStep in self.chainSteps)
+				self.virusCount -= virusesCleared
+			else:
+				# check for matches
+				matchedPillLocations = board.findMatches()
+				if (matchedPillLocations):
+					self.resolveNeeded = True
+
+		# nothing to resolve and no active pill
+		if not self.resolveNeeded and self.pill is None:
+			if self.virusCount < 1:
+				logging.debug("YOU WIN!")
+				self.won = True
+				self.gameOver = True
+				return virusesCleared
+			# spawn a new pill
+			self.spawnPill()
+			if self.gameOver:
+				return virusesCleared
+
+		# game board is not resolved yet, let remaining pills settle
+		# into new positions before spawning a new pill
+		if self.resolveNeeded:
+			# check if anything else can move
+			if not board.resolve():
+				self.resolveNeeded = False
+				# check for matches
+				matchedPillLocations = board.findMatches()
+
+		# clear matches
+		if matchedPillLocations:
+			virusesCleared = board.clearMatches(matchedPillLocations)
+			self.virusCount -= virusesCleared
+			if (self.virusCount < 0):
+				logging.error("Number of viruses < 0!")
+			self.resolveNeeded = True
+		self.matchedPillLocations = matchedPillLocations
+		return virusesCleared
+	def snapshot(self):
+		"""captures the game in a Snapshot, restore() puts it back"""
+		pill = self.pill
+		if pill:
+			pillFields = (True, pill.row, pill.col, pill.orient.value, pill.colours[0], pill.colours[1], pill.gravityTimer,
+				isinstance(pill.gravityTimer, int))
+		else:
+			pillFields = (False, 0, 0, 0, 0, 0, 0, True)
+		progress = SNAPSHOT_FORMAT.pack(*pillFields, *self.nextColours, self.resolveNeeded, self.gameOver, self.won,
+			self.pillsUsed, self.virusCount)
+		if self.pillRngState is None:
+			self.pillRngState = self.pillRng.getstate()
+		return Snapshot(self.board.toBytes(), progress, self.pillRngState)
+	def restore(self, snapshot):
+		"""returns the game to a snapshot() of itself, reusing the board"""
+		self.board.loadBytes(snapshot.board)
+		(hasPill, row, col, orient, first, second, gravityTimer, intTimer, nextFirst, nextSecond, self.resolveNeeded,
+			self.gameOver, self.won, self.pillsUsed, self.virusCount) = SNAPSHOT_FORMAT.unpack(snapshot.progress)
+		self.pill = None
+		if hasPill:
+			self.pill = Pill(self.board, (first, second), row, col, Orientation(orient))
+			self.pill.gravityTimer = int(gravityTimer) if intTimer else gravityTimer
+		self.nextColours = (nextFirst, nextSecond)
+		if snapshot.rngState is not self.pillRngState:
+			self.pillRng.setstate(snapshot.rngState)
+			self.pillRngState = snapshot.rngState
+		self.chainSteps = []
+		self.matchedPillLocations = []
+	def view(self):
+		"""the board as a player sees it: toBytes() cells with the falling pill overlaid, flagged with PILL_FLAG"""
+		cells = bytearray(self.board.toBytes())
+		pill = self.pill
+		if pill and not self.gameOver:
+			links = (Link.RIGHT, Link.LEFT) if pill.orient == Orientation.HORIZONTAL else (Link.DOWN, Link.UP)
+			for ((row, col, colour), link) in zip(pill.halves(), links):
+				cells[row * self.board.cols + col] = makeCell(colour, link = link) | PILL_FLAG
+		return cells
+	def writeObservation(self, buffer, offset = 0):
+		"""writes the board planes and pill into buffer at offset in the OBSERVATION_HEADER layout, returns the bytes written
+
+		buffer is anything writable through a memoryview, such as a bytearray or a shared memory block's buf"""
+		board = self.board
+		size = board.rows * board.cols
+		pill = self.pill if not self.gameOver else None
+		if pill:
+			pillFields = (pill.row, pill.col, pill.orient.value, pill.colours[0], pill.colours[1])
+		else:
+			pillFields = (-1, -1, -1, -1, -1)
+		OBSERVATION_HEADER.pack_into(buffer, offset, *pillFields, *self.nextColours, self.gameOver, self.won,
+			max(self.virusCount, 0), self.pillsUsed)
+		view = memoryview(buffer).cast("B")
+		cells = board.toBytes()
+		start = offset + OBSERVATION_HEADER.size
+		for (plane, table) in enumerate((COLOUR_PLANE, VIRUS_PLANE, LINK_PLANE)):
+			view[start + plane * size:start + (plane + 1) * size] = cells.translate(table)
+		pillPlane = start + 3 * size
+		view[pillPlane:pillPlane + size] = bytes(size)
+		if pill:
+			for (row, col, colour) in pill.halves():
+				view[pillPlane + row * board.cols + col] = colour + 1
+		return OBSERVATION_HEADER.size + len(OBSERVATION_PLANES) * size
+	def boardHash(self):
+		"""short digest of the board, falling pill and virus count, for checking replays"""
+		digest = hashlib.blake2b(self.board.toBytes(), digest_size = 8)
+		if self.pill:
+			digest.update(repr((self.pill.key(), self.pill.gravityTimer)).encode())
+		digest.update(repr((self.virusCount, self.gameOver, self.won)).encode())
+		return digest.digest()
+	def step(self, action = Action.NONE, timeDelta = TICK_MS):
+		"""applies an action and advances the game by one logic tick"""
+		self.applyAction(action)
+		return self.tick(timeDelta)
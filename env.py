@@ -0,0 +1,327 @@
+"""
+Gym-style environments for Dr Mario.
+
+DrMarioEnv wraps a single GameState behind reset(seed)/step(action). Actions
+are either engine.Action values (left, right, rotate, down, hard drop) or,
+with placementActions = True, a (row, col, rotation) placement reachable by
+the current pill. Given a level pack (see levelpack.py), reset(seed) loads
+board seed % len(pack) from the memory-mapped pack instead of placing
+viruses. Observations are (rows, cols) uint8 arrays of engine cells with
+PILL_FLAG set on the falling pill, and the reward is the number of viruses
+cleared.
+
+VectorEnv runs many DrMarioEnvs in worker processes. Observations, rewards,
+dones and actions live in shared memory, so only tiny commands go over the
+pipes instead of pickled boards.
+
+GameState.writeObservation() writes a game as colour, virus, link and pill
+planes plus the pill and progress fields into any writable buffer, and
+observationDtype() maps that layout as a NumPy record without copying. An
+ObservationRing keeps the last few of those per game in shared memory, which
+VectorEnv(ringCapacity = K) fills from its workers after every step, so a
+learner can read the latest K states of every env in one batch.
+
+# @Author: V.K. Prinsen
+
+"""
+
+import random
+import struct
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from engine import (BOARD_ROWS, BOARD_COLS, LEVEL, OBSERVATION_FIELDS, OBSERVATION_HEADER, OBSERVATION_PLANES,
+	Orientation, Action, GameState)
+from levelpack import LevelPack
+
+# sequence number of a ring slot while it is being written
+RING_WRITING = (1 << 64) - 1
+
+def placementRotation(orient, colours, spawnColours):
+	"""numbers the four pill rotations relative to the colours it spawned with: 0 and 2 are
+	horizontal, 1 and 3 vertical, and each rotate() steps to the next one"""
+	(first, second) = spawnColours
+	if orient == Orientation.HORIZONTAL:
+		return 0 if colours == (first, second) else 2
+	return 1 if colours == (second, first) else 3
+
+def observationDtype(rows, cols, sequence = False):
+	"""NumPy record dtype of the GameState.writeObservation() layout, optionally after a u64 sequence number"""
+	(names, formats, offsets) = ([], [], [])
+	start = 8 if sequence else 0
+	if sequence:
+		(names, formats, offsets) = (["sequence"], ["<u8"], [0])
+	offset = start
+	for (name, code) in OBSERVATION_FIELDS:
+		names.append(name)
+		formats.append("<" + code)
+		offsets.append(offset)
+		offset += struct.calcsize("<" + code)
+	offset = start + OBSERVATION_HEADER.size
+	for plane in OBSERVATION_PLANES:
+		names.append(plane)
+		formats.append((np.uint8, (rows, cols)))
+		offsets.append(offset)
+		offset += rows * cols
+	# records stay 8-byte aligned when packed one after another
+	return np.dtype({"names": names, "formats": formats, "offsets": offsets, "itemsize": (offset + 7) // 8 * 8})
+
+def mapObservation(buffer, rows, cols, offset = 0):
+	"""a NumPy record viewing the observation written at offset of buffer, without copying"""
+	return np.ndarray((), observationDtype(rows, cols), buffer = buffer, offset = offset)
+
+class ObservationRing():
+	"""the last capacity observations of each of numSources games, in one shared memory block
+
+	the block holds a u64 count of the observations written per source, then capacity slots per source, each a
+	u64 sequence number and the GameState.writeObservation() layout. write() fills a source's oldest slot and
+	then bumps its count. latest(k) gathers the newest k of every source in one copy, and slots maps the whole
+	ring without copying. A slot's sequence is RING_WRITING while it is written, so a reader can tell a slot
+	that was overwritten while it was being read"""
+	def __init__(self, numSources, capacity, rows = BOARD_ROWS, cols = BOARD_COLS, name = None):
+		"""creates the ring, or attaches to the one called name"""
+		self.numSources = numSources
+		self.capacity = capacity
+		self.dtype = observationDtype(rows, cols, sequence = True)
+		self.slotsOffset = 8 * numSources
+		size = self.slotsOffset + numSources * capacity * self.dtype.itemsize
+		self.owner = name is None
+		if self.owner:
+			self.block = shared_memory.SharedMemory(create = True, size = size)
+		else:
+			self.block = shared_memory.SharedMemory(name = name)
+		self.name = self.block.name
+		self.counts = np.ndarray((numSources,), np.uint64, buffer = self.block.buf)
+		self.slots = np.ndarray((numSources, capacity), self.dtype, buffer = self.block.buf, offset = self.slotsOffset)
+		self.sequences = self.slots["sequence"]
+	def write(self, source, state):
+		"""writes a GameState into the source's oldest slot"""
+		count = int(self.counts[source])
+		slot = count % self.capacity
+		self.sequences[source, slot] = RING_WRITING
+		state.writeObservation(self.block.buf, self.slotsOffset + (source * self.capacity + slot) * self.dtype.itemsize + 8)
+		self.sequences[source, slot] = count
+		self.counts[source] = count + 1
+	def latest(self, k):
+		"""returns (observations, valid): a (numSources, k) copy of every source's newest k observations, oldest
+		first, and which of them are whole; slots a source has not written yet, or that were overwritten while
+		being copied, are not valid"""
+		if k > self.capacity:
+			raise ValueError("Ring only holds %d observations per source" % self.capacity)
+		expected = self.counts.astype(np.int64)[:, None] - k + np.arange(0, k)
+		sources = np.arange(0, self.numSources)[:, None]
+		slots = expected % self.capacity
+		observations = self.slots[sources, slots]
+		valid = ((expected >= 0) & (observations["sequence"].astype(np.int64) == expected) &
+			(self.sequences[sources, slots].astype(np.int64) == expected))
+		return observations, valid
+	def close(self):
+		self.counts = self.slots = self.sequences = None
+		self.block.close()
+		if self.owner:
+			self.block.unlink()
+
+class DrMarioEnv():
+	"""single game environment with reset(seed) and step(action)"""
+	def __init__(self, level = LEVEL, placementActions = False, rows = BOARD_ROWS, cols = BOARD_COLS, levelPack = None):
+		self.level = level
+		self.placementActions = placementActions
+		if isinstance(levelPack, str):
+			levelPack = LevelPack(levelPack)
+		self.levelPack = levelPack
+		if levelPack is not None:
+			(rows, cols) = (levelPack.rows, levelPack.cols)
+		self.rows = rows
+		self.cols = cols
+		self.observationShape = (rows, cols)
+		self.state = None
+	def reset(self, seed = None, out = None):
+		"""starts a new game and returns its first observation"""
+		if self.levelPack is not None:
+			index = random.randrange(len(self.levelPack)) if seed is None else seed % len(self.levelPack)
+			self.state = self.levelPack.newGame(index, instantResolve = True)
+		else:
+			self.state = GameState(self.level, rows = self.rows, cols = self.cols, instantResolve = True, seed = seed)
+		return self.observe(out)
+	def observe(self, out = None):
+		"""writes the board and falling pill into out (or a new array) and returns it"""
+		if out is None:
+			out = np.empty(self.observationShape, dtype = np.uint8)
+		out.reshape(-1)[:] = np.frombuffer(self.state.view(), dtype = np.uint8)
+		return out
+	def snapshot(self):
+		"""captures the game for restore(), e.g. to branch rollouts from one position"""
+		return self.state.snapshot()
+	def restore(self, snapshot, out = None):
+		"""returns the game to a snapshot() and returns its observation"""
+		self.state.restore(snapshot)
+		return self.observe(out)
+	def legalPlacements(self):
+		"""returns {(row, col, rotation): actions} for every placement the current pill can reach"""
+		pill = self.state.pill
+		if pill is None or self.state.gameOver:
+			return {}
+		placements = {}
+		for ((row, col, orient, colours), path) in pill.reachablePlacements().items():
+			placement = (row, col, placementRotation(orient, colours, pill.colours))
+			if placement not in placements or len(path) < len(placements[placement]):
+				placements[placement] = path
+		return placements
+	def step(self, action, out = None):
+		"""applies an action and returns (observation, reward, done, info)"""
+		state = self.state
+		info = {}
+		if self.placementActions:
+			path = self.legalPlacements().get(tuple(int(value) for value in action))
+			if path is None:
+				# unreachable placements drop the pill where it is
+				info["illegal"] = True
+				path = []
+			for pathAction in path:
+				state.applyAction(pathAction)
+			reward = state.step(Action.HARD_DROP)
+		else:
+			reward = state.step(Action(int(action)))
+		info["won"] = state.won
+		info["virusCount"] = state.virusCount
+		info["pillsUsed"] = state.pillsUsed
+		return self.observe(out), float(reward), state.gameOver, info
+
+# Vectorized environment
+
+def createShared(shape, dtype):
+	"""allocates a shared memory block and a NumPy view of it"""
+	size = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+	block = shared_memory.SharedMemory(create = True, size = size)
+	return block, np.ndarray(shape, dtype = dtype, buffer = block.buf)
+
+def attachShared(name, shape, dtype):
+	block = shared_memory.SharedMemory(name = name)
+	return block, np.ndarray(shape, dtype = dtype, buffer = block.buf)
+
+def vectorWorker(connection, layout, first, last, level, placementActions, levelPack, ringLayout = None):
+	"""owns envs first..last-1, reading actions from and writing results into shared memory"""
+	blocks = {}
+	arrays = {}
+	for (key, (name, shape, dtype)) in layout.items():
+		blocks[key], arrays[key] = attachShared(name, shape, dtype)
+	(rows, cols) = arrays["observations"].shape[1:]
+	# (name, capacity) of the ring every step is also written to
+	ring = None
+	if ringLayout:
+		(name, capacity) = ringLayout
+		ring = ObservationRing(len(arrays["dones"]), capacity, rows, cols, name)
+	# each worker maps the pack itself, the pages are shared through the OS cache
+	pack = LevelPack(levelPack) if levelPack else None
+	envs = {index: DrMarioEnv(level, placementActions, rows, cols, pack) for index in range(first, last)}
+	episodes = {index: 0 for index in envs}
+	seeds = {index: None for index in envs}
+	try:
+		while (1):
+			(command, argument) = connection.recv()
+			if command == "close":
+				connection.send(command)
+				break
+			if command == "reset":
+				for (index, env) in envs.items():
+					seeds[index] = None if argument is None else argument + index
+					episodes[index] = 0
+					env.reset(seeds[index], arrays["observations"][index])
+					if ring:
+						ring.write(index, env.state)
+			elif command == "step":
+				for (index, env) in envs.items():
+					action = arrays["actions"][index] if placementActions else arrays["actions"][index, 0]
+					(observation, reward, done, info) = env.step(action, arrays["observations"][index])
+					arrays["rewards"][index] = reward
+					arrays["dones"][index] = done
+					arrays["won"][index] = info["won"]
+					if ring:
+						# the state the step ended in, before any reset, is what the learner wants to see
+						ring.write(index, env.state)
+					if done:
+						# start the next episode straight away, with a seed derived from the first
+						episodes[index] += 1
+						seed = None if seeds[index] is None else seeds[index] + episodes[index] * len(arrays["dones"])
+						env.reset(seed, arrays["observations"][index])
+			connection.send(command)
+	finally:
+		if ring:
+			ring.close()
+		arrays.clear()
+		for block in blocks.values():
+			block.close()
+
+class VectorEnv():
+	"""M DrMarioEnvs spread over a pool of worker processes, with shared-memory observations"""
+	def __init__(self, numEnvs, numWorkers = None, level = LEVEL, placementActions = False, rows = BOARD_ROWS,
+			cols = BOARD_COLS, levelPack = None, ringCapacity = None):
+		"""levelPack is the path of a level pack to reset from; with a ringCapacity every env's last ringCapacity
+		observations are kept in an ObservationRing, self.ring"""
+		self.numEnvs = numEnvs
+		if levelPack is not None:
+			pack = LevelPack(levelPack)
+			(rows, cols) = (pack.rows, pack.cols)
+			pack.close()
+		self.placementActions = placementActions
+		numWorkers = min(numWorkers or mp.cpu_count(), numEnvs)
+		self.blocks = {}
+		self.arrays = {}
+		layout = {}
+		for (key, shape, dtype) in (("observations", (numEnvs, rows, cols), np.uint8),
+				("actions", (numEnvs, 3), np.int16), ("rewards", (numEnvs,), np.float32),
+				("dones", (numEnvs,), np.bool_), ("won", (numEnvs,), np.bool_)):
+			self.blocks[key], self.arrays[key] = createShared(shape, dtype)
+			layout[key] = (self.blocks[key].name, shape, dtype)
+		self.ring = ObservationRing(numEnvs, ringCapacity, rows, cols) if ringCapacity else None
+		ringLayout = (self.ring.name, ringCapacity) if self.ring else None
+		self.connections = []
+		self.workers = []
+		for worker in range(0, numWorkers):
+			(first, last) = (numEnvs * worker // numWorkers, numEnvs * (worker + 1) // numWorkers)
+			(parentEnd, childEnd) = mp.Pipe()
+			process = mp.Process(target = vectorWorker, args = (childEnd, layout, first, last, level, placementActions,
+				levelPack, ringLayout),
+				daemon = True)
+			process.start()
+			self.connections.append(parentEnd)
+			self.workers.append(process)
+	def command(self, command, argument = None):
+		for connection in self.connections:
+			connection.send((command, argument))
+		for connection in self.connections:
+			connection.recv()
+	def reset(self, seed = None):
+		"""resets every env (env i gets seed + i) and returns the shared (M, rows, cols) observations"""
+		self.command("reset", seed)
+		return self.arrays["observations"]
+	def step(self, actions):
+		"""steps every env, auto-resetting finished ones; returns shared (observations, rewards, dones)
+
+		the returned arrays are overwritten by the next call, copy them to keep them"""
+		actions = np.asarray(actions)
+		if self.placementActions:
+			self.arrays["actions"][:] = actions
+		else:
+			self.arrays["actions"][:, 0] = actions
+		self.command("step")
+		return self.arrays["observations"], self.arrays["rewards"], self.arrays["dones"]
+	def close(self):
+		if not self.workers:
+			return
+		self.command("close")
+		for process in self.workers:
+			process.join()
+		self.workers = []
+		self.arrays.clear()
+		for block in self.blocks.values():
+			block.close()
+			block.unlink()
+		if self.ring:
+			self.ring.close()
+	def __enter__(self):
+		return self
+	def __exit__(self, *exc):
+		self.close()
@@ -0,0 +1,105 @@
+"""
+Pre-generated Dr Mario starting boards.
+
+A level pack is a header followed by fixed-size records, one per starting
+board: the game seed, the level and the board cells exactly as
+Board.toBytes() writes them. LevelPack memory-maps the file, so starting a
+game from record i is a slice of the map with no virus placement work, and
+the game plays exactly like GameState(level, seed = seed).
+
+	python levelpack.py levels.drl --count 1000000 --levels 0-20
+
+# @Author: V.K. Prinsen
+
+"""
+
+import mmap
+import random
+import struct
+import logging
+import argparse
+
+from engine import BOARD_ROWS, BOARD_COLS, MAX_SEED, Board, GameState, virusPlacements, parseSeed
+
+PACK_MAGIC = b"DRLP"
+PACK_VERSION = 2
+# magic, version, rows, cols, record count
+PACK_HEADER = struct.Struct("<4sBxHHQ")
+# seed and level, followed by rows * cols cell bytes
+RECORD_HEADER = struct.Struct("<QB")
+
+def recordSize(rows, cols):
+	return RECORD_HEADER.size + rows * cols
+
+def startingBoard(level, seed, rows = BOARD_ROWS, cols = BOARD_COLS):
+	"""cells of the board GameState(level, seed = seed) starts with"""
+	board = Board(rows, cols)
+	for (row, col, colour) in virusPlacements(level, random.Random(seed), rows, cols):
+		board.placeVirus(row, col, colour)
+	return board.toBytes()
+
+def generatePack(path, count, levels, firstSeed = None, rows = BOARD_ROWS, cols = BOARD_COLS):
+	"""writes count starting boards, cycling through levels, with consecutive seeds from firstSeed"""
+	if firstSeed is None:
+		firstSeed = random.randrange(MAX_SEED - count)
+	header = PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION, rows, cols, count)
+	with open(path, "wb") as packFile:
+		packFile.write(header)
+		for index in range(0, count):
+			seed = firstSeed + index
+			level = levels[index % len(levels)]
+			packFile.write(RECORD_HEADER.pack(seed, level))
+			packFile.write(startingBoard(level, seed, rows, cols))
+	logging.info("Wrote %d boards to %s", count, path)
+
+class LevelPack():
+	"""read-only, memory-mapped view of a level pack"""
+	def __init__(self, path):
+		self.path = path
+		with open(path, "rb") as packFile:
+			self.data = mmap.mmap(packFile.fileno(), 0, access = mmap.ACCESS_READ)
+		(magic, version, self.rows, self.cols, self.count) = PACK_HEADER.unpack_from(self.data)
+		if magic != PACK_MAGIC or version != PACK_VERSION:
+			raise ValueError("%s is not a version %d level pack" % (path, PACK_VERSION))
+		self.recordSize = recordSize(self.rows, self.cols)
+		if len(self.data) < PACK_HEADER.size + self.count * self.recordSize:
+			raise ValueError("%s is truncated" % path)
+	def __len__(self):
+		return self.count
+	def record(self, index):
+		"""returns (seed, level, cells) for a record, cells being a memoryview into the map"""
+		if index < 0 or index >= self.count:
+			raise IndexError("level pack index out of range")
+		offset = PACK_HEADER.size + index * self.recordSize
+		(seed, level) = RECORD_HEADER.unpack_from(self.data, offset)
+		start = offset + RECORD_HEADER.size
+		return seed, level, memoryview(self.data)[start:start + self.rows * self.cols]
+	def newGame(self, index, **options):
+		"""starts a GameState on a record's board"""
+		(seed, level, cells) = self.record(index)
+		return GameState(level, rows = self.rows, cols = self.cols, seed = seed, startingBoard = cells, **options)
+	def close(self):
+		self.data.close()
+
+def parseLevels(text):
+	"""'0-20' or '3,5,7' to a list of levels"""
+	levels = []
+	for part in text.split(","):
+		if "-" in part:
+			(first, last) = part.split("-")
+			levels.extend(range(int(first), int(last) + 1))
+		else:
+			levels.append(int(part))
+	return levels
+
+if __name__ == "__main__":
+	logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+	parser = argparse.ArgumentParser(description = "Generate a Dr Mario level pack")
+	parser.add_argument("path", help = "level pack file to write")
+	parser.add_argument("--count", type = int, default = 100000, help = "number of starting boards")
+	parser.add_argument("--levels", type = parseLevels, default = [0], help = "levels to cycle through, e.g. 0-20")
+	parser.add_argument("--seed", type = parseSeed, help = "seed of the first board, the rest follow consecutively")
+	args = parser.parse_args()
+	if args.seed is not None and args.seed + args.count > MAX_SEED:
+		parser.error("--seed leaves no room for %d consecutive seeds" % args.count)
+	generatePack(args.path, args.count, args.levels, args.seed)
@@ -0,0 +1,118 @@
+"""
+Per-frame phase timing for the Dr Mario game loop.
+
+The loop calls startFrame(), then mark(phase) after each piece of work,
+which charges the time since the previous mark to that phase, then
+endFrame(); skip() drops time spent waiting. inputApplied() and displayed()
+bracket the latency from an input being applied to it reaching the screen.
+The last WINDOW samples are kept per phase for rolling p50/p95/p99 figures,
+and a JSON line of them can be appended to a stats file every few seconds
+for scraping. While disabled every call returns
+straight away, so the profiler can stay wired into the loop.
+
+# @Author: V.K. Prinsen
+
+"""
+
+import json
+import time
+import logging
+from collections import deque
+
+# phases of a frame, in the order the game loop runs them
+PHASES = ("input", "gravity", "resolve", "update", "draw", "display")
+# frames kept for the rolling percentiles
+WINDOW = 300
+PERCENTILES = (50, 95, 99)
+# seconds between stats lines
+STATS_INTERVAL = 5
+
+def percentile(ordered, percent):
+	"""nearest-rank percentile of a sorted list"""
+	if not ordered:
+		return 0.0
+	return ordered[min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))]
+
+class FrameProfiler():
+	"""times the phases of every frame and keeps rolling percentiles over the last WINDOW frames"""
+	def __init__(self, statsPath = None, window = WINDOW, statsInterval = STATS_INTERVAL):
+		self.enabled = statsPath is not None
+		self.statsPath = statsPath
+		self.statsInterval = statsInterval
+		self.samples = {phase: deque(maxlen = window) for phase in PHASES + ("frame", "latency")}
+		self.current = dict.fromkeys(PHASES, 0.0)
+		# when each applied input not yet on screen was applied
+		self.pendingInputs = []
+		self.last = 0.0
+		self.frames = 0
+		self.lastStats = time.perf_counter()
+		self.framesAtLastStats = 0
+	def enable(self):
+		"""starts timing from now, so the time spent disabled is not charged to the next phase"""
+		if self.enabled:
+			return
+		self.enabled = True
+		self.pendingInputs.clear()
+		self.startFrame()
+	def disable(self):
+		self.enabled = False
+		self.pendingInputs.clear()
+		self.current = dict.fromkeys(PHASES, 0.0)
+	def startFrame(self):
+		if not self.enabled:
+			return
+		for phase in self.current:
+			self.current[phase] = 0.0
+		self.last = time.perf_counter()
+	def mark(self, phase):
+		"""charges the time since the last mark to phase"""
+		if not self.enabled:
+			return
+		now = time.perf_counter()
+		self.current[phase] += now - self.last
+		self.last = now
+	def skip(self):
+		"""drops the time since the last mark, e.g. time spent waiting for input"""
+		if self.enabled:
+			self.last = time.perf_counter()
+	def inputApplied(self):
+		if self.enabled:
+			self.pendingInputs.append(time.perf_counter())
+	def displayed(self):
+		"""the screen was just updated, so every pending input is now visible"""
+		if not self.enabled or not self.pendingInputs:
+			return
+		now = time.perf_counter()
+		self.samples["latency"].extend(now - appliedTime for appliedTime in self.pendingInputs)
+		self.pendingInputs.clear()
+	def endFrame(self):
+		if not self.enabled:
+			return
+		for (phase, seconds) in self.current.items():
+			self.samples[phase].append(seconds)
+		self.samples["frame"].append(sum(self.current.values()))
+		self.frames += 1
+		if self.statsPath and self.last - self.lastStats >= self.statsInterval:
+			self.writeStats()
+	def percentiles(self):
+		"""returns {phase: (p50, p95, p99)} in milliseconds over the window"""
+		figures = {}
+		for (phase, samples) in self.samples.items():
+			ordered = sorted(samples)
+			figures[phase] = tuple(percentile(ordered, percent) * 1000 for percent in PERCENTILES)
+		return figures
+	def writeStats(self):
+		"""appends one JSON line of frame rate and phase percentiles to the stats file"""
+		now = time.perf_counter()
+		line = {
+			"time": round(time.time(), 3),
+			"fps": round((self.frames - self.framesAtLastStats) / max(now - self.lastStats, 1e-9), 2),
+			"frames": self.frames,
+		}
+		for (phase, figures) in self.percentiles().items():
+			line[phase] = {"p%d" % percent: round(value, 3) for (percent, value) in zip(PERCENTILES, figures)}
+		with open(self.statsPath, "a") as statsFile:
+			statsFile.write(json.dumps(line) + "\n")
+		logging.debug("Frame stats: %s", line)
+		self.lastStats = now
+		self.framesAtLastStats = self.frames
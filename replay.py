@@ -0,0 +1,136 @@
+"""
+Compact binary replays for Dr Mario.
+
+A replay holds the game seed and settings, then every input that changed the
+game as an action byte and a varint tick delta, then an end marker, the final
+tick count and the board hash. Because the rules are deterministic for a given
+seed and logic rate, playReplay can re-simulate a game headless, far faster
+than real time, and check it ends on the same board.
+
+	python replay.py game.drr [more.drr ...]
+
+# @Author: V.K. Prinsen
+
+"""
+
+import sys
+import struct
+import logging
+
+from engine import LOGIC_RATE, Action, GameState
+
+MAGIC = b"DRMR"
+VERSION = 3
+# magic, version, level, logic rate, seed, rows, cols, flags
+HEADER = struct.Struct("<4sBBHQHHB")
+FLAG_INSTANT_RESOLVE = 1
+END_OF_INPUTS = 0xFF
+HASH_SIZE = 8
+
+def encodeVarint(value):
+	"""unsigned LEB128, so most tick deltas take a single byte"""
+	data = bytearray()
+	while (1):
+		byte = value & 0x7F
+		value >>= 7
+		if value:
+			data.append(byte | 0x80)
+		else:
+			data.append(byte)
+			return data
+
+def decodeVarint(data, offset):
+	"""returns (value, next offset)"""
+	value = 0
+	shift = 0
+	while (1):
+		byte = data[offset]
+		offset += 1
+		value |= (byte & 0x7F) << shift
+		shift += 7
+		if not byte & 0x80:
+			return value, offset
+
+class ReplayRecorder():
+	"""drives a GameState in fixed logic ticks and records every input that changed it"""
+	def __init__(self, state, logicRate = LOGIC_RATE):
+		self.state = state
+		self.logicRate = logicRate
+		self.tickTime = 1000 / logicRate
+		self.ticks = 0
+		self.lastInputTick = 0
+		flags = FLAG_INSTANT_RESOLVE if state.instantResolve else 0
+		self.data = bytearray(HEADER.pack(MAGIC, VERSION, state.level, logicRate, state.seed, state.board.rows,
+			state.board.cols, flags))
+	def applyAction(self, action):
+		"""applies an action, recording it against the current tick if it did anything"""
+		applied = self.state.applyAction(action)
+		if applied:
+			self.data.append(action)
+			self.data += encodeVarint(self.ticks - self.lastInputTick)
+			self.lastInputTick = self.ticks
+		return applied
+	def tick(self):
+		"""advances the game by one fixed logic tick"""
+		self.ticks += 1
+		return self.state.tick(self.tickTime)
+	def finish(self):
+		"""returns the finished replay as bytes"""
+		return bytes(self.data + bytes((END_OF_INPUTS,)) + encodeVarint(self.ticks) + self.state.boardHash())
+	def save(self, path):
+		with open(path, "wb") as replayFile:
+			replayFile.write(self.finish())
+		logging.info("Saved replay of %d ticks to %s", self.ticks, path)
+
+class Replay():
+	"""a decoded replay: game settings, the (tick, action) inputs and the expected final board hash"""
+	def __init__(self, data):
+		(magic, version, self.level, self.logicRate, self.seed, self.rows, self.cols, flags) = HEADER.unpack_from(data)
+		if magic != MAGIC or version != VERSION:
+			raise ValueError("Not a version %d Dr Mario replay" % VERSION)
+		self.instantResolve = bool(flags & FLAG_INSTANT_RESOLVE)
+		self.inputs = []
+		offset = HEADER.size
+		tick = 0
+		while (1):
+			action = data[offset]
+			offset += 1
+			if action == END_OF_INPUTS:
+				break
+			(delta, offset) = decodeVarint(data, offset)
+			tick += delta
+			self.inputs.append((tick, Action(action)))
+		(self.ticks, offset) = decodeVarint(data, offset)
+		self.boardHash = bytes(data[offset:offset + HASH_SIZE])
+
+def loadReplay(path):
+	with open(path, "rb") as replayFile:
+		return Replay(replayFile.read())
+
+def playReplay(replay):
+	"""re-simulates a replay headless, returns the final GameState and whether its board hash matches"""
+	state = GameState(replay.level, rows = replay.rows, cols = replay.cols, instantResolve = replay.instantResolve,
+		seed = replay.seed)
+	tickTime = 1000 / replay.logicRate
+	inputs = replay.inputs
+	nextInput = 0
+	for tick in range(0, replay.ticks):
+		while nextInput < len(inputs) and inputs[nextInput][0] == tick:
+			state.applyAction(inputs[nextInput][1])
+			nextInput += 1
+		state.tick(tickTime)
+	# inputs after the last tick still count towards the final board
+	for (tick, action) in inputs[nextInput:]:
+		state.applyAction(action)
+	return state, state.boardHash() == replay.boardHash
+
+if __name__ == "__main__":
+	logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+	failures = 0
+	for path in sys.argv[1:]:
+		replay = loadReplay(path)
+		(state, matched) = playReplay(replay)
+		logging.info("%s: seed %d level %d, %d inputs over %d ticks, %s", path, replay.seed, replay.level,
+			len(replay.inputs), replay.ticks, "board hash matches" if matched else "BOARD HASH MISMATCH")
+		failures += not matched
+	sys.exit(1 if failures else 0)
@@ -0,0 +1,324 @@
+"""
+Asyncio Dr Mario server, hosting many headless games in one process.
+
+Each connection plays one game at a time on the engine rules. A single
+ticker coroutine advances every session on a fixed logic tick, with no
+thread per game, and sends each client only the cells of its board view
+(GameState.view(), the falling pill included) that changed since the last
+tick. Every message is a u16 length followed by a type byte:
+
+	client	NEW_GAME	level u8, has seed u8, seed u64
+			INPUT		action u8, applied straight away
+			STATS		no payload
+	server	START		seed u64, level u8, rows u16, cols u16, logic rate u16, then every view cell
+			DELTA		tick u32, virus count u16, change count varint, then per change
+						the varint gap from the previous changed index and the new cell
+			END			won u8, pills used u32, ticks u32
+			STATS_REPLY	sessions u32, cpu seconds f64, wall seconds f64, ticks u64, late ticks u64
+
+The load test opens many sessions, plays random inputs, mirrors every
+board from its deltas and reports tick jitter and sessions per core.
+
+	python server.py serve --port 7700
+	python server.py loadtest --port 7700 --sessions 500 --duration 20
+
+# @Author: V.K. Prinsen
+
+"""
+
+import time
+import random
+import struct
+import asyncio
+import logging
+import argparse
+
+from engine import LEVEL, LOGIC_RATE, Action, GameState
+from replay import encodeVarint, decodeVarint
+from profiler import percentile
+
+PORT = 7700
+LENGTH = struct.Struct("<H")
+
+# client messages
+NEW_GAME = 1
+INPUT = 2
+STATS = 3
+# server messages
+START = 16
+DELTA = 17
+END = 18
+STATS_REPLY = 19
+
+NEW_GAME_FORMAT = struct.Struct("<BB?Q")
+INPUT_FORMAT = struct.Struct("<BB")
+START_FORMAT = struct.Struct("<BQBHHH")
+DELTA_FORMAT = struct.Struct("<BIH")
+END_FORMAT = struct.Struct("<B?II")
+STATS_FORMAT = struct.Struct("<BIddQQ")
+# payload size of each client message
+MESSAGE_SIZES = {NEW_GAME: NEW_GAME_FORMAT.size, INPUT: INPUT_FORMAT.size, STATS: 1}
+
+# a client that lets this much go unread is dropped rather than buffered forever
+MAX_WRITE_BUFFER = 1 << 20
+
+def frame(payload):
+	return LENGTH.pack(len(payload)) + payload
+
+async def readMessage(reader):
+	"""returns the next message payload, or None when the connection closes"""
+	try:
+		(length,) = LENGTH.unpack(await reader.readexactly(LENGTH.size))
+		return await reader.readexactly(length)
+	except (asyncio.IncompleteReadError, ConnectionError):
+		return None
+
+def encodeDelta(old, new):
+	"""varint gap and new value of every cell that differs, returns (count, data)"""
+	data = bytearray()
+	count = 0
+	previous = 0
+	for index in range(0, len(new)):
+		if old[index] != new[index]:
+			data += encodeVarint(index - previous)
+			data.append(new[index])
+			previous = index
+			count += 1
+	return count, data
+
+def applyDelta(cells, data, offset, count):
+	"""applies encodeDelta() data to a bytearray of cells"""
+	index = 0
+	for _ in range(0, count):
+		(gap, offset) = decodeVarint(data, offset)
+		index += gap
+		cells[index] = data[offset]
+		offset += 1
+	return offset
+
+class Session():
+	"""one client's game and the view it was last sent"""
+	def __init__(self, writer, level, seed):
+		self.writer = writer
+		self.state = GameState(level, seed = seed)
+		self.view = self.state.view()
+		self.ticks = 0
+	def start(self, logicRate):
+		board = self.state.board
+		self.send(START_FORMAT.pack(START, self.state.seed, self.state.level, board.rows, board.cols, logicRate) +
+			bytes(self.view))
+	def send(self, payload):
+		self.writer.write(frame(payload))
+	def tick(self, tickTime):
+		"""advances the game a tick and sends what changed, returns False once the game is over"""
+		state = self.state
+		state.tick(tickTime)
+		self.ticks += 1
+		view = state.view()
+		if view != self.view:
+			(count, data) = encodeDelta(self.view, view)
+			self.send(DELTA_FORMAT.pack(DELTA, self.ticks, max(state.virusCount, 0)) + encodeVarint(count) + data)
+			self.view = view
+		if state.gameOver:
+			self.send(END_FORMAT.pack(END, state.won, state.pillsUsed, self.ticks))
+			return False
+		return True
+
+class GameServer():
+	"""hosts sessions on one asyncio loop, ticking them all together"""
+	def __init__(self, logicRate = LOGIC_RATE):
+		self.logicRate = logicRate
+		self.tickTime = 1000 / logicRate
+		self.sessions = set()
+		self.ticks = 0
+		self.lateTicks = 0
+		self.startTime = time.perf_counter()
+		self.startCpu = time.process_time()
+	async def handleClient(self, reader, writer):
+		session = None
+		try:
+			while (1):
+				payload = await readMessage(reader)
+				if payload is None:
+					break
+				kind = payload[0] if payload else None
+				if kind in MESSAGE_SIZES and len(payload) != MESSAGE_SIZES[kind]:
+					logging.warning("Dropping client after a %d byte message %d", len(payload), kind)
+					break
+				if kind == INPUT:
+					action = INPUT_FORMAT.unpack(payload)[1]
+					if action >= len(Action):
+						logging.warning("Dropping client after unknown action %d", action)
+						break
+					if session is None:
+						# nothing to move until the client starts a game
+						logging.debug("Ignoring input with no game in progress")
+						continue
+					session.state.applyAction(Action(action))
+				elif kind == NEW_GAME:
+					(kind, level, hasSeed, seed) = NEW_GAME_FORMAT.unpack(payload)
+					self.sessions.discard(session)
+					session = Session(writer, level, seed if hasSeed else None)
+					session.start(self.logicRate)
+					self.sessions.add(session)
+				elif kind == STATS:
+					writer.write(frame(STATS_FORMAT.pack(STATS_REPLY, len(self.sessions),
+						time.process_time() - self.startCpu, time.perf_counter() - self.startTime, self.ticks,
+						self.lateTicks)))
+				else:
+					logging.warning("Dropping client after unknown message %s", kind)
+					break
+		finally:
+			self.sessions.discard(session)
+			writer.close()
+	async def tickSessions(self):
+		"""runs every session's logic tick on a fixed schedule"""
+		loop = asyncio.get_running_loop()
+		seconds = self.tickTime / 1000
+		nextTick = loop.time()
+		while (1):
+			nextTick += seconds
+			delay = nextTick - loop.time()
+			if delay > 0:
+				await asyncio.sleep(delay)
+			else:
+				# behind schedule: count it, and give up on ticks more than a tick late rather than bursting
+				self.lateTicks += 1
+				if delay < -seconds:
+					nextTick = loop.time()
+				await asyncio.sleep(0)
+			self.ticks += 1
+			for session in list(self.sessions):
+				if session.writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+					logging.warning("Dropping a client that stopped reading")
+					self.sessions.discard(session)
+					session.writer.close()
+				elif not session.tick(self.tickTime):
+					self.sessions.discard(session)
+	async def serve(self, host = "127.0.0.1", port = PORT, unixPath = None):
+		if unixPath:
+			server = await asyncio.start_unix_server(self.handleClient, unixPath)
+		else:
+			server = await asyncio.start_server(self.handleClient, host, port)
+		logging.info("Serving on %s", unixPath or "%s:%d" % (host, port))
+		ticker = asyncio.ensure_future(self.tickSessions())
+		try:
+			async with server:
+				await server.serve_forever()
+		finally:
+			ticker.cancel()
+
+# Load test
+
+async def openConnection(host, port, unixPath):
+	if unixPath:
+		return await asyncio.open_unix_connection(unixPath)
+	return await asyncio.open_connection(host, port)
+
+async def requestStats(host, port, unixPath):
+	(reader, writer) = await openConnection(host, port, unixPath)
+	writer.write(frame(bytes((STATS,))))
+	payload = await readMessage(reader)
+	writer.close()
+	return STATS_FORMAT.unpack(payload)
+
+class LoadClient():
+	"""one load test session: plays random inputs and mirrors its board from the deltas"""
+	def __init__(self, number, level, inputInterval):
+		self.number = number
+		self.level = level
+		self.inputInterval = inputInterval
+		self.rng = random.Random(number)
+		self.cells = None
+		self.games = 0
+		self.deltas = 0
+		self.deltaBytes = 0
+		# how late each delta arrived against the tick schedule of its game, in seconds
+		self.lateness = []
+	async def run(self, host, port, unixPath, deadline):
+		(reader, writer) = await openConnection(host, port, unixPath)
+		inputs = asyncio.ensure_future(self.sendInputs(writer, deadline))
+		writer.write(frame(NEW_GAME_FORMAT.pack(NEW_GAME, self.level, True, self.number)))
+		(firstArrival, tickSeconds) = (None, 0)
+		try:
+			while time.perf_counter() < deadline:
+				try:
+					payload = await asyncio.wait_for(readMessage(reader), deadline - time.perf_counter())
+				except asyncio.TimeoutError:
+					break
+				if payload is None:
+					break
+				now = time.perf_counter()
+				kind = payload[0]
+				if kind == START:
+					(kind, seed, level, rows, cols, logicRate) = START_FORMAT.unpack_from(payload)
+					self.cells = bytearray(payload[START_FORMAT.size:])
+					tickSeconds = 1 / logicRate
+					firstArrival = None
+				elif kind == DELTA:
+					(kind, tick, virusCount) = DELTA_FORMAT.unpack_from(payload)
+					(count, offset) = decodeVarint(payload, DELTA_FORMAT.size)
+					applyDelta(self.cells, payload, offset, count)
+					self.deltas += 1
+					self.deltaBytes += len(payload) + LENGTH.size
+					if firstArrival is None:
+						firstArrival = now - tick * tickSeconds
+					else:
+						self.lateness.append(now - (firstArrival + tick * tickSeconds))
+				elif kind == END:
+					self.games += 1
+					writer.write(frame(NEW_GAME_FORMAT.pack(NEW_GAME, self.level, True, self.number + self.games * 100003)))
+		finally:
+			inputs.cancel()
+			writer.close()
+	async def sendInputs(self, writer, deadline):
+		actions = [Action.LEFT, Action.RIGHT, Action.ROTATE, Action.DOWN]
+		# spread the sessions' inputs out rather than sending them all at once
+		await asyncio.sleep(self.rng.random() * self.inputInterval)
+		while time.perf_counter() < deadline:
+			writer.write(frame(INPUT_FORMAT.pack(INPUT, self.rng.choice(actions))))
+			await asyncio.sleep(self.inputInterval)
+
+async def loadTest(host = "127.0.0.1", port = PORT, unixPath = None, sessions = 100, duration = 10, level = LEVEL,
+		inputInterval = 0.2):
+	"""runs sessions clients against a server for duration seconds and logs jitter and sessions per core"""
+	before = await requestStats(host, port, unixPath)
+	clients = [LoadClient(number, level, inputInterval) for number in range(0, sessions)]
+	deadline = time.perf_counter() + duration
+	await asyncio.gather(*(client.run(host, port, unixPath, deadline) for client in clients))
+	after = await requestStats(host, port, unixPath)
+	cpuShare = (after[2] - before[2]) / max(after[3] - before[3], 1e-9)
+	# lateness is measured against each game's first delta; jitter is its spread around the typical lateness
+	lateness = sorted(late for client in clients for late in client.lateness)
+	median = percentile(lateness, 50)
+	jitter = sorted(abs(late - median) for late in lateness)
+	deltas = sum(client.deltas for client in clients)
+	logging.info("%d sessions for %.1f s: %d games finished, %d deltas of %.1f bytes on average", sessions, duration,
+		sum(client.games for client in clients), deltas, sum(client.deltaBytes for client in clients) / max(deltas, 1))
+	logging.info("Server used %.1f%% of a core, %.0f sessions per core; %d of %d ticks ran late", cpuShare * 100,
+		sessions / max(cpuShare, 1e-9), after[5] - before[5], after[4] - before[4])
+	logging.info("Tick jitter: p50 %.2f ms, p99 %.2f ms, max %.2f ms", percentile(jitter, 50) * 1000,
+		percentile(jitter, 99) * 1000, (jitter[-1] if jitter else 0) * 1000)
+	return clients
+
+if __name__ == "__main__":
+	logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+	parser = argparse.ArgumentParser(description = "Dr Mario game server and load test")
+	parser.add_argument("mode", choices = ("serve", "loadtest"))
+	parser.add_argument("--host", default = "127.0.0.1")
+	parser.add_argument("--port", type = int, default = PORT)
+	parser.add_argument("--unix", metavar = "PATH", help = "use a Unix socket instead of TCP")
+	parser.add_argument("--logic-rate", type = int, default = LOGIC_RATE, help = "game logic ticks per second")
+	parser.add_argument("--sessions", type = int, default = 100, help = "load test sessions")
+	parser.add_argument("--duration", type = float, default = 10, help = "load test seconds")
+	parser.add_argument("--level", type = int, default = LEVEL, help = "load test virus level")
+	parser.add_argument("--input-interval", type = float, default = 0.2, help = "seconds between a load test session's inputs")
+	args = parser.parse_args()
+	try:
+		if args.mode == "serve":
+			asyncio.run(GameServer(args.logic_rate).serve(args.host, args.port, args.unix))
+		else:
+			asyncio.run(loadTest(args.host, args.port, args.unix, args.sessions, args.duration, args.level,
+				args.input_interval))
+	except KeyboardInterrupt:
+		pass
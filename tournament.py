@@ -0,0 +1,191 @@
+"""
+Headless Dr Mario sweeps over many seeds and levels.
+
+Every (level, seed) game is played by a policy, the search bot or random
+inputs, on a pool of worker processes, and each result is appended to a
+results file as it arrives. The file is a header followed by fixed-size
+records, so an interrupted sweep resumes by skipping the games already in it
+(a torn last record is dropped). When the sweep ends, per-level percentiles
+are read back from the file and logged.
+
+	python tournament.py sweep.drt --levels 0-20 --seeds 1000 --policy bot --lookahead 1
+	python tournament.py sweep.drt --summary
+
+# @Author: V.K. Prinsen
+
+"""
+
+import os
+import time
+import random
+import struct
+import logging
+import argparse
+from multiprocessing import Pool
+
+from engine import MAX_SEED, TICK_MS, Action, GameState, parseSeed
+from bot import Bot
+from levelpack import parseLevels
+from profiler import percentile
+
+RESULTS_MAGIC = b"DRTR"
+RESULTS_VERSION = 1
+POLICIES = ("bot", "random")
+# magic, version, policy, lookahead, max pills
+RESULTS_HEADER = struct.Struct("<4sBBBxI")
+# level, seed, outcome, viruses at the start, viruses cleared, pills used, ticks, longest chain, chains of two or more
+RESULT_RECORD = struct.Struct("<BQBHHIIHH")
+RESULT_FIELDS = ("level", "seed", "outcome", "viruses", "virusesCleared", "pillsUsed", "ticks", "longestChain", "chains")
+# how a game ended
+LOST = 0
+WON = 1
+CUT_OFF = 2
+# pills a game may use before it is cut off
+MAX_PILLS = 1000
+# seconds between flushes of the results file
+FLUSH_INTERVAL = 1
+
+# Worker processes
+
+def startWorker(policy, lookahead, maxPills):
+	global workerPolicy
+	workerPolicy = (policy, Bot(lookahead) if policy == "bot" else None, maxPills)
+
+def playJob(job):
+	(level, seed) = job
+	(policy, bot, maxPills) = workerPolicy
+	return playGame(level, seed, policy, bot, maxPills)
+
+def playGame(level, seed, policy, bot = None, maxPills = MAX_PILLS):
+	"""plays one game to the end and returns its packed RESULT_RECORD"""
+	state = GameState(level, instantResolve = True, seed = seed)
+	viruses = state.virusCount
+	# random inputs come from their own seeded stream, so every game can be replayed
+	rng = random.Random(seed)
+	actions = list(Action)
+	(ticks, longestChain, chains) = (0, 0, 0)
+	while not state.gameOver and state.pillsUsed <= maxPills:
+		if policy == "bot":
+			if state.pill is not None and not state.resolveNeeded:
+				for action in bot.chooseActions(state):
+					state.applyAction(action)
+				state.applyAction(Action.HARD_DROP)
+		else:
+			state.applyAction(rng.choice(actions))
+		pill = state.pill
+		state.tick(TICK_MS)
+		ticks += 1
+		if state.pill is not pill:
+			# a pill locked; its chain is the number of times the cascade cleared something
+			chain = sum(1 for chainStep in state.chainSteps if chainStep.cleared)
+			longestChain = max(longestChain, chain)
+			chains += chain >= 2
+	outcome = WON if state.won else LOST if state.gameOver else CUT_OFF
+	return RESULT_RECORD.pack(level, seed, outcome, viruses, viruses - max(state.virusCount, 0), state.pillsUsed, ticks,
+		longestChain, chains)
+
+# Results file
+
+def openResults(path, policy, lookahead, maxPills):
+	"""opens a results file for appending, creating it or checking it was made by the same policy;
+	returns the file and the (level, seed) of every game already in it"""
+	header = RESULTS_HEADER.pack(RESULTS_MAGIC, RESULTS_VERSION, POLICIES.index(policy), lookahead, maxPills)
+	if not os.path.exists(path) or os.path.getsize(path) < RESULTS_HEADER.size:
+		resultsFile = open(path, "wb")
+		resultsFile.write(header)
+		return resultsFile, set()
+	with open(path, "rb") as existing:
+		if existing.read(RESULTS_HEADER.size) != header:
+			raise ValueError("%s holds results of another policy or version" % path)
+	records = [(record[0], record[1]) for record in readResults(path)]
+	# an interrupted write leaves part of a record at the end
+	size = RESULTS_HEADER.size + len(records) * RESULT_RECORD.size
+	resultsFile = open(path, "r+b")
+	resultsFile.truncate(size)
+	resultsFile.seek(size)
+	return resultsFile, set(records)
+
+def readResults(path):
+	"""yields every whole RESULT_RECORD tuple in a results file"""
+	with open(path, "rb") as resultsFile:
+		header = resultsFile.read(RESULTS_HEADER.size)
+		(magic, version) = RESULTS_HEADER.unpack(header)[:2]
+		if magic != RESULTS_MAGIC or version != RESULTS_VERSION:
+			raise ValueError("Not a version %d Dr Mario results file" % RESULTS_VERSION)
+		while (1):
+			data = resultsFile.read(RESULT_RECORD.size * 4096)
+			count = len(data) // RESULT_RECORD.size
+			yield from RESULT_RECORD.iter_unpack(data[:count * RESULT_RECORD.size])
+			if len(data) < RESULT_RECORD.size * 4096:
+				break
+
+def runSweep(path, levels, seeds, policy = "bot", lookahead = 1, maxPills = MAX_PILLS, workers = None):
+	"""plays every (level, seed) not already in the results file, appending results as they finish"""
+	(resultsFile, done) = openResults(path, policy, lookahead, maxPills)
+	jobs = [(level, seed) for level in levels for seed in seeds if (level, seed) not in done]
+	logging.info("%d games to play, %d already in %s", len(jobs), len(done), path)
+	start = lastFlush = lastLog = time.perf_counter()
+	played = 0
+	try:
+		with Pool(workers, initializer = startWorker, initargs = (policy, lookahead, maxPills)) as pool:
+			for record in pool.imap_unordered(playJob, jobs, chunksize = 4):
+				resultsFile.write(record)
+				played += 1
+				now = time.perf_counter()
+				if now - lastFlush >= FLUSH_INTERVAL:
+					resultsFile.flush()
+					lastFlush = now
+				if now - lastLog >= 10:
+					logging.info("%d of %d games, %.1f games/s", played, len(jobs), played / (now - start))
+					lastLog = now
+	except KeyboardInterrupt:
+		logging.info("Interrupted, run again to resume")
+	finally:
+		resultsFile.close()
+	logging.info("Played %d games in %.1f s", played, time.perf_counter() - start)
+	return played
+
+def summarize(path):
+	"""logs per-level outcomes and percentiles of a results file"""
+	levels = {}
+	for record in readResults(path):
+		result = dict(zip(RESULT_FIELDS, record))
+		levels.setdefault(result["level"], []).append(result)
+	logging.info("%5s %6s %6s %6s %17s %17s %17s %8s", "level", "games", "won", "cutOff", "pills p50/p90/p99",
+		"ticks p50/p90/p99", "cleared p10/p50", "chain99")
+	for (level, results) in sorted(levels.items()):
+		figures = {}
+		for field in ("pillsUsed", "ticks", "virusesCleared", "longestChain"):
+			ordered = sorted(result[field] for result in results)
+			figures[field] = [percentile(ordered, percent) for percent in (10, 50, 90, 99)]
+		won = sum(result["outcome"] == WON for result in results)
+		cutOff = sum(result["outcome"] == CUT_OFF for result in results)
+		logging.info("%5d %6d %5.1f%% %6d %17s %17s %17s %8d", level, len(results), 100 * won / len(results), cutOff,
+			"%d/%d/%d" % tuple(figures["pillsUsed"][1:]), "%d/%d/%d" % tuple(figures["ticks"][1:]),
+			"%d/%d" % tuple(figures["virusesCleared"][:2]), figures["longestChain"][3])
+	return levels
+
+if __name__ == "__main__":
+	logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+	parser = argparse.ArgumentParser(description = "Play Dr Mario sweeps over seeds and levels")
+	parser.add_argument("path", help = "results file, resumed if it exists")
+	parser.add_argument("--levels", type = parseLevels, default = list(range(0, 21)), help = "levels to play, e.g. 0-20")
+	parser.add_argument("--seeds", type = int, default = 100, help = "seeds per level")
+	parser.add_argument("--first-seed", type = parseSeed, default = 0, help = "first seed, the rest follow consecutively")
+	parser.add_argument("--policy", choices = POLICIES, default = "bot", help = "who plays")
+	parser.add_argument("--lookahead", type = int, default = 1, help = "pills the bot searches ahead")
+	parser.add_argument("--max-pills", type = int, default = MAX_PILLS, help = "pills a game may use before it is cut off")
+	parser.add_argument("--workers", type = int, help = "worker processes, all cores by default")
+	parser.add_argument("--summary", action = "store_true", help = "only summarize the results file")
+	args = parser.parse_args()
+	if args.first_seed + args.seeds > MAX_SEED:
+		parser.error("--first-seed leaves no room for %d consecutive seeds" % args.seeds)
+	try:
+		if not args.summary:
+			runSweep(args.path, args.levels, range(args.first_seed, args.first_seed + args.seeds), args.policy,
+				args.lookahead, args.max_pills, args.workers)
+		summarize(args.path)
+	except ValueError as error:
+		parser.error(str(error))
+	except FileNotFoundError:
+		parser.error("%s does not exist" % args.path)